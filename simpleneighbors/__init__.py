@@ -1,11 +1,85 @@
+from collections import namedtuple
+from functools import partial
+from multiprocessing import Pool, cpu_count
+import math
+import os
 import pickle
+import shutil
+import tempfile
+import threading
 from simpleneighbors.backends import select_best
+from simpleneighbors.backends.segmented import Segmented
+from simpleneighbors.cache import QueryCache, vector_digest
+from simpleneighbors.corpus import CorpusWriter, MappedCorpus, write_corpus
+from simpleneighbors.metadata import MetadataIndex
+from simpleneighbors.stats import Stats, counting, timed, timer
 
 __author__ = 'Allison Parrish'
 __email__ = 'allison@decontextualize.com'
 __version__ = '0.1.0'
 
 
+def _next_fetch(fetch, seen, checked, passed, needed):
+    """Returns how many candidates to fetch in the next round of a filtered
+    search, given how many have been seen and checked, and how many passed."""
+    if passed == 0:
+        # nothing has passed yet, so there's no estimate of selectivity
+        return fetch * 4
+    # fetch enough new candidates to find the rest at the observed pass rate,
+    # with some headroom (and at least double, to bound the number of rounds)
+    estimate = seen + int(1.5 * needed * checked / passed) + 1
+    return max(estimate, fetch * 2)
+
+
+# everything a query reads from an index. The tuple is never changed, only
+# replaced (by build() and compact()), and each query reads it once, so a
+# query never sees a new backend together with an old corpus (or vice versa).
+# (Adding or deleting items changes the corpus, id map and backend in place,
+# but only by appending to them or marking items deleted.)
+_IndexState = namedtuple('_IndexState', [
+    'backend', 'corpus', 'id_map', 'metadata', 'metadata_index'])
+
+
+def _knn_block(sim, path, start, stop, n, search_k):
+    """Finds the neighbors of the items with ids ``start`` to ``stop`` and
+    writes them to rows ``start:stop`` of the ``all_neighbors()`` output
+    arrays at ``path``."""
+    import numpy as np
+    from numpy.lib.format import open_memmap
+    ids = np.full((stop - start, n), -1, dtype=np.int32)
+    dists = np.full((stop - start, n), np.inf, dtype=np.float32)
+    backend = sim._state.backend
+    deleted = getattr(backend, 'deleted', ())
+    live = [idx for idx in range(start, stop) if idx not in deleted]
+    # sliced from the stored vectors where the backend keeps them in an array
+    vecs = backend.get_item_vectors(live) if live else []
+    found = backend.get_nns_by_vectors(
+            vecs, n, include_distances=True, search_k=search_k) if live \
+        else []
+    for idx, (row_ids, row_dists) in zip(live, found):
+        ids[idx - start, :len(row_ids)] = row_ids
+        dists[idx - start, :len(row_dists)] = row_dists
+    for suffix, block in (("-ids.npy", ids), ("-dists.npy", dists)):
+        out = open_memmap(path + suffix, mode='r+')
+        out[start:stop] = block
+        out.flush()
+        del out
+
+
+# the index loaded by each all_neighbors() worker process
+_knn_worker = {}
+
+
+def _knn_worker_init(prefix):
+    _knn_worker['sim'] = SimpleNeighbors.load(prefix, n_jobs=1)
+
+
+def _knn_worker_block(args):
+    block, path, start, stop, n, search_k = args
+    _knn_block(_knn_worker['sim'], path, start, stop, n, search_k)
+    return block
+
+
 class SimpleNeighbors:
     """A Simple Neighbors index.
 
@@ -24,25 +98,196 @@ class SimpleNeighbors:
     ``euclidean`` (for Euclidean distance). Both of these parameters are passed
     directly to the backend; see the backend documentation for more details.
 
+    To build an index that's too big to fit in memory, pass a filename prefix
+    as the ``on_disk`` parameter. The backend will then build the index
+    directly in a file with that prefix (supported by every backend except
+    Sklearn and BruteForcePurePython), and items are written to disk as
+    they're added instead of being kept in memory (using the compact format
+    described in :func:`~simpleneighbors.SimpleNeighbors.save`). Items can't
+    be looked up until the index is built. Once it's built, calling
+    :func:`~simpleneighbors.SimpleNeighbors.save` with the same prefix just
+    writes out a small file of object data.
+
+    If your application makes the same queries over and over, set
+    ``cache_size`` to cache the results of up to that many queries made with
+    :func:`~simpleneighbors.SimpleNeighbors.nearest`,
+    :func:`~simpleneighbors.SimpleNeighbors.neighbors` and their
+    ``_with_distances`` variants. The least recently used results are evicted
+    first, and if ``cache_ttl`` is given, results also expire that many
+    seconds after they're cached. (See
+    :func:`~simpleneighbors.SimpleNeighbors.cache_info`.)
+
+    Normally, you can't add items to an index after it's been built. If you
+    set ``mutable`` to ``True``, you can keep adding items after building the
+    index, and remove them with
+    :func:`~simpleneighbors.SimpleNeighbors.delete`. Items added after the
+    index is built are kept in a small brute-force index that's searched
+    alongside the main index, and deleted items are filtered out of results;
+    call :func:`~simpleneighbors.SimpleNeighbors.compact` now and then to fold
+    these changes into a freshly built main index.
+
+    Once an index is built (or loaded), it's safe to query it from several
+    threads at once, so a single loaded index can serve a pool of worker
+    threads without being copied. The Annoy and BruteForceNumpy backends
+    release the GIL while they search, so their queries actually run in
+    parallel. (Adding items isn't thread-safe before the index is built.) On
+    a mutable index, items can be added and deleted, and the index compacted,
+    while other threads are querying: each query uses the backend, items and
+    metadata as they were when it started, and
+    :func:`~simpleneighbors.SimpleNeighbors.compact` swaps in new ones all at
+    once. The ``n_jobs`` parameter limits the number of cores the backend
+    itself uses to build the index and answer batched queries (e.g., the
+    threads Annoy uses in
+    :func:`~simpleneighbors.SimpleNeighbors.nearest_many`, or Sklearn's
+    ``n_jobs``), which you'll want to set to 1 if you're running queries in
+    your own pool of threads. By default, each backend uses its own default.
+
+    The ``search_k`` attribute sets how much effort approximate backends put
+    into each search (for Annoy, the number of nodes to inspect; ``None``
+    means the backend's default). The ``search_effort`` attribute, used when
+    ``search_k`` is ``None``, sets the effort relative to the number of
+    results asked for: for backends whose ``search_k`` is a count of nodes
+    or candidates (Annoy, HNSW and Quantized), each search's ``search_k`` is
+    ``search_effort`` times the number of results, so that larger searches
+    get proportionally more effort. Both are saved with the index, and the
+    tuners in :mod:`simpleneighbors.tuning`, which pick backends and
+    parameters to meet a target recall or latency, set ``search_effort``.
+
+    To see where time goes, add hooks to be called after each operation
+    (see :func:`~simpleneighbors.SimpleNeighbors.add_hook`), or set
+    ``collect_stats`` to ``True`` to keep counts and latency histograms for
+    each operation (see :func:`~simpleneighbors.SimpleNeighbors.stats`).
+
     :param dims: the number of dimensions in your data
     :param metric: the distance metric to use
     :param backend: the nearest neighbors backend to use (default is annoy)
+    :param on_disk: filename prefix for building the index on disk
+    :param cache_size: number of query results to cache (default: none)
+    :param cache_ttl: seconds after which cached results expire
+    :param mutable: allow adding and deleting items after the index is built
+    :param n_jobs: number of cores the backend may use (-1 for all)
+    :param collect_stats: keep statistics about each operation
     """
 
-    def __init__(self, dims, metric="angular", backend=None):
+    def __init__(self, dims, metric="angular", backend=None, on_disk=None,
+                 cache_size=0, cache_ttl=None, mutable=False, n_jobs=None,
+                 collect_stats=False):
 
         if backend is None:
             backend = select_best()
+        if mutable and on_disk is not None:
+            raise ValueError("indexes built on disk can't be mutable")
 
         self.dims = dims
         self.metric = metric
-        self.id_map = {}
-        self.corpus = []
-        self.backend = backend(dims, metric=metric)
+        backend = backend(dims, metric=metric)
+        if n_jobs is not None:
+            backend.n_jobs = n_jobs
         self.i = 0
         self.built = False
+        self.on_disk = on_disk
+        corpus = []
+        if on_disk is not None:
+            backend.on_disk_build(on_disk + ".idx")
+            corpus = CorpusWriter(on_disk)
+        self._state = _IndexState(backend, corpus, {}, {}, MetadataIndex({}))
+        self.cache = None
+        if cache_size:
+            self.cache = QueryCache(cache_size, cache_ttl)
+        self.mutable = mutable
+        self.build_args = (10, None)
+        self.search_k = None
+        self.search_effort = None
+        self.lock = threading.RLock()
+        # held for the whole of a compaction, so that they don't overlap
+        self.compact_lock = threading.Lock()
+        self.hooks = None
+        self.stats_hook = None
+        if collect_stats:
+            self.stats_hook = Stats()
+            self.add_hook(self.stats_hook)
+
+    @property
+    def backend(self):
+        """The backend index."""
+        return self._state.backend
+
+    @property
+    def corpus(self):
+        """The items in the index, by id."""
+        return self._state.corpus
+
+    @property
+    def id_map(self):
+        """A mapping from each item in the index to its id."""
+        return self._state.id_map
+
+    @property
+    def metadata(self):
+        """A dictionary of the metadata of each item, by id."""
+        return self._state.metadata
+
+    @property
+    def metadata_index(self):
+        """The index used to evaluate metadata filters."""
+        return self._state.metadata_index
+
+    def add_hook(self, hook):
+        """Adds a function to call after each operation on the index.
+
+        The function is called with the name of the operation (e.g.,
+        ``'nearest'``), the time it took in seconds, and a dictionary with
+        extra information about the operation (which may be empty). See
+        :mod:`simpleneighbors.stats` for details.
+
+        :param hook: the function to call
+        :returns: None
+        """
+        # the list is replaced rather than changed, so that operations in
+        # other threads never see it half-updated
+        self.hooks = (self.hooks or []) + [hook]
+
+    def remove_hook(self, hook):
+        """Removes a function added with
+        :func:`~simpleneighbors.SimpleNeighbors.add_hook`.
 
-    def add_one(self, item, vector):
+        :param hook: the function to remove
+        :returns: None
+        """
+        hooks = [other for other in self.hooks or [] if other is not hook]
+        self.hooks = hooks or None
+
+    def _record(self, op, seconds, info):
+        for hook in self.hooks or []:
+            hook(op, seconds, info)
+
+    def stats(self, reset=False):
+        """Returns statistics about the operations performed on the index.
+
+        The result is a dictionary mapping the name of each operation (e.g.,
+        ``'nearest'``, ``'build'`` or ``'nearest_matching'``) to a dictionary
+        of statistics: the number of calls, latency percentiles and a
+        latency histogram, along with totals of any extra information (like
+        the number of backend searches, ``backend_calls``, and predicate
+        calls, ``check_calls``, made by
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_matching`). See
+        :meth:`simpleneighbors.stats.Stats.summary` for the full list.
+
+        Statistics are only kept if the index was created (or loaded) with
+        ``collect_stats=True``; otherwise, this method returns ``None``.
+
+        :param reset: clear the statistics after returning them
+        :returns: a dictionary of statistics, or None
+        """
+        if self.stats_hook is None:
+            return None
+        summary = self.stats_hook.summary()
+        if reset:
+            self.stats_hook.reset()
+        return summary
+
+    @timed('add_one')
+    def add_one(self, item, vector, metadata=None):
         """Adds an item to the index.
 
         You need to provide the item to add and a vector that corresponds to
@@ -56,27 +301,57 @@ class SimpleNeighbors:
         object. Vectors must be sequences of numbers. (Lists, tuples, and Numpy
         arrays should all be fine, for example.)
 
+        You can also provide a dictionary of metadata about the item (e.g.,
+        ``{'lang': 'en'}``), which you can use to filter the results of
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_matching` and
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors_matching`. Metadata
+        values must be hashable.
+
         Note: If the index has already been built, you won't be able to add new
-        items.
+        items (unless the index is mutable; in that case, adding an item that's
+        already in the index replaces it).
 
         :param item: the item to add
         :param vector: the vector corresponding to that item
+        :param metadata: dictionary of metadata about the item
         :returns: None
         """
 
-        assert self.built is False, "Index already built; can't add new items."
-        self.backend.add_item(self.i, vector)
-        self.id_map[item] = self.i
-        self.corpus.append(item)
-        self.i += 1
-
+        assert self.built is False or self.mutable, \
+            "Index already built; can't add new items."
+        with self.lock:
+            state = self._state
+            if self.built:
+                self._replace([item])
+            state.backend.add_item(self.i, vector)
+            if metadata:
+                state.metadata[self.i] = dict(metadata)
+                if self.built:
+                    state.metadata_index.add(self.i, metadata)
+            if self.on_disk is None:
+                state.id_map[item] = self.i
+            state.corpus.append(item)
+            self.i += 1
+
+    def _replace(self, items):
+        """Deletes any existing copies of items about to be re-added to a
+        built, mutable index."""
+        state = self._state
+        for item in items:
+            if item in state.id_map:
+                state.backend.delete(state.id_map.pop(item))
+        if self.cache is not None:
+            self.cache.clear()
+
+    @timed('feed')
     def feed(self, items):
         """Add multiple items to the index.
 
         Supply to this method a sequence of (item, vector) tuples (e.g., a list
         of tuples, a generator that produces tuples, etc.) and they'll all be
         added to the index.  Great for adding multiple items to the index at
-        once.
+        once. (Tuples can also have a third element, a dictionary of metadata
+        about the item; see :func:`~simpleneighbors.SimpleNeighbors.add_one`.)
 
         Items can be any `hashable
         <https://docs.python.org/3.7/glossary.html#term-hashable>`_ Python
@@ -94,13 +369,179 @@ class SimpleNeighbors:
             >>> len(sim)
             4
 
-        :param items: a sequence of (item, vector) tuples
+        :param items: a sequence of (item, vector) or (item, vector, metadata)
+            tuples
         :returns: None
         """
-        for item, vector in items:
-            self.add_one(item, vector)
+        for row in items:
+            self.add_one(*row)
+
+    @timed('feed_arrays')
+    def feed_arrays(self, items, matrix, metadata=None):
+        """Add a block of items to the index, with vectors in a 2D array.
+
+        This method is a much faster alternative to
+        :func:`~simpleneighbors.SimpleNeighbors.feed` for adding large numbers
+        of items. Supply a sequence of items and a matrix with one row per item
+        (a 2D Numpy array, or any object that Numpy can turn into one, like an
+        object supporting the buffer protocol), and the whole block of vectors
+        is handed to the backend at once.
+
+        .. doctest::
+
+            >>> import numpy as np
+            >>> from simpleneighbors import SimpleNeighbors
+            >>> sim = SimpleNeighbors(2, 'euclidean')
+            >>> sim.feed_arrays(['a', 'b', 'c', 'd'],
+            ...     np.array([[4, 5], [0, 3], [-2, 8], [2, -2]]))
+            >>> len(sim)
+            4
+
+        :param items: a sequence of items
+        :param matrix: a 2D array of vectors, one row for each item
+        :param metadata: a sequence of metadata dictionaries (or ``None``), one
+            for each item
+        :returns: None
+        """
+
+        assert self.built is False or self.mutable, \
+            "Index already built; can't add new items."
+        items = list(items)
+        try:
+            import numpy as np
+        except ImportError:
+            matrix = [list(row) for row in matrix]
+        else:
+            matrix = np.asarray(matrix, dtype=np.float32)
+            if matrix.ndim != 2 or matrix.shape[1] != self.dims:
+                raise ValueError("expected an array with shape (n, %d)" %
+                                 self.dims)
+        if len(items) != len(matrix):
+            raise ValueError("got %d items but %d vectors" %
+                             (len(items), len(matrix)))
+        if metadata is not None:
+            metadata = list(metadata)
+            if len(metadata) != len(items):
+                raise ValueError("got %d items but %d metadata entries" %
+                                 (len(items), len(metadata)))
+        with self.lock:
+            state = self._state
+            if self.built:
+                self._replace(items)
+            state.backend.add_items(self.i, matrix)
+            if metadata is not None:
+                for offset, meta in enumerate(metadata):
+                    if meta:
+                        state.metadata[self.i + offset] = dict(meta)
+                        if self.built:
+                            state.metadata_index.add(self.i + offset, meta)
+            if self.on_disk is None:
+                state.id_map.update(
+                    zip(items, range(self.i, self.i + len(items))))
+            state.corpus.extend(items)
+            self.i += len(items)
+
+    @classmethod
+    def _from_chunks(cls, chunks, metric, backend, progress, on_disk):
+        sim = None
+        for items, matrix in chunks:
+            if sim is None:
+                sim = cls(matrix.shape[1], metric=metric, backend=backend,
+                          on_disk=on_disk)
+            sim.feed_arrays(items, matrix)
+            if progress is not None:
+                progress(len(sim))
+        if sim is None:
+            raise ValueError("no vectors found")
+        return sim
+
+    @classmethod
+    def from_glove_text(cls, path, metric="angular", backend=None,
+                        limit=None, chunk_size=10000, progress=None,
+                        on_disk=None):
+        """Creates an index from a text file of vectors in GloVe format.
+
+        Each line of the file should consist of an item followed by the
+        components of its vector, separated by spaces. (Files in word2vec's
+        text format work too.) The file is read and added to the index in
+        chunks of ``chunk_size`` lines, so it never needs to fit in memory all
+        at once; see :func:`simpleneighbors.loaders.read_glove_text`. The
+        number of dimensions is determined from the file.
+
+        The index is returned unbuilt, so you'll need to call
+        :func:`~simpleneighbors.SimpleNeighbors.build` before querying it.
+
+        :param path: path to the text file
+        :param metric: the distance metric to use
+        :param backend: the nearest neighbors backend to use
+        :param limit: maximum number of items to read
+        :param chunk_size: number of lines to read at once
+        :param progress: function to call with the number of items added
+            after each chunk
+        :param on_disk: filename prefix for building the index on disk
+        :returns: a new (unbuilt) SimpleNeighbors object
+        """
+        from simpleneighbors.loaders import read_glove_text
+        return cls._from_chunks(
+                read_glove_text(path, chunk_size=chunk_size, limit=limit),
+                metric, backend, progress, on_disk)
+
+    @classmethod
+    def from_word2vec_binary(cls, path, metric="angular", backend=None,
+                             limit=None, chunk_size=10000, progress=None,
+                             on_disk=None):
+        """Creates an index from a file of vectors in word2vec binary format.
+
+        This method works like
+        :func:`~simpleneighbors.SimpleNeighbors.from_glove_text`, but reads the
+        binary format produced by the original word2vec tool (and by
+        ``save_word2vec_format(..., binary=True)`` in gensim); see
+        :func:`simpleneighbors.loaders.read_word2vec_binary`.
+
+        :param path: path to the binary file
+        :param metric: the distance metric to use
+        :param backend: the nearest neighbors backend to use
+        :param limit: maximum number of items to read
+        :param chunk_size: number of vectors to read at once
+        :param progress: function to call with the number of items added
+            after each chunk
+        :param on_disk: filename prefix for building the index on disk
+        :returns: a new (unbuilt) SimpleNeighbors object
+        """
+        from simpleneighbors.loaders import read_word2vec_binary
+        return cls._from_chunks(
+                read_word2vec_binary(
+                    path, chunk_size=chunk_size, limit=limit),
+                metric, backend, progress, on_disk)
+
+    @classmethod
+    def from_npy(cls, path, labels=None, metric="angular", backend=None,
+                 limit=None, chunk_size=10000, progress=None, on_disk=None):
+        """Creates an index from a 2D array saved with ``numpy.save()``.
+
+        The array is memory-mapped and added to the index a chunk of rows at a
+        time; see :func:`simpleneighbors.loaders.read_npy`. Items are taken
+        from ``labels`` (which must have one item per row), or if ``labels``
+        isn't given, each row's item is its index in the array.
+
+        :param path: path to the ``.npy`` file
+        :param labels: sequence of items, one per row
+        :param metric: the distance metric to use
+        :param backend: the nearest neighbors backend to use
+        :param limit: maximum number of items to read
+        :param chunk_size: number of rows to read at once
+        :param progress: function to call with the number of items added
+            after each chunk
+        :param on_disk: filename prefix for building the index on disk
+        :returns: a new (unbuilt) SimpleNeighbors object
+        """
+        from simpleneighbors.loaders import read_npy
+        return cls._from_chunks(
+                read_npy(path, labels, chunk_size=chunk_size, limit=limit),
+                metric, backend, progress, on_disk)
 
-    def build(self, n=10, params=None):
+    @timed('build')
+    def build(self, n=10, params=None, n_jobs=None):
         """Build the index.
 
         After adding all of your items, call this method to build the index.
@@ -112,16 +553,44 @@ class SimpleNeighbors:
         tree. (The Brute Force Pure Python backend ignores this value
         entirely.)
 
+        The ``n_jobs`` parameter sets the number of CPU cores the backend may
+        use to build the index, with ``-1`` meaning all of them. The Annoy
+        backend builds its trees in parallel (with Annoy 1.17 or later), and
+        the Sklearn backend passes the value on to ``NearestNeighbors``. By
+        default, the value given to the constructor is used (or, if none was
+        given, the backend's own default).
+
         After you call build, you'll no longer be able to add new items to the
-        index.
+        index (unless it's mutable; calling build again on a mutable index is
+        the same as calling :func:`~simpleneighbors.SimpleNeighbors.compact`).
 
         :param n: backend-dependent (for Annoy: number of trees)
         :param params: dictionary with extra parameters to pass to backend
+        :param n_jobs: number of cores to use (-1 for all)
         """
-        self.backend.build(n, params)
+        if self.mutable and self.built:
+            self.compact(n, params)
+            return
+        self.build_args = (n, params)
+        backend, corpus, id_map, metadata, metadata_index = self._state
+        if n_jobs is None:
+            backend.build(n, params)
+        else:
+            backend.build(n, params, n_jobs=n_jobs)
+        if self.mutable:
+            backend = Segmented(backend, self.i, self.dims, self.metric)
+        if isinstance(corpus, CorpusWriter):
+            corpus.close()
+            corpus = MappedCorpus(self.on_disk)
+            id_map = corpus.id_map
+        self._state = _IndexState(backend, corpus, id_map, metadata,
+                                  MetadataIndex(metadata))
+        if self.cache is not None:
+            self.cache.clear()
         self.built = True
 
-    def nearest(self, vec, n=12):
+    @timed('nearest')
+    def nearest(self, vec, n=12, search_k=None, oversample=None):
         """Returns the items nearest to a given vector.
 
         The specified vector must have the same number of dimensions as the
@@ -141,15 +610,44 @@ class SimpleNeighbors:
             >>> sim.nearest((1, -1), n=1)
             ['d']
 
+        With approximate backends, ``search_k`` sets how much effort goes into
+        the search: higher values find the true nearest neighbors more often,
+        but take longer. For Annoy, it's the number of nodes to inspect (the
+        default is ``n`` times the number of trees); exact backends ignore
+        it. If it isn't given, the index's ``search_k`` attribute is used, or
+        if that's ``None``, its ``search_effort`` (which the tuners in
+        :mod:`simpleneighbors.tuning` set).
+
+        If ``oversample`` is given, ``n * oversample`` candidates are fetched
+        from the backend, and their exact distances from the search vector
+        are computed (from the vectors stored in the index, in one
+        vectorized step) to choose the ``n`` results. This makes the results
+        of approximate backends nearly exact, for much less than the cost of
+        an exact search. (Re-ranking works with the ``angular``,
+        ``euclidean`` and ``manhattan`` metrics, and requires Numpy.)
+
         :param vec: search vector
         :param n: number of results to return
+        :param search_k: search effort (default: the index's ``search_k``)
+        :param oversample: re-rank this many candidates per result
         :returns: a list of items sorted in order of proximity
         """
 
-        return [self.corpus[idx] for idx
-                in self.backend.get_nns_by_vector(vec, n)]
-
-    def neighbors(self, item, n=12):
+        if self.cache is not None:
+            return [item for item, dist in self._cached(
+                ('vec', vector_digest(vec), n, self._search_k(search_k, n),
+                 oversample),
+                lambda: vec, n, search_k, oversample)]
+        state = self._state
+        if oversample is not None:
+            return [state.corpus[idx] for idx in self._search(
+                state.backend, vec, n, search_k, oversample)[0]]
+        return [state.corpus[idx] for idx
+                in state.backend.get_nns_by_vector(
+                    vec, n, search_k=self._search_k(search_k, n))]
+
+    @timed('neighbors')
+    def neighbors(self, item, n=12, search_k=None, oversample=None):
         """Returns the items nearest another item in the index.
 
         This method returns the items closest to a given item in the index in
@@ -171,13 +669,385 @@ class SimpleNeighbors:
 
         :param item: a data item in that has already been added to the index
         :param n: the number of items to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param oversample: re-rank this many candidates per result (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
         :returns: a list of items sorted in order of proximity
         """
 
-        return self.nearest(self.vec(item), n)
+        if self.cache is not None:
+            return [found for found, dist in self._cached(
+                ('item', item, n, self._search_k(search_k, n), oversample),
+                lambda: self.vec(item), n, search_k, oversample)]
+        return self.nearest(self.vec(item), n, search_k, oversample)
+
+    def _cached(self, key, get_vec, n, search_k, oversample=None):
+        """Returns cached ``(item, distance)`` results for ``key``, searching
+        with the vector returned by ``get_vec`` on a cache miss."""
+        hit, results = self.cache.get(key)
+        if not hit:
+            state = self._state
+            idxs, dists = self._search(state.backend, get_vec(), n, search_k,
+                                       oversample)
+            results = [(state.corpus[idx], dist)
+                       for idx, dist in zip(idxs, dists)]
+            self.cache.put(key, results)
+        return list(results)
+
+    def _search_k(self, search_k, count):
+        """Returns the ``search_k`` to pass to the backend for a search for
+        ``count`` results: ``search_k`` if it's given, otherwise the index's
+        ``search_k`` or, failing that, its ``search_effort`` (multiplied by
+        ``count`` for backends whose effort grows with the number of
+        results)."""
+        if search_k is None:
+            search_k = self.search_k
+        if search_k is not None or self.search_effort is None:
+            return search_k
+        if self._state.backend.search_k_per_result:
+            return int(math.ceil(self.search_effort * count))
+        return int(self.search_effort)
+
+    def _search(self, backend, vec, n, search_k, oversample=None):
+        """Returns the ids and distances of the items nearest ``vec`` in
+        ``backend``, re-ranking ``n * oversample`` candidates if
+        ``oversample`` is given."""
+        if oversample is None:
+            return backend.get_nns_by_vector(
+                    vec, n, include_distances=True,
+                    search_k=self._search_k(search_k, n))
+        fetch = int(n * oversample)
+        idxs, dists = backend.get_nns_by_vector(
+                vec, fetch, include_distances=True,
+                search_k=self._search_k(search_k, fetch))
+        return self._rerank(backend, vec, idxs, n)
+
+    def _rerank(self, backend, vec, idxs, n):
+        """Computes the exact distances from ``vec`` to the items ``idxs``
+        in ``backend`` and returns the ids and distances of the ``n``
+        nearest."""
+        import numpy as np
+        from simpleneighbors.backends.bruteforcenumpy import rerank
+        if not len(idxs):
+            return [], []
+        idxs, dists = rerank(self.metric, backend.get_item_vectors(idxs), vec,
+                             np.asarray(idxs), n)
+        return idxs.tolist(), dists.tolist()
+
+    def cache_info(self):
+        """Returns statistics about the query result cache.
+
+        The result is a dictionary with the number of cache ``hits`` and
+        ``misses`` so far, the current number of cached results (``size``),
+        and the ``maxsize`` and ``ttl`` the index was created with. If the
+        index has no cache, this method returns ``None``.
+
+        :returns: dictionary of cache statistics
+        """
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+    @timed('nearest_with_distances')
+    def nearest_with_distances(self, vec, n=12, search_k=None,
+                               oversample=None):
+        """Returns the items nearest to a given vector, with their distances.
+
+        This method works like
+        :func:`~simpleneighbors.SimpleNeighbors.nearest`, but each result is an
+        ``(item, distance)`` tuple. The distances come from the same backend
+        search that finds the items, so this is much faster than calling
+        :func:`~simpleneighbors.SimpleNeighbors.dist` on each result.
+
+        .. doctest::
 
-    def nearest_matching(self, vec, n=12, check=lambda x: True):
-        """nearest_matching(vec, n=12, check=lambda x: True)
+            >>> from simpleneighbors import SimpleNeighbors
+            >>> sim = SimpleNeighbors(2, 'euclidean')
+            >>> sim.feed([('a', (4, 5)),
+            ...     ('b', (0, 3)),
+            ...     ('c', (-2, 8)),
+            ...     ('d', (2, -2))])
+            >>> sim.build()
+            >>> sim.nearest_with_distances((5, 5), n=1)
+            [('a', 1.0)]
+
+        :param vec: search vector
+        :param n: number of results to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param oversample: re-rank this many candidates per result (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of ``(item, distance)`` tuples sorted in order of
+            proximity
+        """
+
+        if self.cache is not None:
+            return self._cached(
+                    ('vec', vector_digest(vec), n,
+                     self._search_k(search_k, n), oversample),
+                    lambda: vec, n, search_k, oversample)
+        state = self._state
+        idxs, dists = self._search(state.backend, vec, n, search_k,
+                                   oversample)
+        return [(state.corpus[idx], dist) for idx, dist in zip(idxs, dists)]
+
+    @timed('neighbors_with_distances')
+    def neighbors_with_distances(self, item, n=12, search_k=None,
+                                 oversample=None):
+        """Returns the items nearest another item, with their distances.
+
+        This method is just like
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_with_distances`, but
+        finds items nearest a given item already in the index, instead of an
+        arbitrary vector.
+
+        :param item: a data item in that has already been added to the index
+        :param n: the number of items to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param oversample: re-rank this many candidates per result (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of ``(item, distance)`` tuples sorted in order of
+            proximity
+        """
+
+        if self.cache is not None:
+            return self._cached(('item', item, n, self._search_k(search_k, n),
+                                 oversample),
+                                lambda: self.vec(item), n, search_k,
+                                oversample)
+        return self.nearest_with_distances(self.vec(item), n, search_k,
+                                           oversample)
+
+    @timed('nearest_many')
+    def nearest_many(self, vecs, n=12, search_k=None, oversample=None):
+        """Returns the items nearest to each of several vectors.
+
+        This method works like
+        :func:`~simpleneighbors.SimpleNeighbors.nearest` but answers a whole
+        batch of queries at once, which lets the backend amortize its per-query
+        overhead (e.g., the Sklearn backend performs a single search over all
+        of the vectors, and the Annoy backend spreads the queries across
+        threads).
+
+        .. doctest::
+
+            >>> from simpleneighbors import SimpleNeighbors
+            >>> sim = SimpleNeighbors(2, 'euclidean')
+            >>> sim.feed([('a', (4, 5)),
+            ...     ('b', (0, 3)),
+            ...     ('c', (-2, 8)),
+            ...     ('d', (2, -2))])
+            >>> sim.build()
+            >>> sim.nearest_many([(1, -1), (-1, 7)], n=1)
+            [['d'], ['c']]
+
+        :param vecs: a sequence of search vectors
+        :param n: number of results to return for each vector
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param oversample: re-rank this many candidates per result (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list with one list of items (sorted in order of proximity)
+            per search vector
+        """
+
+        vecs = list(vecs)
+        backend, corpus = self._state[:2]
+        if oversample is not None:
+            fetch = int(n * oversample)
+            found = backend.get_nns_by_vectors(
+                    vecs, fetch, include_distances=True,
+                    search_k=self._search_k(search_k, fetch))
+            return [[corpus[idx]
+                     for idx in self._rerank(backend, vec, idxs, n)[0]]
+                    for vec, (idxs, dists) in zip(vecs, found)]
+        return [[corpus[idx] for idx in row] for row
+                in backend.get_nns_by_vectors(
+                    vecs, n, search_k=self._search_k(search_k, n))]
+
+    @timed('nearest_many_with_distances')
+    def nearest_many_with_distances(self, vecs, n=12, search_k=None,
+                                    oversample=None):
+        """Returns the items nearest to each of several vectors, with their
+        distances.
+
+        This is the batched counterpart of
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_with_distances`.
+
+        .. doctest::
+
+            >>> from simpleneighbors import SimpleNeighbors
+            >>> sim = SimpleNeighbors(2, 'euclidean')
+            >>> sim.feed([('a', (4, 5)),
+            ...     ('b', (0, 3)),
+            ...     ('c', (-2, 8)),
+            ...     ('d', (2, -2))])
+            >>> sim.build()
+            >>> sim.nearest_many_with_distances([(5, 5), (0, 4)], n=1)
+            [[('a', 1.0)], [('b', 1.0)]]
+
+        :param vecs: a sequence of search vectors
+        :param n: number of results to return for each vector
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param oversample: re-rank this many candidates per result (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list with one list of ``(item, distance)`` tuples (sorted
+            in order of proximity) per search vector
+        """
+
+        vecs = list(vecs)
+        backend, corpus = self._state[:2]
+        fetch = n if oversample is None else int(n * oversample)
+        found = backend.get_nns_by_vectors(
+                vecs, fetch, include_distances=True,
+                search_k=self._search_k(search_k, fetch))
+        if oversample is not None:
+            found = [self._rerank(backend, vec, idxs, n)
+                     for vec, (idxs, dists) in zip(vecs, found)]
+        return [[(corpus[idx], dist) for idx, dist in zip(idxs, dists)]
+                for idxs, dists in found]
+
+    @timed('neighbors_many')
+    def neighbors_many(self, items, n=12, search_k=None, oversample=None):
+        """Returns the items nearest each of several items in the index.
+
+        This is the batched counterpart of
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors`.
+
+        :param items: a sequence of data items already added to the index
+        :param n: the number of items to return for each item
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param oversample: re-rank this many candidates per result (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list with one list of items (sorted in order of proximity)
+            per item
+        """
+
+        return self.nearest_many([self.vec(item) for item in items], n,
+                                 search_k, oversample)
+
+    @timed('all_neighbors')
+    def all_neighbors(self, n=12, path=None, workers=1, block_size=10000,
+                      resume=False, search_k=None):
+        """Finds the nearest neighbors of every item in the index.
+
+        This gives the same results as calling
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors` for each item
+        (including the item itself), but searches for blocks of
+        ``block_size`` items at a time, in ``workers`` processes, and writes
+        each block's results to disk as soon as it's done. The results are
+        two Numpy arrays with one row per item id (the item with id ``i`` is
+        ``corpus[i]``): ``<path>-ids.npy``, the int32 ids of each item's
+        neighbors, and ``<path>-dists.npy``, their float32 distances. Rows
+        with fewer than ``n`` neighbors (and the rows of deleted items) are
+        padded with ids of -1 and infinite distances.
+
+        Finished blocks are recorded in ``<path>-done.npy``; with
+        ``resume=True``, a run that was interrupted picks up where it left
+        off (given the same ``n`` and ``block_size``).
+
+        .. doctest::
+
+            >>> from simpleneighbors import SimpleNeighbors
+            >>> sim = SimpleNeighbors(2, 'euclidean')
+            >>> sim.feed([('a', (4, 5)),
+            ...     ('b', (0, 3)),
+            ...     ('c', (-2, 8)),
+            ...     ('d', (2, -2))])
+            >>> sim.build()
+            >>> ids, dists = sim.all_neighbors(n=2)
+            >>> [[sim.corpus[idx] for idx in row] for row in ids.tolist()]
+            [['a', 'b'], ['b', 'a'], ['c', 'b'], ['d', 'b']]
+
+        With more than one worker, the index is saved to a temporary
+        directory (in the compact format) for the workers to load.
+
+        :param n: the number of neighbors to find for each item
+        :param path: filename prefix for the output arrays (default: a
+            temporary file, and the arrays are read into memory)
+        :param workers: number of processes to search in (-1 for one per
+            core; 1 searches in this process)
+        :param block_size: number of items to search for at a time
+        :param resume: skip blocks finished by an earlier run with the same
+            ``path``
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a tuple of the ids and distances arrays (memory-mapped,
+            if ``path`` was given)
+        """
+        import numpy as np
+        from numpy.lib.format import open_memmap
+        assert self.built, "Index must be built before searching it."
+        search_k = self._search_k(search_k, n)
+        if workers is None or workers < 1:
+            workers = cpu_count()
+        count = len(self.corpus)
+        blocks = (count + block_size - 1) // block_size
+        tmpdir = None
+        if path is None:
+            tmpdir = tempfile.mkdtemp()
+            path = os.path.join(tmpdir, 'neighbors')
+        try:
+            done_fname = path + "-done.npy"
+            if resume and os.path.exists(done_fname):
+                done = open_memmap(done_fname, mode='r+')
+                shape = np.load(path + "-ids.npy", mmap_mode='r').shape
+                if done.shape != (blocks,) or shape != (count, n):
+                    raise ValueError(
+                        "%s was written with different parameters" % path)
+            else:
+                for suffix, dtype in (("-ids.npy", np.int32),
+                                      ("-dists.npy", np.float32)):
+                    open_memmap(path + suffix, mode='w+', dtype=dtype,
+                                shape=(count, n)).flush()
+                done = open_memmap(done_fname, mode='w+', dtype=np.uint8,
+                                   shape=(blocks,))
+            jobs = [(block, path, block * block_size,
+                     min((block + 1) * block_size, count), n, search_k)
+                    for block in range(blocks) if not done[block]]
+            if workers == 1 or len(jobs) < 2:
+                for job in jobs:
+                    _knn_block(self, *job[1:])
+                    done[job[0]] = 1
+                    done.flush()
+            else:
+                self._all_neighbors_pool(jobs, workers, done)
+            del done
+            if tmpdir is not None:
+                return (np.load(path + "-ids.npy"),
+                        np.load(path + "-dists.npy"))
+            return (np.load(path + "-ids.npy", mmap_mode='r'),
+                    np.load(path + "-dists.npy", mmap_mode='r'))
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _all_neighbors_pool(self, jobs, workers, done):
+        """Runs ``all_neighbors()`` jobs in a pool of worker processes,
+        marking each block in ``done`` as it finishes."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(tmpdir, 'index')
+            self.save(prefix, compact=True)
+            pool = Pool(min(workers, len(jobs)), _knn_worker_init, (prefix,))
+            try:
+                for block in pool.imap_unordered(_knn_worker_block, jobs):
+                    done[block] = 1
+                    done.flush()
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def nearest_matching(self, vec, n=12, check=lambda x: True, where=None,
+                         search_k=None):
+        """nearest_matching(vec, n=12, check=lambda x: True, where=None, \
+search_k=None)
         Returns the items nearest a given vector that pass a test.
 
         This method looks for the items in the index nearest the given vector
@@ -189,6 +1059,21 @@ class SimpleNeighbors:
         parameter: the item in question. It should return ``True`` if the item
         should be included in the results, and ``False`` otherwise.
 
+        If the items were added with metadata, you can also (or instead) pass
+        a filter as ``where``: a dictionary mapping metadata attributes to the
+        values they must have, e.g. ``{'lang': 'en'}``. (See
+        :mod:`simpleneighbors.metadata` for the other kinds of conditions.)
+        Filters are much faster than equivalent ``check`` functions: they're
+        evaluated using an index built by
+        :func:`~simpleneighbors.SimpleNeighbors.build`, and backends that
+        support it (the brute-force backends) only search the matching items
+        in the first place.
+
+        The search is performed in rounds. Each round asks the backend for
+        more candidates than the last, sized using the fraction of candidates
+        that have passed ``check`` so far, and ``check`` is only called on
+        candidates that weren't seen in earlier rounds.
+
         This search process might be slow; in order to make it easier to
         display incremental results, this method returns a generator. You can
         easily get the results of this method as a list by enclosing your call
@@ -210,24 +1095,130 @@ class SimpleNeighbors:
         :param vec: search vector
         :param n: number of items to return
         :param check: function to call on each item
+        :param where: dictionary of metadata conditions
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
         :returns: a generator yielding up to ``n`` items
         """
 
+        if check is None:
+            check = lambda x: True  # noqa: E731
+        if self.hooks is not None:
+            return self._timed_matching('nearest_matching', vec, n, check,
+                                        where, search_k)
+        return self._matching(vec, n, check, where, search_k)
+
+    def nearest_matching_with_distances(self, vec, n=12,
+                                        check=lambda x: True, where=None,
+                                        search_k=None):
+        """nearest_matching_with_distances(vec, n=12, check=lambda x: True, \
+where=None, search_k=None)
+        Returns the items nearest a given vector that pass a test, with their
+        distances.
+
+        This method is just like
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_matching`, but yields
+        ``(item, distance)`` tuples.
+
+        :param vec: search vector
+        :param n: number of items to return
+        :param check: function to call on each item
+        :param where: dictionary of metadata conditions
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a generator yielding up to ``n`` ``(item, distance)``
+            tuples
+        """
+
+        if check is None:
+            check = lambda x: True  # noqa: E731
+        if self.hooks is not None:
+            return self._timed_matching('nearest_matching_with_distances',
+                                        vec, n, check, where, search_k,
+                                        with_distances=True)
+        return self._matching(vec, n, check, where, search_k,
+                              with_distances=True)
+
+    def _timed_matching(self, op, vec, n, check, where, search_k,
+                        with_distances=False):
+        """Runs a filtered search, reporting the time spent in it (not
+        counting time spent by the caller between results) to the hooks as
+        ``op``."""
+        counts = {'results': 0}
+        elapsed = 0.0
+        results = self._matching(vec, n, check, where, search_k, counts,
+                                 with_distances)
+        try:
+            while True:
+                start = timer()
+                try:
+                    item = next(results)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += timer() - start
+                counts['results'] += 1
+                yield item
+        finally:
+            self._record(op, elapsed, counts)
+
+    def _matching(self, vec, n, check, where, search_k, counts=None,
+                  with_distances=False):
+        """Does the work of
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_matching`, counting
+        and timing backend searches and predicate calls in ``counts`` if
+        it's given. With ``with_distances``, yields ``(item, distance)``
+        pairs."""
+        state = self._state
+        search = state.backend.get_nns_by_vector
+        total = len(state.corpus)
+        allowed = None
+        if where:
+            ids = state.metadata_index.select(where)
+            if state.backend.supports_id_filter:
+                search = partial(state.backend.get_nns_by_vector_in, ids=ids)
+                total = len(ids)
+            else:
+                allowed = set(ids)
+        if counts is not None:
+            search = counting(search, counts, 'backend')
+            check = counting(check, counts, 'check')
+        seen = set()
         found = set()
-        current_n = n
-        while True:
-            for item in self.nearest(vec, current_n):
-                if item not in found and check(item):
-                    yield item
+        checked = 0
+        fetch = min(n, total)
+        while len(found) < n and fetch > 0:
+            # the search effort grows with the number of candidates fetched
+            effort = self._search_k(search_k, fetch)
+            idxs, dists = search(vec, fetch, include_distances=True,
+                                 search_k=effort)
+            fresh = [(idx, dist) for idx, dist in zip(idxs, dists)
+                     if idx not in seen]
+            seen.update(idx for idx, dist in fresh)
+            if allowed is not None:
+                checked += len(fresh)
+                fresh = [(idx, dist) for idx, dist in fresh
+                         if idx in allowed]
+            for idx, dist in fresh:
+                item = state.corpus[idx]
+                if item in found:
+                    continue
+                if allowed is None:
+                    checked += 1
+                if check(item):
+                    yield (item, dist) if with_distances else item
                     found.add(item)
-                if len(found) == n:
-                    break
-            if len(found) == n or current_n >= len(self.corpus):
-                break
-            else:
-                current_n *= 2
-
-    def neighbors_matching(self, item, n=12, check=None):
+                    if len(found) == n:
+                        return
+            # (an approximate search with a limited effort can come up short
+            # before the whole index has been searched)
+            if fetch >= total or (len(idxs) < fetch and effort is None):
+                return
+            fetch = min(total, _next_fetch(
+                fetch, len(seen), checked, len(found), n - len(found)))
+
+    def neighbors_matching(self, item, n=12, check=None, where=None,
+                           search_k=None):
         """Returns the items nearest an indexed item that pass a test.
 
         This method is just like
@@ -238,12 +1229,17 @@ class SimpleNeighbors:
         :param item: search item
         :param n: number of items to return
         :param check: function to call on each item
+        :param where: dictionary of metadata conditions
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
         :returns: a generator yielding up to ``n`` items
         """
 
-        for item in self.nearest_matching(self.vec(item), n, check):
+        for item in self.nearest_matching(self.vec(item), n, check, where,
+                                          search_k):
             yield item
 
+    @timed('dist')
     def dist(self, a, b):
         """Returns the distance between two items.
 
@@ -251,8 +1247,10 @@ class SimpleNeighbors:
         :param b: second item
         :returns: distance between ``a`` and ``b``
         """
-        return self.backend.get_distance(self.id_map[a], self.id_map[b])
+        backend, corpus, id_map = self._state[:3]
+        return backend.get_distance(id_map[a], id_map[b])
 
+    @timed('vec')
     def vec(self, item):
         """Returns the vector for an item.
 
@@ -264,13 +1262,115 @@ class SimpleNeighbors:
         :param item: item to lookup
         :returns: vector for item
         """
-        return self.backend.get_item_vector(self.id_map[item])
+        state = self._state
+        return state.backend.get_item_vector(state.id_map[item])
+
+    @timed('delete')
+    def delete(self, item):
+        """Removes an item from a built, mutable index.
+
+        The item is removed from search results immediately; the space it
+        occupies is reclaimed the next time the index is compacted (see
+        :func:`~simpleneighbors.SimpleNeighbors.compact`).
+
+        :param item: the item to remove
+        :returns: None
+        """
+        assert self.mutable and self.built, \
+            "Items can only be deleted from built, mutable indexes."
+        with self.lock:
+            state = self._state
+            state.backend.delete(state.id_map.pop(item))
+            if self.cache is not None:
+                self.cache.clear()
+
+    @timed('compact')
+    def compact(self, n=None, params=None, background=False):
+        """Rebuilds a mutable index, folding in additions and deletions.
+
+        This method builds a new main index from all of the items currently
+        in the index (using the same backend, and by default the same ``n``
+        and ``params`` as the last call to
+        :func:`~simpleneighbors.SimpleNeighbors.build`), then swaps it in,
+        leaving an empty delta segment and no deleted items. Items can still
+        be queried, added and deleted while the new index is being built;
+        changes made in the meantime are carried over to the new index.
+
+        If ``background`` is ``True``, the new index is built in a separate
+        thread, and this method returns the ``threading.Thread`` object
+        immediately (call its ``join()`` method to wait for it to finish).
+        Compactions don't overlap: one that's started while another is
+        running waits for it to finish, then rebuilds from its result.
+
+        :param n: backend-dependent (see
+            :func:`~simpleneighbors.SimpleNeighbors.build`)
+        :param params: dictionary with extra parameters to pass to backend
+        :param background: build the new index in a background thread
+        :returns: None, or the background thread
+        """
+        assert self.mutable and self.built, \
+            "Only built, mutable indexes can be compacted."
+        if background:
+            thread = threading.Thread(target=self.compact,
+                                      kwargs={'n': n, 'params': params})
+            thread.daemon = True
+            thread.start()
+            return thread
+        with self.compact_lock:
+            self._compact(n, params)
+
+    def _compact(self, n, params):
+        if n is None:
+            n, params = self.build_args
+        with self.lock:
+            old = self._state.backend
+            snapshot = self.i
+            deleted = set(old.deleted)
+        live = [idx for idx in range(snapshot) if idx not in deleted]
+        main = old.main.__class__(self.dims, metric=self.metric)
+        main.n_jobs = old.main.n_jobs
+        # copy the vectors a block at a time, to bound the memory needed
+        for start in range(0, len(live), 10000):
+            block = live[start:start + 10000]
+            main.add_items(start, old.get_item_vectors(block))
+        main.build(n, params)
+        with self.lock:
+            state = self._state
+            segmented = Segmented(main, len(live), self.dims, self.metric)
+            remap = dict((idx, new_idx) for new_idx, idx in enumerate(live))
+            corpus = [state.corpus[idx] for idx in live]
+            # carry over items added while the new index was being built
+            added = list(range(snapshot, self.i))
+            if added:
+                segmented.add_items(len(corpus), old.get_item_vectors(added))
+            for idx in added:
+                remap[idx] = len(corpus)
+                corpus.append(state.corpus[idx])
+            # ...and items deleted in the meantime
+            for idx in old.deleted - deleted:
+                if idx in remap:
+                    segmented.delete(remap[idx])
+            metadata = dict((remap[idx], meta)
+                            for idx, meta in state.metadata.items()
+                            if idx in remap)
+            id_map = dict((item, remap[idx])
+                          for item, idx in state.id_map.items())
+            # queries in other threads see either the old state or the new
+            # one, never a mixture
+            self._state = _IndexState(segmented, corpus, id_map, metadata,
+                                      MetadataIndex(metadata))
+            self.i = len(corpus)
+            self.build_args = (n, params)
+            if self.cache is not None:
+                self.cache.clear()
 
     def __len__(self):
         """Returns the number of items in the vector"""
-        return len(self.corpus)
+        backend, corpus = self._state[:2]
+        return len(corpus) - len(getattr(backend, 'deleted', ()))
 
-    def save(self, prefix):
+    @timed('save')
+    def save(self, prefix, compact=False):
         """Saves the index to disk.
 
         This method saves the index to disk. Each backend manages serialization
@@ -282,44 +1382,118 @@ class SimpleNeighbors:
 
         This method's parameter specifies the "prefix" to use for these files.
 
+        By default, the items in the index are pickled along with the other
+        object data, and the whole lot is read back into memory by
+        :func:`~simpleneighbors.SimpleNeighbors.load`. If you set ``compact``
+        to ``True``, the items will instead be stored in a compact format that
+        is memory-mapped when the index is loaded (see
+        :mod:`simpleneighbors.corpus`), which makes loading large indexes much
+        faster and lets multiple processes share the same memory. (The compact
+        format requires Numpy.) Indexes built with the ``on_disk`` parameter
+        are always saved in the compact format.
+
         :param prefix: filename prefix for Annoy index and object data
+        :param compact: save items in the compact, memory-mappable format
         :returns: None
         """
 
-        import pickle
+        backend, corpus, id_map, metadata = self._state[:4]
+        data = {
+            'i': self.i,
+            'built': self.built,
+            'metric': self.metric,
+            'dims': self.dims,
+            'metadata': metadata,
+            'mutable': self.mutable,
+            'build_args': self.build_args,
+            'search_k': self.search_k,
+            'search_effort': self.search_effort,
+            '_backend_class': backend.__class__
+        }
+        if isinstance(backend, Segmented):
+            data['_backend_class'] = backend.main.__class__
+            data['segments'] = {
+                'main_count': backend.main_count,
+                'delta_count': backend.delta_count,
+                'deleted': backend.deleted,
+                '_delta_class': backend.delta.__class__,
+            }
+        if compact or self.on_disk is not None:
+            data['format'] = 'compact'
+            if not isinstance(corpus, MappedCorpus):
+                write_corpus(prefix, corpus)
+            elif corpus.prefix != prefix:
+                corpus.copy_to(prefix)
+        else:
+            if isinstance(corpus, MappedCorpus):
+                data['id_map'] = dict(
+                    (item, idx) for idx, item in enumerate(corpus))
+            else:
+                data['id_map'] = id_map
+            data['corpus'] = list(corpus)
         with open(prefix + "-data.pkl", "wb") as fh:
-            pickle.dump({
-                'id_map': self.id_map,
-                'corpus': self.corpus,
-                'i': self.i,
-                'built': self.built,
-                'metric': self.metric,
-                'dims': self.dims,
-                '_backend_class': self.backend.__class__
-            }, fh)
-        self.backend.save(prefix + ".idx")
+            pickle.dump(data, fh)
+        backend.save(prefix + ".idx")
 
     @classmethod
-    def load(cls, prefix):
+    def load(cls, prefix, n_jobs=None, collect_stats=False, hooks=()):
         """Restores a previously-saved index.
 
         This class method restores a previously-saved index using the specified
-        file prefix.
+        file prefix. (Indexes saved with ``compact=True`` are memory-mapped,
+        rather than read into memory.)
 
         :param prefix: prefix used when saving
+        :param n_jobs: number of cores the backend may use (-1 for all)
+        :param collect_stats: keep statistics about each operation
+        :param hooks: functions to call after each operation (see
+            :func:`~simpleneighbors.SimpleNeighbors.add_hook`); they're
+            called for the load itself, too
         :returns: SimpleNeighbors object restored from specified files
         """
 
+        start = timer()
         with open(prefix + "-data.pkl", "rb") as fh:
             data = pickle.load(fh)
         newobj = cls(
             dims=data['dims'],
             metric=data['metric'],
-            backend=data['_backend_class']
+            backend=data['_backend_class'],
+            n_jobs=n_jobs,
+            collect_stats=collect_stats
         )
-        newobj.id_map = data['id_map']
-        newobj.corpus = data['corpus']
+        for hook in hooks:
+            newobj.add_hook(hook)
+        if data.get('format') == 'compact':
+            corpus = MappedCorpus(prefix)
+            id_map = corpus.id_map
+        else:
+            id_map = data['id_map']
+            corpus = data['corpus']
         newobj.i = data['i']
         newobj.built = data['built']
-        newobj.backend.load(prefix + ".idx")
+        metadata = data.get('metadata', {})
+        newobj.mutable = data.get('mutable', False)
+        newobj.build_args = data.get('build_args', (10, None))
+        newobj.search_k = data.get('search_k')
+        newobj.search_effort = data.get('search_effort')
+        backend = newobj.backend
+        segments = data.get('segments')
+        if segments is not None:
+            backend = Segmented(
+                    backend, segments['main_count'], newobj.dims,
+                    newobj.metric, segments['_delta_class'])
+            backend.delta_count = segments['delta_count']
+            backend.deleted = segments['deleted']
+        if newobj.mutable and isinstance(corpus, MappedCorpus):
+            # mutable indexes need a corpus that can be appended to
+            corpus = list(corpus)
+            id_map = dict(
+                (item, idx) for idx, item in enumerate(corpus)
+                if idx not in getattr(backend, 'deleted', ()))
+        backend.load(prefix + ".idx")
+        newobj._state = _IndexState(backend, corpus, id_map, metadata,
+                                    MetadataIndex(metadata))
+        if newobj.hooks is not None:
+            newobj._record('load', timer() - start, {})
         return newobj
@@ -0,0 +1,150 @@
+"""Querying an index from asyncio code.
+
+Searching an index blocks the thread that does it, which in an asyncio
+application means blocking the event loop. :class:`AsyncSimpleNeighbors`
+wraps a built :class:`~simpleneighbors.SimpleNeighbors` object and runs its
+searches in an executor instead. Queries that arrive within a short window of
+each other are combined into a single call to
+:func:`~simpleneighbors.SimpleNeighbors.nearest_many`, so that under load the
+backend answers a few large batches rather than many single queries.
+
+This module requires Python 3.5 or later.
+"""
+
+import asyncio
+
+
+class AsyncSimpleNeighbors:
+    """Asynchronous, batching query interface to a built index.
+
+    Calls to :meth:`anearest` and :meth:`aneighbors` with the same ``n`` (and
+    ``search_k``) are collected for ``window`` seconds (or until ``max_batch``
+    of them have been collected) and then answered with one call to the
+    index's ``nearest_many`` method, run in ``executor`` (the event loop's
+    default executor if not given). If a batch fails (e.g., because one of
+    its vectors has the wrong number of dimensions), each of its queries is
+    retried on its own, so that the error is raised only to the caller that
+    caused it.
+
+    .. doctest::
+
+        >>> import asyncio
+        >>> from simpleneighbors import SimpleNeighbors
+        >>> from simpleneighbors.aio import AsyncSimpleNeighbors
+        >>> sim = SimpleNeighbors(2, 'euclidean')
+        >>> sim.feed([('a', (4, 5)),
+        ...     ('b', (0, 3)),
+        ...     ('c', (-2, 8)),
+        ...     ('d', (2, -2))])
+        >>> sim.build()
+        >>> asim = AsyncSimpleNeighbors(sim)
+        >>> async def search():
+        ...     return await asyncio.gather(asim.anearest((1, -1), n=1),
+        ...                                 asim.aneighbors('c', n=2))
+        >>> loop = asyncio.new_event_loop()
+        >>> loop.run_until_complete(search())
+        [['d'], ['c', 'b']]
+        >>> loop.close()
+
+    :param sim: a built :class:`~simpleneighbors.SimpleNeighbors` object (or
+        anything else with the same query methods)
+    :param executor: a ``concurrent.futures`` executor to run searches in
+    :param window: seconds to wait for more queries before searching
+    :param max_batch: maximum number of queries to search at once
+    """
+
+    def __init__(self, sim, executor=None, window=0.001, max_batch=256):
+        self.sim = sim
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}
+        self.timers = {}
+
+    async def anearest(self, vec, n=12, search_k=None):
+        """Returns the items nearest to a given vector (see
+        :func:`~simpleneighbors.SimpleNeighbors.nearest`).
+
+        :param vec: search vector
+        :param n: number of results to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of items sorted in order of proximity
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        key = (n, search_k)
+        batch = self.pending.setdefault(key, [])
+        batch.append((vec, future))
+        if len(batch) >= self.max_batch:
+            self._flush(loop, key)
+        elif len(batch) == 1:
+            self.timers[key] = loop.call_later(
+                    self.window, self._flush, loop, key)
+        return await future
+
+    async def aneighbors(self, item, n=12, search_k=None):
+        """Returns the items nearest another item in the index (see
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors`).
+
+        :param item: a data item that has already been added to the index
+        :param n: the number of items to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of items sorted in order of proximity
+        """
+        return await self.anearest(self.sim.vec(item), n, search_k)
+
+    async def arun(self, fn, *args):
+        """Calls any function (e.g., another method of the index) in the
+        executor, without batching.
+
+        :param fn: the function to call
+        :param args: arguments to pass to the function
+        :returns: the function's return value
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def _flush(self, loop, key):
+        """Starts searching for the queries collected for ``key``, an
+        ``(n, search_k)`` tuple."""
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if not batch:
+            return
+        vecs = [vec for vec, future in batch]
+        futures = [future for vec, future in batch]
+        done = loop.run_in_executor(
+                self.executor, self.sim.nearest_many, vecs, *key)
+        done.add_done_callback(
+                lambda done: self._dispatch(loop, vecs, futures, key, done))
+
+    def _dispatch(self, loop, vecs, futures, key, done):
+        """Hands the results of a batch to the waiting callers."""
+        if done.cancelled() or done.exception() is not None:
+            if len(futures) == 1:
+                self._resolve(futures[0], done)
+                return
+            for vec, future in zip(vecs, futures):
+                single = loop.run_in_executor(
+                        self.executor, self.sim.nearest, vec, *key)
+                single.add_done_callback(
+                        lambda single, future=future: self._resolve(
+                            future, single))
+            return
+        for future, results in zip(futures, done.result()):
+            if not future.done():
+                future.set_result(results)
+
+    def _resolve(self, future, done):
+        if future.done():
+            return
+        if done.cancelled():
+            future.cancel()
+        elif done.exception() is not None:
+            future.set_exception(done.exception())
+        else:
+            future.set_result(done.result())
@@ -1,7 +1,11 @@
 import warnings
 
 from .annoy_ import Annoy
+from .bruteforcenumpy import BruteForceNumpy
 from .bruteforcepurepython import BruteForcePurePython
+from .hnsw import HNSW  # noqa: F401
+from .ivf import IVF
+from .quantized import Quantized
 from .sklearn_ import Sklearn
 
 brute_force_message = """
@@ -13,12 +17,21 @@ other (faster and better) backends.
 
 It is HIGHLY RECOMMENDED that you install Annoy (pip install annoy) or
 scikit-learn (pip install scikit-learn). Doing so will make the corresponding
-backends available to you and will improve performance dramatically.
+backends available to you and will improve performance dramatically. (Even
+installing Numpy alone will enable the much faster BruteForceNumpy backend.)
 """
 
 
-def select_best():
-    for b in (Annoy, Sklearn):
+def select_best(compressed=False):
+    """Returns the best backend available.
+
+    :param compressed: prefer a backend that stores vectors compressed
+        (:class:`Quantized`), for indexes too big to keep in memory at full
+        precision
+    """
+    if compressed and Quantized.available():
+        return Quantized
+    for b in (Annoy, Sklearn, BruteForceNumpy):
         if b.available():
             return b
     warnings.warn(brute_force_message)
@@ -26,4 +39,8 @@ def select_best():
 
 
 def available():
-    return [Annoy, Sklearn, BruteForcePurePython]
+    # HNSW is left out: building it takes time proportional to the square
+    # of the number of items, which would make the default grids of tune()
+    # and benchmark() very slow (pass it to them explicitly instead)
+    return [Annoy, Sklearn, IVF, BruteForceNumpy, Quantized,
+            BruteForcePurePython]
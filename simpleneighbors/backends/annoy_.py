@@ -1,8 +1,18 @@
 from simpleneighbors.backends.base import BaseBackend
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import shutil
+import threading
+
+# batches smaller than this are searched sequentially: below it, handing the
+# queries to worker threads costs more than searching them in parallel saves
+PARALLEL_MIN_BATCH = 64
 
 
 class Annoy(BaseBackend):
 
+    search_k_per_result = True
+
     @classmethod
     def available(cls):
         try:
@@ -11,18 +21,89 @@ class Annoy(BaseBackend):
             return False
         return True
 
+    @classmethod
+    def tuning_grid(cls, n, build_ns):
+        # Annoy's default search_k is n * the number of trees
+        return [(trees, [None] + [n * trees * factor
+                                  for factor in (2, 4, 8, 16)])
+                for trees in build_ns]
+
     def __init__(self, dims, metric):
         import annoy
         self.annoy = annoy.AnnoyIndex(dims, metric=metric)
+        self.on_disk_fname = None
+        self.pool = None
+        self.pool_lock = threading.Lock()
 
     def add_item(self, idx, vector):
         self.annoy.add_item(idx, vector)
 
-    def build(self, n, params=None):
-        self.annoy.build(n)
+    def on_disk_build(self, fname):
+        self.annoy.on_disk_build(fname)
+        self.on_disk_fname = fname
+
+    def build(self, n, params=None, n_jobs=None):
+        if n_jobs is None:
+            n_jobs = -1 if self.n_jobs is None else self.n_jobs
+        try:
+            self.annoy.build(n, n_jobs=n_jobs)
+        except TypeError:
+            # Annoy < 1.17 doesn't support parallel builds
+            self.annoy.build(n)
+
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self.annoy.get_nns_by_vector(
+                vec, n, search_k=-1 if search_k is None else search_k,
+                include_distances=include_distances)
 
-    def get_nns_by_vector(self, vec, n):
-        return self.annoy.get_nns_by_vector(vec, n)
+    def _threads(self):
+        """Returns the number of threads to spread batched queries over."""
+        if self.n_jobs is not None and self.n_jobs > 0:
+            return self.n_jobs
+        return cpu_count()
+
+    def _pool(self, threads):
+        """Returns this backend's thread pool, which is created on first use
+        and kept for later batches (and recreated if ``n_jobs`` changes)."""
+        with self.pool_lock:
+            if self.pool is None or self.pool_size != threads:
+                self.close()
+                self.pool = ThreadPool(threads)
+                self.pool_size = threads
+            return self.pool
+
+    def close(self):
+        """Shuts down the thread pool used for batched queries, if any."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def get_nns_by_vectors(self, vecs, n, include_distances=False,
+                           search_k=None):
+        vecs = list(vecs)
+        threads = self._threads()
+        if len(vecs) < PARALLEL_MIN_BATCH or threads == 1:
+            return [self.get_nns_by_vector(vec, n, include_distances,
+                                           search_k)
+                    for vec in vecs]
+        # Annoy releases the GIL while searching, so the queries run in
+        # parallel; each thread gets a contiguous slice of the batch, so
+        # there's one hand-off per thread rather than one per query
+        size = (len(vecs) + threads - 1) // threads
+        slices = [vecs[start:start + size]
+                  for start in range(0, len(vecs), size)]
+        results = self._pool(threads).map(
+            lambda batch: [self.get_nns_by_vector(
+                vec, n, include_distances, search_k) for vec in batch],
+            slices)
+        return [found for batch in results for found in batch]
 
     def get_distance(self, a_idx, b_idx):
         return self.annoy.get_distance(a_idx, b_idx)
@@ -34,8 +115,14 @@ class Annoy(BaseBackend):
         """
         Saves the Annoy index as ``<prefix>.annoy`` and the object data will be
         saved as ``<prefix>-data.pkl``.
+
+        An index built on disk is already saved in its on-disk file, which is
+        copied if ``fname`` is a different file.
         """
-        self.annoy.save(fname)
+        if self.on_disk_fname is None:
+            self.annoy.save(fname)
+        elif fname != self.on_disk_fname:
+            shutil.copyfile(self.on_disk_fname, fname)
 
     def load(self, fname):
         self.annoy.load(fname)
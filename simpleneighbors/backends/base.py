@@ -1,19 +1,59 @@
 class BaseBackend:
 
+    # whether get_nns_by_vector_in() can restrict a search to given item ids
+    supports_id_filter = False
+
+    # whether search_k counts something (like nodes or candidates to
+    # inspect) that should grow in proportion to the number of results; the
+    # search_effort set by tuners is then multiplied by the number of results
+    # to get each search's search_k
+    search_k_per_result = False
+
+    # number of cores the backend may use to build the index and answer
+    # batched queries (-1 for all of them); None leaves it up to the backend
+    n_jobs = None
+
     @classmethod
     def available(cls):
         return False
 
+    @classmethod
+    def tuning_grid(cls, n, build_ns):
+        """Returns the settings worth trying when tuning this backend to
+        return ``n`` results, as a list of ``(build n, [search_k values])``
+        pairs, given candidate values for ``build()``'s ``n``."""
+        return [(build_n, [None]) for build_n in build_ns]
+
     def __init__(self, dims, metric):
         raise NotImplementedError
 
     def add_item(self, idx, vector):
         raise NotImplementedError
 
-    def build(self, n, params=None):
+    def add_items(self, start_idx, vectors):
+        for i, vector in enumerate(vectors):
+            self.add_item(start_idx + i, vector)
+
+    def on_disk_build(self, fname):
+        raise NotImplementedError
+
+    def build(self, n, params=None, n_jobs=None):
+        raise NotImplementedError
+
+    # search_k is the search effort for approximate backends (for Annoy, the
+    # number of nodes to inspect); None means the backend's default, and
+    # exact backends ignore it
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
         raise NotImplementedError
 
-    def get_nns_by_vector(self, vec, n):
+    def get_nns_by_vectors(self, vecs, n, include_distances=False,
+                           search_k=None):
+        return [self.get_nns_by_vector(vec, n, include_distances, search_k)
+                for vec in vecs]
+
+    def get_nns_by_vector_in(self, vec, n, ids, include_distances=False,
+                             search_k=None):
         raise NotImplementedError
 
     def get_distance(self, a_idx, b_idx):
@@ -22,6 +62,17 @@ class BaseBackend:
     def get_item_vector(self, idx):
         raise NotImplementedError
 
+    def get_item_vectors(self, ids):
+        """Returns the vectors of the items ``ids``: a 2D Numpy array
+        sliced from the backend's stored vectors, if it keeps them in a
+        Numpy-backed :class:`~simpleneighbors.backends.vectors.VectorStore`
+        (as ``items``), otherwise a list of the vectors looked up one at a
+        time."""
+        items = getattr(self, 'items', None)
+        if items is not None and items.use_numpy:
+            return items.matrix()[list(ids)]
+        return [self.get_item_vector(idx) for idx in ids]
+
     def save(self, fname):
         raise NotImplementedError
 
@@ -0,0 +1,239 @@
+from simpleneighbors.backends.base import BaseBackend
+from simpleneighbors.backends.vectors import VectorStore
+import shutil
+
+# number of rows to convert to float64 at a time
+CHUNK_ROWS = 65536
+
+# A note on precision, for this and the other Numpy backends: scoring a
+# whole batch of vectors in one matrix product relies on the expansion
+# |x - q|^2 = |x|^2 - 2x.q + |q|^2, but when the vectors are far from the
+# origin, the large terms of that expansion cancel, and their float32
+# rounding errors can outweigh the distances themselves. So expanded scores
+# are always computed relative to a point among the vectors (like their
+# mean), which keeps the terms small, and they're only used to choose
+# candidates: results are ranked by distances computed from the differences
+# between the vectors (see exact_distances() and squared_distances()).
+
+
+def top_k(scores, n):
+    """Returns the column indices of the ``n`` smallest values in each row of
+    ``scores``, sorted in ascending order of score."""
+    import numpy as np
+    count = scores.shape[1]
+    n = min(n, count)
+    if n <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.intp)
+    if n < count:
+        idx = np.argpartition(scores, n - 1, axis=1)[:, :n]
+    else:
+        idx = np.tile(np.arange(count), (scores.shape[0], 1))
+    order = np.argsort(
+            np.take_along_axis(scores, idx, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def squared_distances(vecs, query):
+    """Returns the squared euclidean distances from ``query`` to each row
+    of ``vecs``, computed from the differences between the vectors (in
+    their own precision)."""
+    import numpy as np
+    diffs = vecs - query
+    return np.einsum('ij,ij->i', diffs, diffs)
+
+
+def gather_rows(matrix, ids):
+    """Returns the rows ``ids`` of ``matrix``, in that order, reading them
+    in sorted order (which is fastest when the matrix is memory-mapped)."""
+    import numpy as np
+    ids = np.asarray(ids)
+    return matrix[np.sort(ids)][np.argsort(np.argsort(ids))]
+
+
+def exact_distances(metric, vecs, query):
+    """Returns the distances from ``query`` to each row of ``vecs``, computed
+    in float64 from the differences between the vectors. Angular distances
+    are the distances between the normalized vectors, sqrt(2 - 2cos), as in
+    Annoy, which (like Sklearn) also supports the manhattan metric."""
+    import numpy as np
+    vecs = np.asarray(vecs, dtype=np.float64)
+    query = np.asarray(query, dtype=np.float64).reshape(1, -1)
+    if metric == 'angular':
+        norms = np.linalg.norm(vecs, axis=1)
+        norms[norms == 0] = 1.0
+        vecs = vecs / norms[:, None]
+        query = query / (np.linalg.norm(query) or 1.0)
+    if metric in ('angular', 'euclidean'):
+        return np.linalg.norm(vecs - query, axis=1)
+    if metric == 'manhattan':
+        return np.abs(vecs - query).sum(axis=1)
+    raise ValueError("can't compute exact distances for the %s metric" %
+                     metric)
+
+
+def rerank(metric, vecs, query, ids, n):
+    """Re-ranks candidates by their exact distances from ``query``.
+
+    :param metric: the distance metric
+    :param vecs: the candidates' vectors
+    :param query: the search vector
+    :param ids: a Numpy array of the candidates' ids
+    :param n: the number of results to keep
+    :returns: the ids and distances of the ``n`` nearest candidates
+    """
+    import numpy as np
+    dists = exact_distances(metric, vecs, query)
+    order = np.argsort(dists, kind='stable')[:n]
+    return ids[order], dists[order]
+
+
+def vector_distance(metric, a, b):
+    """Returns the exact distance between the vectors ``a`` and ``b``, as
+    a float."""
+    return float(exact_distances(metric, [a], b)[0])
+
+
+class BruteForceNumpy(BaseBackend):
+
+    supports_id_filter = True
+
+    @classmethod
+    def available(cls):
+        try:
+            import numpy as np  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    @classmethod
+    def tuning_grid(cls, n, build_ns):
+        # exact search has nothing to tune
+        return [(build_ns[0], [None])]
+
+    def __init__(self, dims, metric):
+        if metric not in ('angular', 'euclidean'):
+            raise NotImplementedError('no metric %s for this backend' % metric)
+        self.dims = dims
+        self.metric = metric
+        self.items = VectorStore(dims, use_numpy=True)
+        self.data = None
+        self.on_disk_fname = None
+
+    def add_item(self, idx, vector):
+        self.items.append(vector)
+
+    def add_items(self, start_idx, vectors):
+        self.items.extend(vectors)
+
+    def on_disk_build(self, fname):
+        self.items = VectorStore(self.dims, path=fname)
+        self.on_disk_fname = fname
+
+    def build(self, n, params=None, n_jobs=None):
+        self.items.close()
+        self.data = self.items.matrix()
+        self._prepare()
+
+    def _prepare(self):
+        import numpy as np
+        # euclidean scores are computed relative to the mean of the vectors
+        # (see the note at the top of this module)
+        self.center = self.data.mean(axis=0, dtype=np.float64) \
+            if len(self.data) else np.zeros(self.dims)
+        self.sq_norms = np.empty(len(self.data))
+        for start in range(0, len(self.data), CHUNK_ROWS):
+            chunk = self.data[start:start + CHUNK_ROWS]
+            if self.metric == 'euclidean':
+                chunk = chunk - self.center
+            self.sq_norms[start:start + CHUNK_ROWS] = np.einsum(
+                    'ij,ij->i', chunk, chunk, dtype=np.float64)
+        if self.metric == 'angular':
+            norms = np.sqrt(self.sq_norms)
+            norms[norms == 0] = 1.0
+            self.inv_norms = 1.0 / norms
+
+    def _scores(self, queries, ids=None):
+        """Returns a (queries, items) matrix of scores; smaller is nearer.
+
+        The scores are only used to choose candidates, which are then
+        re-ranked by their exact distances (see :meth:`_nearest`). If
+        ``ids`` is given, only those items are scored."""
+        import numpy as np
+        data, sq_norms = self.data, self.sq_norms
+        if ids is not None:
+            data, sq_norms = data[ids], sq_norms[ids]
+        if self.metric == 'angular':
+            dots = np.dot(queries.astype(np.float32), data.T)
+            inv_norms = self.inv_norms if ids is None else self.inv_norms[ids]
+            q_norms = np.linalg.norm(queries, axis=1)
+            q_norms[q_norms == 0] = 1.0
+            return -(dots * inv_norms) / q_norms[:, None]
+        # (x-c).(q-c) = x.(q-c) - c.(q-c)
+        centered = queries.astype(np.float64) - self.center
+        dots = np.dot(centered.astype(np.float32), data.T) - \
+            np.dot(centered, self.center)[:, None]
+        q_sq_norms = np.einsum('ij,ij->i', centered, centered)
+        return sq_norms - 2 * dots + q_sq_norms[:, None]
+
+    def _nearest(self, queries, n, ids=None):
+        """Returns a list of ``(ids, distances)`` pairs of Numpy arrays, one
+        for each query: the best-scoring candidates, re-ranked by their
+        exact distances."""
+        scores = self._scores(queries, ids)
+        results = []
+        for query, cands in zip(queries, top_k(scores, n + max(n, 16))):
+            if ids is not None:
+                cands = ids[cands]
+            results.append(rerank(self.metric, gather_rows(self.data, cands),
+                                  query, cands, n))
+        return results
+
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self.get_nns_by_vectors([vec], n, include_distances)[0]
+
+    def get_nns_by_vectors(self, vecs, n, include_distances=False,
+                           search_k=None):
+        import numpy as np
+        queries = np.asarray(vecs, dtype=np.float64).reshape(-1, self.dims)
+        results = self._nearest(queries, n)
+        if not include_distances:
+            return [idxs.tolist() for idxs, dists in results]
+        return [(idxs.tolist(), dists.tolist()) for idxs, dists in results]
+
+    def get_nns_by_vector_in(self, vec, n, ids, include_distances=False,
+                             search_k=None):
+        import numpy as np
+        ids = np.asarray(ids, dtype=np.intp)
+        query = np.asarray(vec, dtype=np.float64).reshape(1, self.dims)
+        found, dists = self._nearest(query, n, ids)[0]
+        if not include_distances:
+            return found.tolist()
+        return found.tolist(), dists.tolist()
+
+    def get_distance(self, a_idx, b_idx):
+        return vector_distance(self.metric, self.items.row(a_idx),
+                               self.items.row(b_idx))
+
+    def get_item_vector(self, idx):
+        return self.items.get(idx)
+
+    def save(self, fname):
+        import numpy as np
+        if self.on_disk_fname is not None:
+            if fname != self.on_disk_fname:
+                shutil.copyfile(self.on_disk_fname, fname)
+            return
+        with open(fname, "wb") as fh:
+            np.save(fh, self.items.matrix())
+
+    def load(self, fname):
+        """
+        Memory-maps the saved array of vectors, so that only the pages that are
+        actually needed are read from disk (and they're shared between
+        processes that load the same file).
+        """
+        import numpy as np
+        self.items = VectorStore.from_array(np.load(fname, mmap_mode='r'))
+        self.data = self.items.matrix()
+        self._prepare()
@@ -1,23 +1,10 @@
 from simpleneighbors.backends.base import BaseBackend
+from simpleneighbors.backends.vectors import VectorStore
+from heapq import nsmallest
 from math import sqrt
 import pickle
 
-try:
-    from functools import lru_cache
-except ImportError:
-    # for python 2, NOP lru_cache
-    from functools import wraps
 
-    def lru_cache(maxsize=10000):
-        def deco(fn):
-            @wraps(fn)
-            def wrapper(*args):
-                return fn(*args)
-            return wrapper
-        return deco
-
-
-@lru_cache(maxsize=10000)
 def distance(coord1, coord2):
     return sqrt(sum([(i - j)**2 for i, j in zip(coord1, coord2)]))
 
@@ -26,25 +13,32 @@ def norm(vec):
     return sqrt(sum([item**2 for item in vec]))
 
 
-@lru_cache(maxsize=10000)
 def normalize(vec):
-    norm_val = norm(vec)
+    vec = tuple(vec)
+    norm_val = norm(vec) or 1.0
     return tuple(item / norm_val for item in vec)
 
 
-@lru_cache(maxsize=10000)
 def norm_dist(v1, v2):
     return distance(normalize(v1), normalize(v2))
 
 
 class BruteForcePurePython(BaseBackend):
 
+    supports_id_filter = True
+
     @classmethod
     def available(cls):
         return True
 
+    @classmethod
+    def tuning_grid(cls, n, build_ns):
+        # exact search has nothing to tune
+        return [(build_ns[0], [None])]
+
     def __init__(self, dims, metric):
-        self.items = []
+        # always use array('f') storage, so this backend never needs Numpy
+        self.items = VectorStore(dims, use_numpy=False)
         assert metric in ('angular', 'euclidean')
         if metric == 'angular':
             self.dist_fn = norm_dist
@@ -54,22 +48,53 @@ class BruteForcePurePython(BaseBackend):
             raise NotImplementedError('no metric %s for this backend' % metric)
 
     def add_item(self, idx, vector):
-        self.items.append(tuple(float(d) for d in vector))
+        self.items.append(vector)
+
+    def add_items(self, start_idx, vectors):
+        self.items.extend(vectors)
 
-    def build(self, n, params=None):
+    def build(self, n, params=None, n_jobs=None):
         return
 
-    def get_nns_by_vector(self, vec, n):
-        w_idx = sorted(
-                    enumerate(self.items),
-                    key=lambda x: self.dist_fn(x[1], tuple(vec)))[:n]
-        return [item[0] for item in w_idx]
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self.get_nns_by_vectors([vec], n, include_distances)[0]
+
+    def get_nns_by_vectors(self, vecs, n, include_distances=False,
+                           search_k=None):
+        return self._search(vecs, n, range(len(self.items)), include_distances)
+
+    def get_nns_by_vector_in(self, vec, n, ids, include_distances=False,
+                             search_k=None):
+        return self._search([vec], n, ids, include_distances)[0]
+
+    def _search(self, vecs, n, ids, include_distances):
+        # one pass over the stored items, scoring every query against each.
+        # for angular distance, normalize each vector only once.
+        angular = self.dist_fn is norm_dist
+        prep = normalize if angular else tuple
+        queries = [prep(float(d) for d in vec) for vec in vecs]
+        ids = list(ids)
+        dists = [[] for q in queries]
+        for idx in ids:
+            item = prep(self.items.row(idx))
+            for q_dists, q in zip(dists, queries):
+                q_dists.append(distance(item, q))
+        results = []
+        for q_dists in dists:
+            pos = nsmallest(n, range(len(q_dists)), key=q_dists.__getitem__)
+            idxs = [ids[p] for p in pos]
+            if include_distances:
+                results.append((idxs, [q_dists[p] for p in pos]))
+            else:
+                results.append(idxs)
+        return results
 
     def get_distance(self, a_idx, b_idx):
-        return self.dist_fn(self.items[a_idx], self.items[b_idx])
+        return self.dist_fn(self.items.row(a_idx), self.items.row(b_idx))
 
     def get_item_vector(self, idx):
-        return list(self.items[idx])
+        return self.items.get(idx)
 
     def save(self, fname):
         with open(fname, "wb") as fh:
@@ -78,5 +103,10 @@ class BruteForcePurePython(BaseBackend):
     def load(self, fname):
         with open(fname, "rb") as fh:
             obj = pickle.load(fh)
-        self.items = obj.items
+        if isinstance(obj.items, list):
+            # index saved by an older version, with the vectors as tuples
+            self.items = VectorStore(self.items.dims, use_numpy=False)
+            self.items.extend(obj.items)
+        else:
+            self.items = obj.items
         self.dist_fn = obj.dist_fn
@@ -0,0 +1,368 @@
+from simpleneighbors.backends.base import BaseBackend
+from simpleneighbors.backends.bruteforcenumpy import (
+    rerank, squared_distances, top_k, vector_distance)
+from simpleneighbors.backends.vectors import VectorStore
+import shutil
+
+# number of items whose links are chosen at a time when building, and the
+# number of scores computed at a time to find their nearest neighbors (which
+# bound the memory needed)
+BLOCK_ROWS = 256
+BLOCK_SCORES = 1 << 24
+
+# number of items whose links are followed at a time when searching
+EXPAND = 8
+
+# searches start from the nearest item on the lowest layer with at most this
+# many items, found by scoring them all at once
+ENTRY_ROWS = 1024
+
+
+class HNSW(BaseBackend):
+    """Approximate search with a hierarchical navigable small world graph.
+
+    Each item is linked to its nearest neighbors (chosen so that the links
+    point in diverse directions) on the bottom layer of the graph, and to
+    exponentially fewer items on each layer above. A search starts from the
+    nearest item on a small upper layer, descends greedily through the
+    layers below and then explores the bottom layer best-first, keeping the
+    ``ef`` nearest items seen so far. Links are stored in fixed-width Numpy
+    arrays (one row per item, padded with -1), so the backend needs nothing
+    but Numpy.
+
+    Rather than inserting items one at a time, each layer is built at once:
+    the nearest neighbors of every item on the layer are found exactly, with
+    a matrix product for each block of items, and pruned to the links
+    kept. Building therefore takes time proportional to the square of the
+    number of items; for more than about a hundred thousand items, Annoy or
+    IVF build much faster. (That's also why this backend isn't one of
+    :func:`~simpleneighbors.backends.available`'s, which
+    :func:`~simpleneighbors.tuning.tune` and the benchmarks try by
+    default.)
+
+    The ``n`` argument to ``build()`` is the number of links per item on the
+    upper layers (twice as many on the bottom layer). Extra ``params``:
+    ``ef_construction``, the number of nearest neighbors each item's links
+    are chosen from (default 100), ``ef``, the default size of the candidate
+    list when searching (default 50), and ``seed``, for choosing the layers
+    of items (default 0). The ``search_k`` argument of the query methods
+    sets ``ef`` for that query (it's never less than the number of results
+    asked for).
+    """
+
+    search_k_per_result = True
+
+    @classmethod
+    def available(cls):
+        try:
+            import numpy as np  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    @classmethod
+    def tuning_grid(cls, n, build_ns):
+        return [(degree, [None] + [n * factor for factor in (2, 4, 8, 16)])
+                for degree in build_ns]
+
+    def __init__(self, dims, metric):
+        if metric not in ('angular', 'euclidean'):
+            raise NotImplementedError('no metric %s for this backend' % metric)
+        self.dims = dims
+        self.metric = metric
+        self.items = VectorStore(dims, use_numpy=True)
+        self.on_disk_fname = None
+        self.ef = 50
+        self.entry = None
+
+    def add_item(self, idx, vector):
+        self.items.append(vector)
+
+    def add_items(self, start_idx, vectors):
+        self.items.extend(vectors)
+
+    def on_disk_build(self, fname):
+        self.items = VectorStore(self.dims, path=fname + "-vectors.npy")
+        self.on_disk_fname = fname + "-vectors.npy"
+
+    def _prepare(self):
+        import numpy as np
+        data = self.items.matrix()
+        if self.metric == 'angular':
+            # with unit vectors, 1 - x.q orders items by angular distance
+            norms = np.linalg.norm(data, axis=1)
+            norms[norms == 0] = 1.0
+            self.data = (data / norms[:, None]).astype(np.float32)
+        else:
+            self.data = data
+        # rows of each upper layer's link array, by item id (-1 for items
+        # that aren't on the layer)
+        self.rows = [None]
+        for layer in range(1, len(self.links)):
+            rows = np.full(len(self.levels), -1, dtype=np.int32)
+            nodes = np.nonzero(self.levels >= layer)[0]
+            rows[nodes] = np.arange(len(nodes))
+            self.rows.append(rows)
+        self.entry_layer = len(self.links) - 1
+        while self.entry_layer > 0 and \
+                (self.levels >= self.entry_layer - 1).sum() <= ENTRY_ROWS:
+            self.entry_layer -= 1
+        self.entry_nodes = np.nonzero(self.levels >= self.entry_layer)[0]
+
+    def _query_vector(self, vec):
+        import numpy as np
+        vec = np.asarray(vec, dtype=np.float32).reshape(self.dims)
+        if self.metric == 'angular':
+            vec = vec / (np.linalg.norm(vec) or 1.0)
+        return vec
+
+    def _scores(self, vec, ids):
+        """Returns an array of scores of the items ``ids`` for a (prepared)
+        query vector; smaller is nearer."""
+        import numpy as np
+        if self.metric == 'angular':
+            return 1.0 - np.dot(self.data[ids], vec)
+        return squared_distances(self.data[ids], vec)
+
+    def _select(self, data, cands, scores, m):
+        """Chooses up to ``m`` links for each of a block of items from their
+        candidates ``cands`` (a 2D array of rows of ``data``, padded with -1)
+        sorted by ``scores``, nearest first: a candidate is skipped if it's
+        nearer to an already chosen one than to the item being linked, so
+        that links fan out in different directions. Returns the links and
+        their scores, padded with -1 and infinity."""
+        import numpy as np
+        valid = cands >= 0
+        vecs = data[cands]
+        dots = np.matmul(vecs, np.swapaxes(vecs, 1, 2))
+        if self.metric == 'angular':
+            pairwise = 1.0 - dots
+        else:
+            sq_norms = np.einsum('ijk,ijk->ij', vecs, vecs)
+            pairwise = sq_norms[:, :, None] - 2 * dots + sq_norms[:, None, :]
+        chosen = np.zeros(cands.shape, dtype=bool)
+        counts = np.zeros(len(cands), dtype=np.intp)
+        for i in range(cands.shape[1]):
+            keep = valid[:, i] & (counts < m)
+            if i:
+                keep &= ~((pairwise[:, i, :i] < scores[:, i, None]) &
+                          chosen[:, :i]).any(axis=1)
+            chosen[:, i] = keep
+            counts += keep
+        links = np.full((len(cands), m), -1, dtype=np.int32)
+        link_scores = np.full((len(cands), m), np.inf, dtype=np.float32)
+        rows, cols = np.nonzero(chosen)
+        slots = np.cumsum(chosen, axis=1)[rows, cols] - 1
+        links[rows, slots] = cands[rows, cols]
+        link_scores[rows, slots] = scores[rows, cols]
+        return links, link_scores
+
+    def _graph(self, nodes, m, pool):
+        """Builds the links between the items ``nodes`` (an array of ids)
+        on one layer: each item's ``pool`` nearest others are found exactly,
+        a block of items at a time, and pruned to ``m`` links; then each
+        item's links are chosen again from those and the links pointing to
+        it, so that they run both ways."""
+        import numpy as np
+        count = len(nodes)
+        data = self.data[nodes]
+        if self.metric == 'euclidean':
+            # (relative to their mean; see the note in bruteforcenumpy)
+            data = data - data.mean(axis=0)
+        data = data.astype(np.float32)
+        links = np.full((count, m), -1, dtype=np.int32)
+        link_scores = np.full((count, m), np.inf, dtype=np.float32)
+        pool = min(pool, count - 1)
+        if pool <= 0:
+            return links
+        # scores less the block's own squared norms (or 1, for angular
+        # ones), which don't change the order of each row, are computed in
+        # one product: |x|^2 - 2x.q for each item x is [x, |x|^2].[-2q, 1]
+        sq_norms = np.einsum('ij,ij->i', data, data)
+        if self.metric == 'angular':
+            items, factor = data, -1
+        else:
+            items, factor = np.hstack([data, sq_norms[:, None]]), -2
+        block_rows = max(1, min(BLOCK_ROWS, BLOCK_SCORES // count))
+        for start in range(0, count, block_rows):
+            stop = min(start + block_rows, count)
+            block = factor * data[start:stop]
+            if self.metric == 'euclidean':
+                block = np.hstack(
+                        [block, np.ones((stop - start, 1), dtype=np.float32)])
+            scores = np.dot(block, items.T)
+            scores[np.arange(stop - start), np.arange(start, stop)] = np.inf
+            cands = top_k(scores, pool)
+            scores = np.take_along_axis(scores, cands, axis=1)
+            scores += 1.0 if self.metric == 'angular' else \
+                sq_norms[start:stop, None]
+            links[start:stop], link_scores[start:stop] = self._select(
+                    data, cands, scores, m)
+        # up to m of the nearest links pointing to each item
+        sources = np.repeat(np.arange(count, dtype=np.int32), m)
+        targets, scores = links.ravel(), link_scores.ravel()
+        present = targets >= 0
+        sources, targets, scores = \
+            sources[present], targets[present], scores[present]
+        order = np.lexsort((scores, targets))
+        sources, targets, scores = \
+            sources[order], targets[order], scores[order]
+        ranks = np.arange(len(targets)) - np.searchsorted(targets, targets)
+        present = ranks < m
+        reverse = np.full((count, m), -1, dtype=np.int32)
+        reverse_scores = np.full((count, m), np.inf, dtype=np.float32)
+        reverse[targets[present], ranks[present]] = sources[present]
+        reverse_scores[targets[present], ranks[present]] = scores[present]
+        cands = np.hstack([links, reverse])
+        scores = np.hstack([link_scores, reverse_scores])
+        # drop the links that appear both ways, then sort by score
+        order = np.argsort(cands, axis=1, kind='stable')
+        cands = np.take_along_axis(cands, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        repeated = np.zeros(cands.shape, dtype=bool)
+        repeated[:, 1:] = (cands[:, 1:] == cands[:, :-1]) & (cands[:, 1:] >= 0)
+        cands[repeated] = -1
+        scores[repeated] = np.inf
+        order = np.argsort(scores, axis=1, kind='stable')
+        cands = np.take_along_axis(cands, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        for start in range(0, count, BLOCK_ROWS):
+            rows = slice(start, start + BLOCK_ROWS)
+            links[rows] = self._select(data, cands[rows], scores[rows], m)[0]
+        # from rows of this layer to item ids
+        return np.where(links >= 0, nodes[links], -1).astype(np.int32)
+
+    def build(self, n, params=None, n_jobs=None):
+        import numpy as np
+        params = params or {}
+        self.m = max(int(n), 2)
+        self.ef = params.get('ef', 50)
+        ef_construction = max(params.get('ef_construction', 100), self.m)
+        self.items.close()
+        count = len(self.items)
+        rng = np.random.RandomState(params.get('seed', 0))
+        # each layer holds about 1/m of the items on the layer below
+        self.levels = np.floor(-np.log(1.0 - rng.random_sample(count)) /
+                               np.log(self.m)).astype(np.int32)
+        top = int(self.levels.max()) if count else 0
+        self.links = [np.full((count, 2 * self.m), -1, dtype=np.int32)] + [
+                np.full((int((self.levels >= layer).sum()), self.m), -1,
+                        dtype=np.int32)
+                for layer in range(1, top + 1)]
+        self._prepare()
+        for layer in range(top + 1):
+            nodes = np.nonzero(self.levels >= layer)[0]
+            self.links[layer] = self._graph(
+                    nodes, self.links[layer].shape[1], ef_construction)
+        # the search starts from an item on the top layer
+        self.entry = int(np.argmax(self.levels)) if count else None
+        self.max_level = top
+
+    def _search_layer(self, vec, entries, ef, layer):
+        """Best-first search of one layer of the graph, starting from the
+        item ids ``entries``: the links of the nearest few items found so
+        far that haven't been expanded yet are followed at once, until the
+        ``ef`` nearest items found have all been expanded. Returns arrays of
+        their ids and scores, nearest first."""
+        import numpy as np
+        links, rows = self.links[layer], self.rows[layer]
+        ids = np.asarray(entries, dtype=np.intp)
+        scores = self._scores(vec, ids)
+        expanded = np.zeros(len(ids), dtype=bool)
+        visited = np.zeros(len(self.levels), dtype=bool)
+        visited[ids] = True
+        # scratch space for dropping repeated ids
+        slots = np.empty(len(self.levels), dtype=np.int32)
+        while True:
+            # ids are kept sorted by score, nearest first
+            frontier = np.flatnonzero(~expanded)[:EXPAND]
+            if not len(frontier):
+                break
+            expanded[frontier] = True
+            nodes = ids[frontier]
+            new = (links[nodes] if rows is None else links[rows[nodes]])
+            new = new[new >= 0]
+            new = new[~visited[new]]
+            if not len(new):
+                continue
+            positions = np.arange(len(new), dtype=np.int32)
+            slots[new] = positions
+            new = new[slots[new] == positions]
+            visited[new] = True
+            ids = np.concatenate([ids, new])
+            scores = np.concatenate([scores, self._scores(vec, new)])
+            expanded = np.concatenate(
+                    [expanded, np.zeros(len(new), dtype=bool)])
+            order = np.argsort(scores, kind='stable')[:ef]
+            ids, scores, expanded = ids[order], scores[order], expanded[order]
+        return ids, scores
+
+    def _search(self, vec, n, include_distances, search_k):
+        import numpy as np
+        if self.entry is None or n <= 0:
+            return ([], []) if include_distances else []
+        query = self._query_vector(vec)
+        ef = max(n, self.ef if search_k is None else search_k)
+        nodes = self.entry_nodes
+        entries = nodes[[int(np.argmin(self._scores(query, nodes)))]]
+        for layer in range(self.entry_layer - 1, 0, -1):
+            entries = self._search_layer(query, entries, 1, layer)[0]
+        found = self._search_layer(query, entries, ef, 0)[0][:n]
+        # the results are ordered, and their distances computed, exactly
+        idxs, dists = rerank(self.metric, self.items.matrix()[found], vec,
+                             found, n)
+        if not include_distances:
+            return idxs.tolist()
+        return idxs.tolist(), dists.tolist()
+
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self._search(vec, n, include_distances, search_k)
+
+    def get_distance(self, a_idx, b_idx):
+        return vector_distance(self.metric, self.items.row(a_idx),
+                               self.items.row(b_idx))
+
+    def get_item_vector(self, idx):
+        return self.items.get(idx)
+
+    def save(self, fname):
+        """
+        Saves the graph as ``fname`` (in Numpy's ``.npz`` format: the layer
+        of each item and an array of links for each layer) and the vectors
+        as ``<fname>-vectors.npy``.
+        """
+        import numpy as np
+        layers = dict(('links%d' % layer, links)
+                      for layer, links in enumerate(self.links))
+        entry = -1 if self.entry is None else self.entry
+        with open(fname, "wb") as fh:
+            np.savez(fh, levels=self.levels,
+                     header=np.array([self.m, self.ef, entry, self.max_level,
+                                      len(self.links)]),
+                     **layers)
+        vectors_fname = fname + "-vectors.npy"
+        if self.on_disk_fname is not None:
+            if vectors_fname != self.on_disk_fname:
+                shutil.copyfile(self.on_disk_fname, vectors_fname)
+            return
+        with open(vectors_fname, "wb") as fh:
+            np.save(fh, self.items.matrix())
+
+    def load(self, fname):
+        """
+        Loads the graph into memory and memory-maps the vectors (for the
+        angular metric, a normalized copy of the vectors is made in memory).
+        """
+        import numpy as np
+        with np.load(fname) as saved:
+            self.levels = saved['levels']
+            self.m, self.ef, entry, self.max_level, layers = (
+                    int(x) for x in saved['header'])
+            self.links = [saved['links%d' % layer] for layer in range(layers)]
+        self.entry = None if entry < 0 else entry
+        # saving again copies this file rather than rewriting it
+        self.on_disk_fname = fname + "-vectors.npy"
+        self.items = VectorStore.from_array(
+                np.load(self.on_disk_fname, mmap_mode='r'))
+        self._prepare()
@@ -0,0 +1,320 @@
+from simpleneighbors.backends.base import BaseBackend
+from simpleneighbors.backends.bruteforcenumpy import (
+    gather_rows, rerank, squared_distances, top_k, vector_distance)
+from simpleneighbors.backends.vectors import VectorStore
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+
+# number of vectors to assign to lists at a time
+CHUNK_ROWS = 65536
+
+
+class IVF(BaseBackend):
+    """Approximate search with an inverted file index.
+
+    When the index is built, k-means clustering (on a sample of the vectors)
+    divides the space into ``n`` cells, and the vectors are rearranged so
+    that each cell's vectors are stored contiguously. A search compares the
+    query with the cells' centroids and then scores every vector in the
+    ``nprobe`` nearest cells in one vectorized step, and the best of them
+    are re-ranked by their exact distances. Each k-means iteration and the
+    final assignment of vectors to cells are matrix products, split between
+    ``n_jobs`` threads.
+
+    The rearranged vectors are saved as a single ``.npy`` file, which is
+    memory-mapped on load, so only the cells that are actually searched are
+    read into memory.
+
+    The ``n`` argument to ``build()`` is the number of cells (a common
+    choice is around the square root of the number of items). Extra
+    ``params``: ``nprobe``, the default number of cells to search (default
+    8), ``iterations``, the number of k-means iterations (default 10),
+    ``sample``, the number of vectors to train k-means on (default 256 per
+    cell), and ``seed`` (default 0). The ``search_k`` argument of the query
+    methods sets ``nprobe`` for that query. Searches restricted to given
+    ids (with :func:`~simpleneighbors.SimpleNeighbors.nearest_matching`)
+    are exact.
+    """
+
+    supports_id_filter = True
+
+    @classmethod
+    def available(cls):
+        try:
+            import numpy as np  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    @classmethod
+    def tuning_grid(cls, n, build_ns):
+        return [(lists, [None] + [nprobe for nprobe in (1, 2, 4, 16, 32)
+                                  if nprobe < lists])
+                for lists in build_ns]
+
+    def __init__(self, dims, metric):
+        if metric not in ('angular', 'euclidean'):
+            raise NotImplementedError('no metric %s for this backend' % metric)
+        self.dims = dims
+        self.metric = metric
+        self.items = VectorStore(dims, use_numpy=True)
+        self.on_disk_fname = None
+        self.nprobe = 8
+
+    def add_item(self, idx, vector):
+        self.items.append(vector)
+
+    def add_items(self, start_idx, vectors):
+        self.items.extend(vectors)
+
+    def on_disk_build(self, fname):
+        self.items = VectorStore(self.dims, path=fname + "-vectors.npy")
+        self.on_disk_fname = fname
+
+    def _map_chunks(self, fn, count, n_jobs):
+        """Calls ``fn(start, stop)`` for each chunk of ``count`` rows, in
+        ``n_jobs`` threads (Numpy releases the GIL for matrix products), and
+        returns the results in order."""
+        chunks = [(start, min(start + CHUNK_ROWS, count))
+                  for start in range(0, count, CHUNK_ROWS)]
+        if n_jobs == 1 or len(chunks) < 2:
+            return [fn(*chunk) for chunk in chunks]
+        pool = ThreadPool(n_jobs if n_jobs and n_jobs > 0 else None)
+        try:
+            return pool.map(lambda chunk: fn(*chunk), chunks)
+        finally:
+            pool.close()
+
+    def _centroid_scores(self, data, centroids):
+        """Returns a (rows, centroids) matrix of scores of the centroids
+        for each row of ``data``; smaller is nearer."""
+        import numpy as np
+        if self.metric == 'angular':
+            # (with unit centroids)
+            return -np.dot(data, centroids.T)
+        # |x - c|^2 - |x|^2 = |c|^2 - 2x.c, computed relative to the
+        # centroids' mean (see the note in bruteforcenumpy)
+        center = centroids.mean(axis=0)
+        centroids = centroids - center
+        c_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        return c_sq_norms - 2 * np.dot(data - center, centroids.T)
+
+    def _assign(self, data, centroids, n_jobs):
+        """Returns the index of the nearest centroid to each row of
+        ``data``."""
+        import numpy as np
+
+        def assign(start, stop):
+            return np.argmin(
+                    self._centroid_scores(data[start:stop], centroids), axis=1)
+        chunks = self._map_chunks(assign, data.shape[0], n_jobs)
+        if not chunks:
+            return np.zeros(0, dtype=np.intp)
+        return np.concatenate(chunks)
+
+    def _normalize(self, data):
+        import numpy as np
+        norms = np.linalg.norm(data, axis=1)
+        norms[norms == 0] = 1.0
+        return data / norms[:, None]
+
+    def _kmeans(self, data, lists, iterations, sample, rng, n_jobs):
+        import numpy as np
+        count = data.shape[0]
+        sample = np.sort(rng.choice(count, min(count, sample), replace=False))
+        # (sorted, so that a memory-mapped array is read in order)
+        train = np.asarray(data[sample], dtype=np.float32)
+        if self.metric == 'angular':
+            train = self._normalize(train)
+        centroids = train[rng.choice(len(train), lists, replace=False)]
+        for i in range(iterations):
+            assigned = self._assign(train, centroids, n_jobs)
+            sizes = np.bincount(assigned, minlength=lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assigned, train)
+            empty = sizes == 0
+            centroids = sums / np.maximum(sizes, 1)[:, None]
+            # start empty cells over from random vectors
+            centroids[empty] = train[rng.choice(len(train), empty.sum())]
+            if self.metric == 'angular':
+                centroids = self._normalize(centroids)
+        return centroids.astype(np.float32)
+
+    def build(self, n, params=None, n_jobs=None):
+        import numpy as np
+        params = params or {}
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        self.nprobe = params.get('nprobe', 8)
+        self.items.close()
+        data = self.items.matrix()
+        count = data.shape[0]
+        lists = max(min(int(n), count), 1)
+        rng = np.random.RandomState(params.get('seed', 0))
+        if count:
+            self.centroids = self._kmeans(
+                    data, lists, params.get('iterations', 10),
+                    params.get('sample', 256 * lists), rng, n_jobs)
+            assigned = self._assign(data, self.centroids, n_jobs)
+        else:
+            self.centroids = np.zeros((1, self.dims), dtype=np.float32)
+            assigned = np.zeros(0, dtype=np.intp)
+        # ids[offsets[c]:offsets[c + 1]] are the items in cell c
+        self.ids = np.argsort(assigned, kind='stable').astype(np.int64)
+        self.offsets = np.concatenate(
+                [[0], np.cumsum(np.bincount(assigned, minlength=lists))])
+        if self.on_disk_fname is not None and count:
+            from numpy.lib.format import open_memmap
+            self.vectors = open_memmap(
+                    self.on_disk_fname + "-lists.npy", mode='w+',
+                    dtype=np.float32, shape=(count, self.dims))
+        else:
+            self.vectors = np.empty((count, self.dims), dtype=np.float32)
+
+        def rearrange(start, stop):
+            self.vectors[start:stop] = gather_rows(
+                    data, self.ids[start:stop])
+        self._map_chunks(rearrange, count, n_jobs)
+        # the vectors are only needed in their new order from now on
+        data = None
+        self.items = None
+        if self.on_disk_fname is not None:
+            os.remove(self.on_disk_fname + "-vectors.npy")
+        self.sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self._prepare()
+
+    def _prepare(self):
+        import numpy as np
+        # positions[idx] is where item idx is stored in vectors
+        self.positions = np.empty(len(self.ids), dtype=np.int64)
+        self.positions[self.ids] = np.arange(len(self.ids))
+        if self.metric == 'angular':
+            norms = np.sqrt(self.sq_norms)
+            norms[norms == 0] = 1.0
+            self.inv_norms = 1.0 / norms
+
+    def _scores(self, query, start, stop):
+        """Returns the scores of the vectors stored at positions
+        ``start:stop`` (a slice or an array of positions) for one float32
+        query; smaller is nearer."""
+        import numpy as np
+        rows = slice(start, stop) if stop is not None else start
+        if self.metric == 'angular':
+            q_norm = np.linalg.norm(query) or 1.0
+            dots = np.dot(self.vectors[rows], query)
+            return -(dots * self.inv_norms[rows]) / q_norm
+        return squared_distances(self.vectors[rows], query)
+
+    def _probe(self, queries, nprobe, n):
+        """Returns, for each query, the indices of the ``nprobe`` cells
+        nearest to it (or of more cells, if those hold fewer than ``n``
+        items)."""
+        import numpy as np
+        scores = self._centroid_scores(queries, self.centroids)
+        sizes = np.diff(self.offsets)
+        probes = []
+        for row, cells in zip(scores, top_k(scores, nprobe)):
+            if sizes[cells].sum() < n:
+                cells = top_k(row[None, :], len(row))[0]
+                enough = np.searchsorted(np.cumsum(sizes[cells]), n)
+                cells = cells[:max(enough + 1, nprobe)]
+            probes.append(cells)
+        return probes
+
+    def _result(self, query, positions, scores, n, include_distances):
+        """Returns the ``n`` best-scoring items, ordered by their exact
+        distances from ``query``."""
+        positions = positions[top_k(scores[None, :], n)[0]]
+        idxs, dists = rerank(self.metric, self.vectors[positions], query,
+                             self.ids[positions], n)
+        if not include_distances:
+            return idxs.tolist()
+        return idxs.tolist(), dists.tolist()
+
+    def get_nns_by_vectors(self, vecs, n, include_distances=False,
+                           search_k=None):
+        import numpy as np
+        queries = np.asarray(vecs, dtype=np.float64).reshape(-1, self.dims)
+        prepared = queries.astype(np.float32)
+        nprobe = self.nprobe if search_k is None else search_k
+        nprobe = max(min(nprobe, len(self.centroids)), 1)
+        results = []
+        for raw, query, cells in zip(queries, prepared,
+                                     self._probe(prepared, nprobe, n)):
+            cells = np.sort(cells)
+            positions = np.concatenate(
+                    [np.arange(self.offsets[cell], self.offsets[cell + 1])
+                     for cell in cells])
+            scores = np.concatenate(
+                    [self._scores(query, self.offsets[cell],
+                                  self.offsets[cell + 1])
+                     for cell in cells])
+            results.append(self._result(raw, positions, scores, n,
+                                        include_distances))
+        return results
+
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self.get_nns_by_vectors(
+                [vec], n, include_distances, search_k)[0]
+
+    def get_nns_by_vector_in(self, vec, n, ids, include_distances=False,
+                             search_k=None):
+        import numpy as np
+        query = np.asarray(vec, dtype=np.float64).reshape(self.dims)
+        positions = np.sort(self.positions[np.asarray(ids, dtype=np.intp)])
+        scores = self._scores(query.astype(np.float32), positions, None)
+        return self._result(query, positions, scores, n, include_distances)
+
+    def get_distance(self, a_idx, b_idx):
+        return vector_distance(self.metric,
+                               self.vectors[self.positions[a_idx]],
+                               self.vectors[self.positions[b_idx]])
+
+    def get_item_vector(self, idx):
+        return [float(x) for x in self.vectors[self.positions[idx]]]
+
+    def get_item_vectors(self, ids):
+        return self.vectors[self.positions[list(ids)]]
+
+    def save(self, fname):
+        """
+        Saves the centroids, the item ids in each cell and the vectors'
+        norms as ``fname`` (in Numpy's ``.npz`` format), and the vectors,
+        arranged by cell, as ``<fname>-lists.npy``.
+        """
+        import numpy as np
+        with open(fname, "wb") as fh:
+            np.savez(fh, centroids=self.centroids, ids=self.ids,
+                     offsets=self.offsets, sq_norms=self.sq_norms,
+                     nprobe=self.nprobe)
+        lists_fname = fname + "-lists.npy"
+        if self.on_disk_fname is not None and len(self.ids):
+            if lists_fname != self.on_disk_fname + "-lists.npy":
+                shutil.copyfile(self.on_disk_fname + "-lists.npy",
+                                lists_fname)
+            return
+        with open(lists_fname, "wb") as fh:
+            np.save(fh, self.vectors)
+
+    def load(self, fname):
+        """
+        Loads the centroids and cell contents into memory and memory-maps
+        the vectors, so that only the cells that are searched are read
+        from disk.
+        """
+        import numpy as np
+        with np.load(fname) as saved:
+            self.centroids = saved['centroids']
+            self.ids = saved['ids']
+            self.offsets = saved['offsets']
+            self.sq_norms = saved['sq_norms']
+            self.nprobe = int(saved['nprobe'])
+        # saving again copies this file rather than rewriting it
+        self.on_disk_fname = fname
+        # (an empty file can't be memory-mapped)
+        self.vectors = np.load(fname + "-lists.npy",
+                               mmap_mode='r' if len(self.ids) else None)
+        self.items = None
+        self._prepare()
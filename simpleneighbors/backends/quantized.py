@@ -0,0 +1,248 @@
+from simpleneighbors.backends.base import BaseBackend
+from simpleneighbors.backends.bruteforcenumpy import (
+    gather_rows, rerank, top_k, vector_distance)
+from simpleneighbors.backends.vectors import VectorStore
+import shutil
+
+# number of rows of codes to convert to floats at a time when scoring, which
+# bounds the memory needed for a search
+CHUNK_ROWS = 65536
+
+
+class Quantized(BaseBackend):
+    """Brute-force search over vectors compressed to 8 bits per dimension.
+
+    When the index is built, each dimension's range of values is divided
+    into 256 steps, and every vector is stored as one signed byte per
+    dimension: a quarter of the memory needed for float32 vectors. Queries
+    aren't quantized (the distances are *asymmetric*), and the scores of
+    the best candidates are recomputed with the exact vectors, which are
+    memory-mapped from disk after the index is saved and loaded, so that only
+    the pages actually needed for re-ranking are read into memory.
+
+    Extra ``params`` for ``build()``: ``rerank``, the number of candidates to
+    re-rank per result (default 4), and ``keep_vectors``, whether to keep
+    the exact vectors at all (default ``True``; without them, results are
+    ranked by the quantized vectors alone and the index is smallest). The
+    ``search_k`` argument of the query methods sets the number of
+    candidates to re-rank for that query (0 to skip re-ranking). The ``n``
+    argument to ``build()`` is ignored.
+    """
+
+    supports_id_filter = True
+    search_k_per_result = True
+
+    @classmethod
+    def available(cls):
+        try:
+            import numpy as np  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    @classmethod
+    def tuning_grid(cls, n, build_ns):
+        return [(build_ns[0], [0, None] + [n * factor
+                                           for factor in (8, 16, 32)])]
+
+    def __init__(self, dims, metric):
+        if metric not in ('angular', 'euclidean'):
+            raise NotImplementedError('no metric %s for this backend' % metric)
+        self.dims = dims
+        self.metric = metric
+        self.items = VectorStore(dims, use_numpy=True)
+        self.on_disk_fname = None
+        self.rerank = 4
+        self.codes = None
+
+    def add_item(self, idx, vector):
+        self.items.append(vector)
+
+    def add_items(self, start_idx, vectors):
+        self.items.extend(vectors)
+
+    def on_disk_build(self, fname):
+        self.items = VectorStore(self.dims, path=fname + "-vectors.npy")
+        self.on_disk_fname = fname + "-vectors.npy"
+
+    def _normalized(self, data):
+        import numpy as np
+        data = np.asarray(data, dtype=np.float32)
+        if self.metric != 'angular':
+            return data
+        norms = np.linalg.norm(data, axis=1)
+        norms[norms == 0] = 1.0
+        return data / norms[:, None]
+
+    def build(self, n, params=None, n_jobs=None):
+        import numpy as np
+        params = params or {}
+        self.rerank = params.get('rerank', 4)
+        self.items.close()
+        data = self.items.matrix()
+        count = data.shape[0]
+        # each dimension's range, over the (normalized) vectors
+        lo = np.full(self.dims, np.inf, dtype=np.float32)
+        hi = np.full(self.dims, -np.inf, dtype=np.float32)
+        for start in range(0, count, CHUNK_ROWS):
+            chunk = self._normalized(data[start:start + CHUNK_ROWS])
+            lo = np.minimum(lo, chunk.min(axis=0))
+            hi = np.maximum(hi, chunk.max(axis=0))
+        if not count:
+            lo = hi = np.zeros(self.dims, dtype=np.float32)
+        self.scale = (hi - lo) / 255.0
+        self.scale[self.scale == 0] = 1.0
+        # code c stands for the value c * scale + offset
+        self.offset = lo + 128 * self.scale
+        self.codes = np.empty((count, self.dims), dtype=np.int8)
+        for start in range(0, count, CHUNK_ROWS):
+            chunk = self._normalized(data[start:start + CHUNK_ROWS])
+            self.codes[start:start + CHUNK_ROWS] = np.clip(
+                    np.rint((chunk - lo) / self.scale) - 128, -128, 127)
+        self._prepare()
+        if not params.get('keep_vectors', True):
+            self.items = None
+
+    def _prepare(self):
+        import numpy as np
+        # squared norms of the dequantized vectors minus the offset (see
+        # _scores), for euclidean distances
+        self.sq_norms = np.empty(self.codes.shape[0], dtype=np.float32)
+        for start in range(0, self.codes.shape[0], CHUNK_ROWS):
+            chunk = self.codes[start:start + CHUNK_ROWS].astype(
+                    np.float32) * self.scale
+            self.sq_norms[start:start + CHUNK_ROWS] = np.einsum(
+                    'ij,ij->i', chunk, chunk)
+
+    def _dequantized(self, rows):
+        import numpy as np
+        return self.codes[rows].astype(np.float32) * self.scale + self.offset
+
+    def _scores(self, queries, ids=None):
+        """Returns a (queries, items) matrix of approximate scores; smaller
+        is nearer. If ``ids`` is given, only those items are scored."""
+        import numpy as np
+        count = self.codes.shape[0] if ids is None else len(ids)
+        if self.metric == 'euclidean':
+            # relative to the offset, a dequantized x is just scale * c
+            # (see the note in bruteforcenumpy)
+            queries = queries - self.offset
+        # q.x for a dequantized x is (q * scale).c + q.offset
+        scaled = (queries * self.scale).astype(np.float32)
+        dots = np.empty((queries.shape[0], count), dtype=np.float32)
+        for start in range(0, count, CHUNK_ROWS):
+            rows = slice(start, start + CHUNK_ROWS)
+            codes = self.codes[rows] if ids is None else \
+                self.codes[ids[rows]]
+            dots[:, rows] = np.dot(scaled, codes.astype(np.float32).T)
+        if self.metric == 'angular':
+            return -(dots + np.dot(queries, self.offset)[:, None])
+        sq_norms = self.sq_norms if ids is None else self.sq_norms[ids]
+        q_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        return sq_norms - 2 * dots + q_sq_norms[:, None]
+
+    def _distances(self, scores):
+        import numpy as np
+        if self.metric == 'angular':
+            return np.sqrt(np.maximum(2 + 2 * scores, 0))
+        return np.sqrt(np.maximum(scores, 0))
+
+    def _search(self, queries, n, include_distances, search_k, ids=None):
+        import numpy as np
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, self.dims)
+        if self.metric == 'angular':
+            norms = np.linalg.norm(queries, axis=1)
+            norms[norms == 0] = 1.0
+            scores = self._scores(queries / norms[:, None], ids)
+        else:
+            scores = self._scores(queries, ids)
+        candidates = n * self.rerank if search_k is None else search_k
+        results = []
+        if self.items is None or candidates <= 0:
+            idxs = top_k(scores, n)
+            dists = self._distances(np.take_along_axis(scores, idxs, axis=1))
+            if ids is not None:
+                idxs = ids[idxs]
+            results = zip(idxs, dists)
+        else:
+            # re-rank the best candidates by their exact distances
+            for query, cands in zip(queries,
+                                    top_k(scores, max(candidates, n))):
+                if ids is not None:
+                    cands = ids[cands]
+                results.append(rerank(
+                        self.metric, gather_rows(self.items.matrix(), cands),
+                        query, cands, n))
+        if not include_distances:
+            return [idxs.tolist() for idxs, dists in results]
+        return [(idxs.tolist(), dists.tolist()) for idxs, dists in results]
+
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self._search([vec], n, include_distances, search_k)[0]
+
+    def get_nns_by_vectors(self, vecs, n, include_distances=False,
+                           search_k=None):
+        return self._search(list(vecs), n, include_distances, search_k)
+
+    def get_nns_by_vector_in(self, vec, n, ids, include_distances=False,
+                             search_k=None):
+        import numpy as np
+        ids = np.asarray(ids, dtype=np.intp)
+        return self._search([vec], n, include_distances, search_k, ids)[0]
+
+    def get_item_vector(self, idx):
+        if self.items is None:
+            return [float(x) for x in self._dequantized(idx)]
+        return self.items.get(idx)
+
+    def get_item_vectors(self, ids):
+        if self.items is None:
+            return self._dequantized(list(ids))
+        return gather_rows(self.items.matrix(), ids)
+
+    def get_distance(self, a_idx, b_idx):
+        return vector_distance(self.metric, self.get_item_vector(a_idx),
+                               self.get_item_vector(b_idx))
+
+    def save(self, fname):
+        """
+        Saves the quantized vectors and quantization parameters as
+        ``fname`` (in Numpy's ``.npz`` format) and the exact vectors, if
+        they were kept, as ``<fname>-vectors.npy``.
+        """
+        import numpy as np
+        with open(fname, "wb") as fh:
+            np.savez(fh, codes=self.codes, scale=self.scale,
+                     offset=self.offset, rerank=self.rerank,
+                     has_vectors=self.items is not None)
+        if self.items is None:
+            return
+        vectors_fname = fname + "-vectors.npy"
+        if self.on_disk_fname is not None:
+            if vectors_fname != self.on_disk_fname:
+                shutil.copyfile(self.on_disk_fname, vectors_fname)
+            return
+        with open(vectors_fname, "wb") as fh:
+            np.save(fh, self.items.matrix())
+
+    def load(self, fname):
+        """
+        Loads the quantized vectors into memory and memory-maps the exact
+        vectors, so that only the pages needed for re-ranking are read from
+        disk.
+        """
+        import numpy as np
+        with np.load(fname) as saved:
+            self.codes = saved['codes']
+            self.scale = saved['scale']
+            self.offset = saved['offset']
+            self.rerank = int(saved['rerank'])
+            has_vectors = bool(saved['has_vectors'])
+        self.items = self.on_disk_fname = None
+        if has_vectors:
+            # saving again copies this file rather than rewriting it
+            self.on_disk_fname = fname + "-vectors.npy"
+            self.items = VectorStore.from_array(
+                    np.load(self.on_disk_fname, mmap_mode='r'))
+        self._prepare()
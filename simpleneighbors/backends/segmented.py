@@ -0,0 +1,172 @@
+from simpleneighbors.backends.base import BaseBackend
+from simpleneighbors.backends.bruteforcenumpy import BruteForceNumpy
+from simpleneighbors.backends.bruteforcepurepython import (
+    BruteForcePurePython, distance, norm_dist)
+from heapq import merge
+from itertools import islice
+import threading
+
+
+def delta_backend():
+    """Returns the backend class to use for delta segments: an exact,
+    brute-force backend, which needs no build step."""
+    if BruteForceNumpy.available():
+        return BruteForceNumpy
+    return BruteForcePurePython
+
+
+class Segmented(BaseBackend):
+    """Combines a built index with a small, mutable delta segment.
+
+    Items with ids below ``main_count`` live in the ``main`` backend, which
+    has already been built. Items added afterwards go to a brute-force delta
+    backend (with ids offset by ``main_count``), and every search consults
+    both segments and merges their results by distance. Deleted ids are kept
+    as tombstones and filtered out of search results. The delta segment is
+    guarded by a lock, so items can be added while other threads search.
+
+    This backend is used by :class:`~simpleneighbors.SimpleNeighbors` objects
+    created with ``mutable=True``; it isn't meant to be used directly.
+
+    :param main: a built backend instance
+    :param main_count: number of items in ``main``
+    :param dims: the number of dimensions
+    :param metric: the distance metric
+    :param delta_class: backend class for the delta segment
+    """
+
+    def __init__(self, main, main_count, dims, metric, delta_class=None):
+        if delta_class is None:
+            delta_class = delta_backend()
+        self.main = main
+        self.main_count = main_count
+        self.dims = dims
+        self.metric = metric
+        self.delta = delta_class(dims, metric=metric)
+        self.delta_count = 0
+        self.delta_built = True
+        self.deleted = set()
+        self.lock = threading.RLock()
+        self.supports_id_filter = (main.supports_id_filter and
+                                   self.delta.supports_id_filter)
+        self.search_k_per_result = main.search_k_per_result
+
+    def add_item(self, idx, vector):
+        with self.lock:
+            self.delta.add_item(idx - self.main_count, vector)
+            self.delta_count += 1
+            self.delta_built = False
+
+    def add_items(self, start_idx, vectors):
+        with self.lock:
+            self.delta.add_items(start_idx - self.main_count, vectors)
+            self.delta_count += len(vectors)
+            self.delta_built = False
+
+    def delete(self, idx):
+        self.deleted.add(idx)
+
+    def build(self, n, params=None, n_jobs=None):
+        raise NotImplementedError(
+            "segmented indexes are built incrementally; use compact()")
+
+    def _delta(self):
+        with self.lock:
+            if not self.delta_built:
+                self.delta.build(0)
+                self.delta_built = True
+            return self.delta
+
+    def _search_segment(self, backend, offset, count, vec, n, ids,
+                        search_k=None):
+        """Searches one segment, returning ``(distance, id)`` pairs for the
+        items found that haven't been deleted."""
+        if ids is not None:
+            ids = [idx - offset for idx in ids
+                   if offset <= idx < offset + count]
+            count = len(ids)
+        if not count:
+            return []
+        # over-fetch by the number of tombstones, so that enough results
+        # remain once they're filtered out
+        deleted = self.deleted
+        fetch = min(n + len(deleted), count)
+        if ids is None:
+            idxs, dists = backend.get_nns_by_vector(
+                    vec, fetch, include_distances=True, search_k=search_k)
+        else:
+            idxs, dists = backend.get_nns_by_vector_in(
+                    vec, fetch, ids, include_distances=True,
+                    search_k=search_k)
+        return [(dist, idx + offset) for idx, dist in zip(idxs, dists)
+                if idx + offset not in deleted]
+
+    def _search(self, vec, n, include_distances, ids=None, search_k=None):
+        results = [self._search_segment(
+                self.main, 0, self.main_count, vec, n, ids, search_k)]
+        # the delta segment is small, but may change while it's searched
+        with self.lock:
+            if self.delta_count:
+                results.append(self._search_segment(
+                        self._delta(), self.main_count, self.delta_count,
+                        vec, n, ids))
+        best = list(islice(merge(*results), n))
+        idxs = [idx for dist, idx in best]
+        if include_distances:
+            return idxs, [dist for dist, idx in best]
+        return idxs
+
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self._search(vec, n, include_distances, search_k=search_k)
+
+    def get_nns_by_vector_in(self, vec, n, ids, include_distances=False,
+                             search_k=None):
+        return self._search(vec, n, include_distances, ids, search_k)
+
+    def _segment(self, idx):
+        if idx < self.main_count:
+            return self.main, idx
+        return self._delta(), idx - self.main_count
+
+    def get_distance(self, a_idx, b_idx):
+        a_backend, a_local = self._segment(a_idx)
+        b_backend, b_local = self._segment(b_idx)
+        if a_backend is b_backend:
+            return a_backend.get_distance(a_local, b_local)
+        dist_fn = norm_dist if self.metric == 'angular' else distance
+        return dist_fn(a_backend.get_item_vector(a_local),
+                       b_backend.get_item_vector(b_local))
+
+    def get_item_vector(self, idx):
+        backend, local = self._segment(idx)
+        return backend.get_item_vector(local)
+
+    def get_item_vectors(self, ids):
+        ids = list(ids)
+        main_ids = [idx for idx in ids if idx < self.main_count]
+        delta_ids = [idx - self.main_count for idx in ids
+                     if idx >= self.main_count]
+        if not delta_ids:
+            return self.main.get_item_vectors(main_ids)
+        delta_vecs = self._delta().get_item_vectors(delta_ids)
+        if not main_ids:
+            return delta_vecs
+        main_vecs = self.main.get_item_vectors(main_ids)
+        # put the vectors back in the order the ids were given
+        by_id = dict(zip(main_ids, main_vecs))
+        by_id.update((idx + self.main_count, vec)
+                     for idx, vec in zip(delta_ids, delta_vecs))
+        return [by_id[idx] for idx in ids]
+
+    def save(self, fname):
+        """
+        Saves the main index as ``fname`` and the delta segment as
+        ``<fname>-delta``. (Tombstones are saved with the object data.)
+        """
+        self.main.save(fname)
+        self._delta().save(fname + "-delta")
+
+    def load(self, fname):
+        self.main.load(fname)
+        self.delta.load(fname + "-delta")
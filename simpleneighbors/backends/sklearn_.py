@@ -1,4 +1,6 @@
 from simpleneighbors.backends.base import BaseBackend
+from simpleneighbors.backends.bruteforcenumpy import vector_distance
+from simpleneighbors.backends.vectors import VectorStore
 import pickle
 
 
@@ -14,58 +16,115 @@ class Sklearn(BaseBackend):
         return True
 
     def __init__(self, dims, metric):
-        self.items = []
+        self.items = VectorStore(dims, use_numpy=True)
         self.metric = metric
 
     def add_item(self, idx, vector):
-        self.items.append([float(d) for d in vector])
+        self.items.append(vector)
 
-    def build(self, n, params=None):
+    def add_items(self, start_idx, vectors):
+        self.items.extend(vectors)
+
+    def build(self, n, params=None, n_jobs=None):
         from sklearn.neighbors import NearestNeighbors
-        from sklearn.preprocessing import normalize
-        import numpy as np
-        data = np.array(self.items)
-        if self.metric == 'angular':
-            data = normalize(data, norm='l2')
-            metric = 'minkowski'  # equivalent to euclidean
-        else:
-            metric = self.metric
-        if params is None:
-            params = {}
+        params = dict(params or {})
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        if n_jobs is not None:
+            params.setdefault('n_jobs', n_jobs)
+        params.setdefault('algorithm', 'auto')
         self.nn = NearestNeighbors(
-                algorithm='auto',
                 leaf_size=n,
-                metric=metric,
-                n_jobs=-1,
+                metric='minkowski' if self.metric == 'angular' else
+                self.metric,  # minkowski is equivalent to euclidean
                 **params)
+        self._fit()
+
+    def _fit(self):
+        from sklearn.preprocessing import normalize
+        data = self.items.matrix()
+        if self.metric == 'angular':
+            data = normalize(data, norm='l2')
+        # (with the brute-force algorithm, NearestNeighbors keeps a
+        # reference to the data rather than a copy)
         self.nn.fit(data)
 
-    def get_nns_by_vector(self, vec, n):
-        indices = self.nn.kneighbors([vec], n, return_distance=False)
-        return [item for item in indices[0]]
+    def get_nns_by_vector(self, vec, n, include_distances=False,
+                          search_k=None):
+        return self.get_nns_by_vectors([vec], n, include_distances)[0]
 
-    def get_distance(self, a_idx, b_idx):
-        from sklearn.neighbors import DistanceMetric
+    def get_nns_by_vectors(self, vecs, n, include_distances=False,
+                           search_k=None):
         from sklearn.preprocessing import normalize
         import numpy as np
-        X = np.array([self.items[a_idx], self.items[b_idx]])
+        queries = np.asarray(vecs, dtype=np.float64)
+        if not len(queries):
+            # (kneighbors() rejects an empty batch)
+            return []
         if self.metric == 'angular':
-            X = normalize(X, norm='l2')
-            metric = 'minkowski'
-        else:
-            metric = self.metric
-        dist = DistanceMetric.get_metric(metric)
-        return dist.pairwise(X)[0][1]
+            # the indexed data is normalized, so the queries must be too in
+            # order for the returned distances to be angular distances
+            queries = normalize(queries, norm='l2')
+        if not include_distances:
+            indices = self.nn.kneighbors(queries, n, return_distance=False)
+            return [[int(item) for item in row] for row in indices]
+        distances, indices = self.nn.kneighbors(
+                queries, n, return_distance=True)
+        return [([int(item) for item in idx_row],
+                 [float(d) for d in dist_row])
+                for idx_row, dist_row in zip(indices, distances)]
+
+    def get_distance(self, a_idx, b_idx):
+        import numpy as np
+        a = self.items.row(a_idx).astype(np.float64)
+        b = self.items.row(b_idx).astype(np.float64)
+        if self.metric in ('angular', 'euclidean'):
+            return vector_distance(self.metric, a, b)
+        from sklearn.metrics import pairwise_distances
+        return float(pairwise_distances([a], [b], metric=self.metric)[0][0])
 
     def get_item_vector(self, idx):
-        return self.items[idx]
+        return self.items.get(idx)
 
     def save(self, fname):
+        """
+        Saves the item vectors as a float32 Numpy array in ``<fname>.npy``,
+        and the parameters of the ``NearestNeighbors`` object as a pickle in
+        ``fname``. (The fitted object isn't pickled, since it holds another
+        copy of the vectors.)
+        """
+        import numpy as np
+        np.save(fname + ".npy", self.items.matrix())
         with open(fname, "wb") as fh:
-            pickle.dump((self.items, self.nn), fh)
+            pickle.dump({'params': self.nn.get_params()}, fh)
 
     def load(self, fname):
+        """
+        Memory-maps the saved vectors and fits a ``NearestNeighbors`` object
+        to them. With the brute-force algorithm (which scikit-learn chooses
+        for high-dimensional data), fitting is instant and the vectors
+        aren't copied, so they're read from disk as they're needed and
+        shared between processes. (The angular metric needs a normalized
+        copy of the vectors, and tree algorithms rebuild their trees.)
+        """
+        import numpy as np
+        from sklearn.neighbors import NearestNeighbors
         with open(fname, "rb") as fh:
             obj = pickle.load(fh)
-        self.items = obj[0]
-        self.nn = obj[1]
+        if isinstance(obj, tuple):
+            # index saved by an older version, with vectors in the pickle
+            self.items = VectorStore.from_array(
+                    np.asarray(obj[0], dtype=np.float32))
+            self.nn = obj[1]
+        elif isinstance(obj, NearestNeighbors):
+            # index saved by an older version, with the fitted object
+            self.items = VectorStore.from_array(
+                    np.load(fname + ".npy", mmap_mode='r'))
+            self.nn = obj
+        else:
+            self.items = VectorStore.from_array(
+                    np.load(fname + ".npy", mmap_mode='r'))
+            self.nn = NearestNeighbors(**obj['params'])
+            self._fit()
+        if self.n_jobs is not None:
+            self.nn.n_jobs = self.n_jobs
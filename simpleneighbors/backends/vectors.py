@@ -0,0 +1,184 @@
+from array import array
+import struct
+
+# size of the .npy header written by on-disk stores; fixed, so that the
+# header can be rewritten in place with the final shape
+NPY_HEADER_LEN = 128
+
+
+def npy_header(shape):
+    """Returns a version 1.0 ``.npy`` header for a float32 array with the
+    given shape, padded to exactly :data:`NPY_HEADER_LEN` bytes."""
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': %r, }" % (
+            tuple(int(d) for d in shape),)
+    header = header.ljust(NPY_HEADER_LEN - 11) + "\n"
+    return (b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+            header.encode('latin1'))
+
+
+def numpy_available():
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class VectorStore:
+    """Growable, contiguous float32 storage for item vectors.
+
+    Vectors are appended in place to a preallocated buffer (a Numpy array if
+    Numpy is installed, otherwise an ``array('f')``), which grows
+    geometrically as needed. This takes four bytes per dimension, rather than
+    the 24 or more needed to store each dimension as a Python float in a list
+    or tuple, and (with Numpy) :meth:`matrix` returns the stored vectors
+    without copying them.
+
+    If ``path`` is given, the buffer is instead a memory-mapped ``.npy`` file,
+    which grows on disk as vectors are added; call :meth:`close` when you're
+    done adding vectors to write out the final file.
+
+    :param dims: the number of dimensions in each vector
+    :param use_numpy: store vectors in a Numpy array (default: only if Numpy
+        is installed)
+    :param path: store vectors in a memory-mapped ``.npy`` file at this path
+    """
+
+    def __init__(self, dims, use_numpy=None, capacity=16, path=None):
+        if use_numpy is None:
+            use_numpy = numpy_available()
+        self.dims = dims
+        self.use_numpy = use_numpy or path is not None
+        self.path = path
+        self.n = 0
+        if path is not None:
+            with open(path, "wb") as fh:
+                fh.write(npy_header((0, dims)))
+            self.buf = None
+            self._map(capacity)
+        elif use_numpy:
+            import numpy as np
+            self.buf = np.empty((capacity, dims), dtype=np.float32)
+        else:
+            self.buf = array('f')
+
+    @classmethod
+    def from_array(cls, arr):
+        """Wraps an existing (possibly memory-mapped) 2D Numpy array.
+
+        :param arr: array of shape (number of items, dims)
+        :returns: a new VectorStore using ``arr`` as its buffer
+        """
+        store = cls(arr.shape[1], use_numpy=True, capacity=0)
+        store.buf = arr
+        store.n = arr.shape[0]
+        return store
+
+    def __len__(self):
+        return self.n
+
+    def _map(self, capacity):
+        import numpy as np
+        if self.buf is not None:
+            self.buf.flush()
+            self.buf = None
+        with open(self.path, "r+b") as fh:
+            fh.truncate(NPY_HEADER_LEN + capacity * self.dims * 4)
+        self.buf = np.memmap(self.path, dtype=np.float32, mode='r+',
+                             offset=NPY_HEADER_LEN,
+                             shape=(capacity, self.dims))
+
+    def _reserve(self, count):
+        import numpy as np
+        needed = self.n + count
+        if needed <= self.buf.shape[0]:
+            return
+        capacity = max(needed, 2 * self.buf.shape[0], 16)
+        if self.path is not None:
+            self._map(capacity)
+            return
+        buf = np.empty((capacity, self.dims), dtype=np.float32)
+        buf[:self.n] = self.buf[:self.n]
+        self.buf = buf
+
+    def close(self):
+        """Finishes writing an on-disk store.
+
+        Trims the file to the vectors actually added and writes its final
+        header, then reopens it read-only. (Does nothing for in-memory
+        stores.)
+        """
+        import numpy as np
+        if self.path is None:
+            return
+        self.buf.flush()
+        self.buf = None
+        with open(self.path, "r+b") as fh:
+            fh.write(npy_header((self.n, self.dims)))
+            fh.truncate(NPY_HEADER_LEN + self.n * self.dims * 4)
+        # (an empty file can't be memory-mapped)
+        self.buf = np.load(self.path, mmap_mode='r' if self.n else None)
+        self.path = None
+
+    def append(self, vector):
+        if self.use_numpy:
+            import numpy as np
+            vector = np.asarray(vector, dtype=np.float32)
+            # (assigning to a row would broadcast a vector of the wrong shape)
+            if vector.shape != (self.dims,):
+                raise ValueError("expected a vector with %d dimensions" %
+                                 self.dims)
+            self._reserve(1)
+            self.buf[self.n] = vector
+        else:
+            start = len(self.buf)
+            self.buf.extend(float(d) for d in vector)
+            if len(self.buf) - start != self.dims:
+                del self.buf[start:]
+                raise ValueError("expected a vector with %d dimensions" %
+                                 self.dims)
+        self.n += 1
+
+    def extend(self, vectors):
+        """Appends a block of vectors at once.
+
+        :param vectors: a 2D array (or a sequence of vectors)
+        """
+        if self.use_numpy:
+            import numpy as np
+            block = np.asarray(vectors, dtype=np.float32)
+            if block.ndim != 2 or block.shape[1] != self.dims:
+                raise ValueError("expected an array with shape (n, %d)" %
+                                 self.dims)
+            self._reserve(block.shape[0])
+            self.buf[self.n:self.n + block.shape[0]] = block
+            self.n += block.shape[0]
+        else:
+            for vector in vectors:
+                self.append(vector)
+
+    def row(self, idx):
+        """Returns the vector at ``idx`` as a view (or, without Numpy, as an
+        ``array('f')`` slice)."""
+        if not 0 <= idx < self.n:
+            raise IndexError("vector index out of range")
+        if self.use_numpy:
+            return self.buf[idx]
+        return self.buf[idx * self.dims:(idx + 1) * self.dims]
+
+    def get(self, idx):
+        """Returns the vector at ``idx`` as a list of floats."""
+        return [float(d) for d in self.row(idx)]
+
+    def matrix(self):
+        """Returns the stored vectors as a 2D float32 Numpy array.
+
+        With Numpy storage, this is a view on the buffer, not a copy. (An
+        ``array('f')`` buffer is copied, since a view would prevent the array
+        from growing any further.)
+        """
+        import numpy as np
+        if self.use_numpy:
+            return self.buf[:self.n]
+        return np.array(self.buf, dtype=np.float32).reshape(
+                self.n, self.dims)
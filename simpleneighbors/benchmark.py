@@ -1,27 +1,263 @@
+"""Benchmarks for SimpleNeighbors backends.
+
+Each benchmark run builds an index of random data with one backend and
+measures:
+
+* ``ingest_sec``: time to add the items to the index;
+* ``build_sec``: time to build the index;
+* ``latency_ms_p50``, ``_p95``, ``_p99``: latency of single
+  :func:`~simpleneighbors.SimpleNeighbors.nearest` queries;
+* ``batch_ms_p50``, ``_p95``, ``_p99``: latency of batches of queries made
+  with :func:`~simpleneighbors.SimpleNeighbors.nearest_many`, and
+  ``batch_qps``, the number of queries answered per second in batches;
+* ``threaded_qps``: queries per second with several threads querying the
+  same index at once;
+* ``recall``: recall@k of the results, compared to an exact search;
+* ``index_bytes``: size of the saved index on disk, and ``load_sec``, the
+  time to load it;
+* ``peak_rss_kb``: the peak resident memory of the process that ran the
+  benchmark (each run gets its own process, unless ``isolate`` is false).
+
+Run this module as a script to benchmark every available backend over a
+grid of settings, writing the results as JSON and/or CSV::
+
+    python -m simpleneighbors.benchmark --n 10000 100000 --dims 100 300 \\
+        --build-n 10 50 --json results.json --csv results.csv
+"""
+
+import csv
+import json
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
 from simpleneighbors import SimpleNeighbors
-from simpleneighbors.backends import available
+from simpleneighbors.backends import available, BruteForceNumpy, HNSW
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    # python 2
+    _timer = time.time
 
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 
-def benchmark(n=10000, dims=300, query_count=10, metric='angular'):
+FIELDS = [
+    'backend', 'n', 'dims', 'metric', 'build_n', 'k', 'query_count',
+    'ingest_sec', 'build_sec',
+    'latency_ms_p50', 'latency_ms_p95', 'latency_ms_p99',
+    'batch_size', 'batch_ms_p50', 'batch_ms_p95', 'batch_ms_p99',
+    'batch_qps', 'threads', 'threaded_qps', 'recall',
+    'index_bytes', 'load_sec', 'peak_rss_kb']
+
+
+def peak_rss_kb():
+    """Returns the peak resident memory of this process in kilobytes, or
+    ``None`` if it can't be measured."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname()[0] == 'Darwin':
+        # macOS reports bytes, everything else kilobytes
+        rss //= 1024
+    return rss
+
+
+def percentiles(latencies, prefix):
+    """Returns a dictionary with the 50th, 95th and 99th percentiles of a
+    list of latencies (in seconds), in milliseconds."""
     import numpy as np
-    from time import time
-    data = np.random.randn(n, dims)
-    for backend in available():
-        start = time()
-        print("benchmarking", backend, "at", start)
-        sim = SimpleNeighbors(dims, metric, backend=backend)
-        labels = list(range(n))
-        print("feeding data")
-        sim.feed(zip(labels, data))
-        print("building index")
-        sim.build(50)
-        to_build = time()
-        print("querying")
-        for i in range(query_count):
-            sim.nearest(np.random.randn(dims))
-        nearest_query = time()
-        print(backend, "%0.2f sec to build, %0.2f sec to query %d items" %
-              (to_build - start, nearest_query - start, query_count))
+    values = np.percentile(np.asarray(latencies) * 1000.0, [50, 95, 99])
+    return dict(('%s_p%d' % (prefix, q), float(value))
+                for q, value in zip((50, 95, 99), values))
+
+
+def recall(found, expected):
+    """Returns the mean fraction of the expected results that were found.
+
+    :param found: a list with one list of results per query
+    :param expected: a list with one list of exact results per query
+    :returns: recall as a float between 0 and 1
+    """
+    total = sum(len(set(row) & set(exact))
+                for row, exact in zip(found, expected))
+    return total / float(sum(len(exact) for exact in expected) or 1)
+
+
+def _index_bytes(prefix):
+    dirname, basename = os.path.split(prefix)
+    return sum(os.path.getsize(os.path.join(dirname, fname))
+               for fname in os.listdir(dirname)
+               if fname.startswith(basename))
+
+
+def run_one(backend, n=10000, dims=128, metric='angular', build_n=50,
+            query_count=100, k=10, batch_size=32, threads=4, seed=0,
+            workdir=None):
+    """Benchmarks one backend with one set of parameters.
+
+    :param backend: the backend class to benchmark
+    :param n: number of random data items to generate
+    :param dims: number of dimensions in random data
+    :param metric: the distance metric to use
+    :param build_n: value passed to ``build()``
+    :param query_count: number of queries to perform
+    :param k: number of results to ask for in each query
+    :param batch_size: number of queries in each batch
+    :param threads: number of threads for the threaded queries
+    :param seed: random seed for the data and queries
+    :param workdir: directory to save the index in (default: a temporary
+        directory)
+    :returns: a dictionary of results (see :data:`FIELDS`)
+    """
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    data = rng.randn(n, dims).astype(np.float32)
+    queries = rng.randn(query_count, dims).astype(np.float32)
+    labels = list(range(n))
+    result = {'backend': backend.__name__, 'n': n, 'dims': dims,
+              'metric': metric, 'build_n': build_n, 'k': k,
+              'query_count': query_count, 'batch_size': batch_size,
+              'threads': threads}
+
+    start = _timer()
+    sim = SimpleNeighbors(dims, metric, backend=backend)
+    sim.feed_arrays(labels, data)
+    result['ingest_sec'] = _timer() - start
+    start = _timer()
+    sim.build(build_n)
+    result['build_sec'] = _timer() - start
+
+    latencies = []
+    found = []
+    for query in queries:
+        start = _timer()
+        found.append(sim.nearest(query, k))
+        latencies.append(_timer() - start)
+    result.update(percentiles(latencies, 'latency_ms'))
+
+    latencies = []
+    batch_start = _timer()
+    for offset in range(0, query_count, batch_size):
+        start = _timer()
+        sim.nearest_many(queries[offset:offset + batch_size], k)
+        latencies.append(_timer() - start)
+    result['batch_qps'] = query_count / (_timer() - batch_start)
+    result.update(percentiles(latencies, 'batch_ms'))
+
+    pool = ThreadPool(threads)
+    try:
+        start = _timer()
+        pool.map(lambda query: sim.nearest(query, k), queries)
+        result['threaded_qps'] = query_count / (_timer() - start)
+    finally:
+        pool.close()
+
+    if backend is BruteForceNumpy:
+        result['recall'] = 1.0
+    else:
+        exact = SimpleNeighbors(dims, metric, backend=BruteForceNumpy)
+        exact.feed_arrays(labels, data)
+        exact.build()
+        result['recall'] = recall(found, exact.nearest_many(queries, k))
+
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(workdir, 'benchmark-%s' % backend.__name__)
+        sim.save(prefix)
+        result['index_bytes'] = _index_bytes(prefix)
+        start = _timer()
+        SimpleNeighbors.load(prefix)
+        result['load_sec'] = _timer() - start
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+
+def _run_one(kwargs):
+    return run_one(**kwargs)
+
+
+def benchmark(n=10000, dims=300, query_count=10, metric='angular',
+              build_n=50, backends=None, isolate=True, **kwargs):
+    """Benchmarks each backend over a grid of parameters.
+
+    Each of ``n``, ``dims``, ``metric`` and ``build_n`` can be a single
+    value or a list of values; every combination of values is benchmarked
+    with each backend. Unless ``isolate`` is false, each run happens in a
+    separate process, so that its peak memory use can be measured on its
+    own. Other keyword arguments are passed to :func:`run_one`.
+
+    :param n: number(s) of random data items to generate
+    :param dims: number(s) of dimensions in random data
+    :param query_count: number of queries to perform
+    :param metric: distance metric(s) to use
+    :param build_n: value(s) passed to ``build()``
+    :param backends: backend classes to benchmark (default: all available,
+        except :class:`~simpleneighbors.backends.HNSW`)
+    :param isolate: run each benchmark in its own process
+    :returns: a list of result dictionaries
+    """
+    def values(value):
+        return value if isinstance(value, (list, tuple)) else [value]
+    if backends is None:
+        backends = available()
+    results = []
+    for backend in backends:
+        for n_ in values(n):
+            for dims_ in values(dims):
+                for metric_ in values(metric):
+                    for build_n_ in values(build_n):
+                        args = dict(kwargs, backend=backend, n=n_,
+                                    dims=dims_, metric=metric_,
+                                    build_n=build_n_,
+                                    query_count=query_count)
+                        print("benchmarking %s (n=%d, dims=%d, metric=%s, "
+                              "build_n=%d)" % (backend.__name__, n_, dims_,
+                                               metric_, build_n_))
+                        if isolate:
+                            pool = Pool(1)
+                            try:
+                                result = pool.apply(_run_one, (args,))
+                            finally:
+                                pool.close()
+                                pool.join()
+                        else:
+                            result = run_one(**args)
+                        print("  build %0.2f sec, p50 %0.3f ms, "
+                              "recall@%d %0.3f" % (
+                                  result['build_sec'],
+                                  result['latency_ms_p50'], result['k'],
+                                  result['recall']))
+                        results.append(result)
+    return results
+
+
+def write_json(results, path):
+    """Writes benchmark results to a JSON file."""
+    with open(path, "w") as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+
+
+def write_csv(results, path):
+    """Writes benchmark results to a CSV file, one row per run."""
+    with open(path, "w") as fh:
+        writer = csv.DictWriter(fh, fieldnames=FIELDS)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
 
 
 if __name__ == '__main__':
@@ -32,17 +268,72 @@ if __name__ == '__main__':
     parser.add_argument(
             "--n",
             type=int,
-            default=10000,
-            help='number of random data items to generate')
+            nargs='+',
+            default=[10000],
+            help='number(s) of random data items to generate')
     parser.add_argument(
             "--dims",
             type=int,
-            default=128,
-            help='number of dimensions in random data')
+            nargs='+',
+            default=[128],
+            help='number(s) of dimensions in random data')
+    parser.add_argument(
+            "--metric",
+            nargs='+',
+            default=['angular'],
+            help='distance metric(s) to use')
+    parser.add_argument(
+            "--build-n",
+            type=int,
+            nargs='+',
+            default=[50],
+            help='value(s) to pass to build() (e.g., number of Annoy trees)')
+    parser.add_argument(
+            "--backend",
+            nargs='+',
+            help='names of backends to benchmark (default: all available '
+                 'except HNSW)')
     parser.add_argument(
             "--query-count",
             type=int,
-            default=10,
+            default=100,
             help='number of queries to perform')
+    parser.add_argument(
+            "--k",
+            type=int,
+            default=10,
+            help='number of results to ask for in each query')
+    parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=32,
+            help='number of queries in each batch')
+    parser.add_argument(
+            "--threads",
+            type=int,
+            default=4,
+            help='number of threads for threaded queries')
+    parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help='random seed')
+    parser.add_argument(
+            "--json",
+            help='file to write results to as JSON')
+    parser.add_argument(
+            "--csv",
+            help='file to write results to as CSV')
     args = parser.parse_args()
-    benchmark(args.n, args.dims, args.query_count)
+    backends = available()
+    if args.backend:
+        backends = [backend for backend in backends + [HNSW]
+                    if backend.__name__ in args.backend]
+    results = benchmark(args.n, args.dims, args.query_count, args.metric,
+                        args.build_n, backends=backends, k=args.k,
+                        batch_size=args.batch_size, threads=args.threads,
+                        seed=args.seed)
+    if args.json:
+        write_json(results, args.json)
+    if args.csv:
+        write_csv(results, args.csv)
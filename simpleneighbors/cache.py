@@ -0,0 +1,99 @@
+"""A small LRU cache for query results, with optional expiry."""
+
+from array import array
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+try:
+    _now = time.monotonic
+except AttributeError:
+    # python 2
+    _now = time.time
+
+
+def vector_digest(vec):
+    """Returns a short digest identifying a vector's values.
+
+    :param vec: a sequence of numbers
+    :returns: a 16-byte digest
+    """
+    values = array('d', [float(d) for d in vec])
+    try:
+        data = values.tobytes()
+    except AttributeError:
+        # python 2
+        data = values.tostring()
+    return hashlib.md5(data).digest()
+
+
+class QueryCache:
+    """A bounded, thread-safe LRU cache.
+
+    When the cache holds ``maxsize`` entries, adding another evicts the least
+    recently used one. If ``ttl`` is given, entries also expire that many
+    seconds after they were added.
+
+    :param maxsize: maximum number of entries
+    :param ttl: seconds after which an entry expires (default: never)
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Looks up a key.
+
+        :param key: key to look up
+        :returns: ``(True, value)`` if the key is cached, otherwise
+            ``(False, None)``
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and _now() - entry[1] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            # move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, value):
+        """Adds a value to the cache, evicting old entries as needed.
+
+        :param key: key for the value
+        :param value: value to cache
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, _now())
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries (but keeps the hit and miss counts)."""
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        """Returns a dictionary with the cache's hit and miss counts, current
+        size, maximum size and time-to-live."""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+            }
@@ -0,0 +1,199 @@
+"""Compact on-disk storage for the items in an index.
+
+The compact format stores each item as a separate pickle in a single blob
+file, along with Numpy arrays of blob offsets and of item lookup keys. When
+loaded, the blob file and the arrays are memory-mapped rather than read into
+memory, so loading is fast regardless of the size of the corpus, and processes
+that load the same files (e.g., forked workers) share the same pages.
+
+Items are looked up by the contents of their pickles, so an item will only
+be found if it pickles to the same bytes as the item that was added (e.g.,
+``1`` and ``1.0`` are different items for the purposes of lookup).
+"""
+
+import hashlib
+import mmap
+import pickle
+import shutil
+
+# protocol 2 is the newest protocol that every supported Python version can
+# read; it also keeps the pickled representation of an item stable, which
+# lookups depend on
+PICKLE_PROTOCOL = 2
+
+
+def _key(blob):
+    return int(hashlib.md5(blob).hexdigest()[:16], 16)
+
+
+def _fnames(prefix):
+    return {
+        'blobs': prefix + "-corpus.bin",
+        'offsets': prefix + "-corpus-offsets.npy",
+        'keys': prefix + "-corpus-keys.npy",
+        'order': prefix + "-corpus-order.npy",
+    }
+
+
+class CorpusWriter:
+    """Writes items to disk in the compact corpus format.
+
+    Items are written to the blob file as they're appended; the offset and
+    lookup arrays are written when :meth:`close` is called.
+
+    :param prefix: filename prefix for the corpus files
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.fnames = _fnames(prefix)
+        self.fh = open(self.fnames['blobs'], "wb")
+        # (lists rather than arrays, since Python 2 has no array('Q'))
+        self.offsets = [0]
+        self.keys = []
+
+    def append(self, item):
+        blob = pickle.dumps(item, protocol=PICKLE_PROTOCOL)
+        self.fh.write(blob)
+        self.offsets.append(self.offsets[-1] + len(blob))
+        self.keys.append(_key(blob))
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        import numpy as np
+        self.fh.close()
+        keys = np.array(self.keys, dtype=np.uint64)
+        # stable sort, so that items added more than once can be resolved to
+        # the last copy added (the same behavior as a dict)
+        order = np.argsort(keys, kind='stable')
+        np.save(self.fnames['offsets'],
+                np.array(self.offsets, dtype=np.uint64))
+        np.save(self.fnames['keys'], keys[order])
+        np.save(self.fnames['order'], order.astype(np.int64))
+
+
+def write_corpus(prefix, items):
+    """Writes a sequence of items to disk in the compact corpus format.
+
+    :param prefix: filename prefix for the corpus files
+    :param items: sequence of items
+    :returns: None
+    """
+    writer = CorpusWriter(prefix)
+    writer.extend(items)
+    writer.close()
+
+
+class MappedCorpus:
+    """A read-only, memory-mapped sequence of items.
+
+    This class reads files written by :class:`CorpusWriter` and supports the
+    same operations as the list of items in a
+    :class:`~simpleneighbors.SimpleNeighbors` object (indexing, iteration and
+    ``len()``). Its :attr:`id_map` attribute stands in for the dictionary
+    mapping items to their indices.
+
+    :param prefix: filename prefix for the corpus files
+    """
+
+    def __init__(self, prefix):
+        import numpy as np
+        self.prefix = prefix
+        self.fnames = _fnames(prefix)
+        self.offsets = np.load(self.fnames['offsets'], mmap_mode='r')
+        self.keys = np.load(self.fnames['keys'], mmap_mode='r')
+        self.order = np.load(self.fnames['order'], mmap_mode='r')
+        with open(self.fnames['blobs'], "rb") as fh:
+            if self.offsets[-1] > 0:
+                self.blobs = mmap.mmap(
+                        fh.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.blobs = b''
+        self.id_map = MappedIdMap(self)
+
+    def _blob(self, idx):
+        return self.blobs[int(self.offsets[idx]):int(self.offsets[idx + 1])]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("corpus index out of range")
+        return pickle.loads(self._blob(idx))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def copy_to(self, prefix):
+        """Copies the corpus files to a new filename prefix.
+
+        :param prefix: filename prefix for the copies
+        :returns: None
+        """
+        fnames = _fnames(prefix)
+        for kind, fname in self.fnames.items():
+            shutil.copyfile(fname, fnames[kind])
+
+    def index_of(self, item):
+        """Returns the index of the last copy of ``item`` added to the corpus.
+
+        :param item: item to look up
+        :returns: the index of the item
+        :raises KeyError: if the item isn't in the corpus
+        """
+        import numpy as np
+        blob = pickle.dumps(item, protocol=PICKLE_PROTOCOL)
+        key = np.uint64(_key(blob))
+        lo = np.searchsorted(self.keys, key, side='left')
+        hi = np.searchsorted(self.keys, key, side='right')
+        for pos in range(hi - 1, lo - 1, -1):
+            idx = int(self.order[pos])
+            if self._blob(idx) == blob:
+                return idx
+        raise KeyError(item)
+
+
+class MappedIdMap:
+    """Read-only mapping from items to indices for a :class:`MappedCorpus`.
+    """
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __getitem__(self, item):
+        return self.corpus.index_of(item)
+
+    def __contains__(self, item):
+        try:
+            self.corpus.index_of(item)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, item, default=None):
+        try:
+            return self.corpus.index_of(item)
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        seen = set()
+        for item in self.corpus:
+            if item not in seen:
+                seen.add(item)
+                yield item
+
+    def __len__(self):
+        return sum(1 for item in self)
@@ -0,0 +1,142 @@
+"""Readers for common on-disk embedding formats.
+
+Each reader yields ``(labels, matrix)`` chunks, where ``labels`` is a list of
+items and ``matrix`` is a 2D float32 Numpy array with one row per item. Only
+one chunk is held in memory at a time, so files larger than available memory
+can be streamed into an index with
+:func:`~simpleneighbors.SimpleNeighbors.feed_arrays`. (See also the
+``from_*`` class methods on :class:`~simpleneighbors.SimpleNeighbors`, which
+use these readers.) The readers require Numpy.
+"""
+
+import io
+
+
+def _limited(count, chunk_size, limit):
+    if limit is None:
+        return chunk_size
+    return min(chunk_size, limit - count)
+
+
+def read_glove_text(path, dims=None, chunk_size=10000, limit=None,
+                    encoding='utf8'):
+    """Reads vectors from a text file in GloVe (or word2vec text) format.
+
+    Each line in the file should have a label followed by the components of
+    its vector, separated by spaces. If the first line consists of just two
+    integers (the header of the word2vec text format), it's skipped. If
+    ``dims`` isn't given, it's inferred from the first line of data; giving it
+    explicitly allows labels that contain spaces.
+
+    :param path: path to the text file
+    :param dims: number of dimensions in each vector
+    :param chunk_size: number of rows to yield at a time
+    :param limit: maximum number of rows to read
+    :param encoding: text encoding of the file
+    :returns: a generator yielding ``(labels, matrix)`` chunks
+    """
+    import numpy as np
+    count = 0
+    labels, rows = [], []
+    with io.open(path, encoding=encoding) as fh:
+        for lineno, line in enumerate(fh):
+            if limit is not None and count + len(rows) >= limit:
+                break
+            if not line.strip():
+                continue
+            parts = line.rstrip().split(" ")
+            if lineno == 0 and len(parts) == 2 and \
+                    all(part.isdigit() for part in parts):
+                continue
+            if dims is None:
+                dims = len(parts) - 1
+            if len(parts) < dims + 1:
+                raise ValueError("line %d has fewer than %d dimensions" %
+                                 (lineno + 1, dims))
+            labels.append(" ".join(parts[:-dims]))
+            rows.append(parts[-dims:])
+            if len(rows) == _limited(count, chunk_size, limit):
+                yield labels, np.array(rows, dtype=np.float32)
+                count += len(rows)
+                labels, rows = [], []
+    if rows:
+        yield labels, np.array(rows, dtype=np.float32)
+
+
+def _read_label(fh):
+    # labels end at the first space; the newline that (optionally) ends the
+    # previous vector ends up at the start of the label
+    parts = []
+    while True:
+        buf = fh.peek(64)
+        if not buf:
+            raise ValueError("unexpected end of file")
+        pos = buf.find(b' ')
+        if pos >= 0:
+            parts.append(fh.read(pos))
+            fh.read(1)
+            return b''.join(parts).lstrip(b'\n')
+        parts.append(fh.read(len(buf)))
+
+
+def read_word2vec_binary(path, chunk_size=10000, limit=None,
+                         encoding='utf8'):
+    """Reads vectors from a file in word2vec's binary format.
+
+    The file begins with a line giving the number of vectors and the number of
+    dimensions; each vector follows as a label, a space, and the vector's
+    components as little-endian 32-bit floats.
+
+    :param path: path to the binary file
+    :param chunk_size: number of rows to yield at a time
+    :param limit: maximum number of rows to read
+    :param encoding: text encoding of the labels
+    :returns: a generator yielding ``(labels, matrix)`` chunks
+    """
+    import numpy as np
+    dtype = np.dtype('<f4')
+    with io.open(path, 'rb') as fh:
+        total, dims = (int(x) for x in fh.readline().split())
+        if limit is not None:
+            total = min(total, limit)
+        count = 0
+        while count < total:
+            size = min(chunk_size, total - count)
+            labels = []
+            matrix = np.empty((size, dims), dtype=np.float32)
+            for i in range(size):
+                labels.append(_read_label(fh).decode(encoding))
+                matrix[i] = np.frombuffer(
+                        fh.read(dtype.itemsize * dims), dtype=dtype)
+            count += size
+            yield labels, matrix
+
+
+def read_npy(path, labels=None, chunk_size=10000, limit=None):
+    """Reads vectors from a 2D array saved with ``numpy.save()``.
+
+    The array is memory-mapped, so only the chunk being read is in memory at
+    any one time. If ``labels`` is not given, each row's label is its index in
+    the array.
+
+    :param path: path to the ``.npy`` file
+    :param labels: sequence (e.g., a list) of labels, one per row of the
+        array
+    :param chunk_size: number of rows to yield at a time
+    :param limit: maximum number of rows to read
+    :returns: a generator yielding ``(labels, matrix)`` chunks
+    """
+    import numpy as np
+    data = np.load(path, mmap_mode='r')
+    if data.ndim != 2:
+        raise ValueError("expected a 2D array, got shape %r" % (data.shape,))
+    total = data.shape[0] if limit is None else min(data.shape[0], limit)
+    if labels is not None and len(labels) < total:
+        raise ValueError("got %d labels for %d rows" % (len(labels), total))
+    for start in range(0, total, chunk_size):
+        stop = min(start + chunk_size, total)
+        if labels is None:
+            chunk_labels = list(range(start, stop))
+        else:
+            chunk_labels = list(labels[start:stop])
+        yield chunk_labels, np.asarray(data[start:stop], dtype=np.float32)
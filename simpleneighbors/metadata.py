@@ -0,0 +1,99 @@
+"""Attribute indexes for filtering nearest neighbor searches.
+
+Items can be added to an index along with a dictionary of metadata (e.g.,
+``{'lang': 'en', 'year': 2019}``). When the index is built, the metadata is
+turned into a :class:`MetadataIndex`, which maps each attribute value to the
+(integer) ids of the items having that value. Searches can then be limited to
+items matching a filter, like ``{'lang': 'en'}``, without calling a Python
+function on every candidate item.
+
+A filter is a dictionary mapping attribute names to conditions. An item
+matches the filter if it matches every condition. A condition can be:
+
+* a single value, which the attribute must equal;
+* a ``set``, ``frozenset`` or ``list`` of values, one of which the attribute
+  must equal;
+* a :class:`Range`, which the attribute's value must fall within.
+"""
+
+from array import array
+from collections import namedtuple
+
+
+class Range(namedtuple('Range', ['lo', 'hi'])):
+    """A condition matching attribute values between ``lo`` and ``hi``
+    (inclusive). Either bound can be ``None``, meaning unbounded.
+
+        >>> from simpleneighbors.metadata import Range
+        >>> 2015 in Range(2010, 2019)
+        True
+        >>> 'b' in Range(lo='c')
+        False
+    """
+
+    def __new__(cls, lo=None, hi=None):
+        return super(Range, cls).__new__(cls, lo, hi)
+
+    def __contains__(self, value):
+        try:
+            return ((self.lo is None or value >= self.lo) and
+                    (self.hi is None or value <= self.hi))
+        except TypeError:
+            # values of other types don't fall in the range
+            return False
+
+
+class MetadataIndex:
+    """Maps attribute values to the ids of the items that have them.
+
+    :param metadata: dictionary mapping item ids to metadata dictionaries
+    """
+
+    def __init__(self, metadata):
+        self.postings = {}
+        for idx in sorted(metadata):
+            self.add(idx, metadata[idx])
+
+    def add(self, idx, metadata):
+        """Adds an item's metadata to the index.
+
+        :param idx: the item's id
+        :param metadata: dictionary of metadata about the item
+        """
+        for attr, value in metadata.items():
+            ids = self.postings.setdefault(attr, {}).setdefault(
+                    value, array('l'))
+            ids.append(idx)
+
+    def __len__(self):
+        return len(self.postings)
+
+    def _matching(self, attr, condition):
+        values = self.postings.get(attr, {})
+        if isinstance(condition, Range):
+            keys = [value for value in values if value in condition]
+        elif isinstance(condition, (set, frozenset, list)):
+            keys = [value for value in condition if value in values]
+        else:
+            keys = [condition] if condition in values else []
+        ids = set()
+        for key in keys:
+            ids.update(values[key])
+        return ids
+
+    def select(self, where):
+        """Returns the ids of the items matching a filter.
+
+        :param where: dictionary mapping attribute names to conditions
+        :returns: a sorted list of item ids
+        """
+        # start with the most selective condition, so that the intersections
+        # stay small
+        selected = sorted((self._matching(attr, condition)
+                           for attr, condition in where.items()), key=len)
+        if not selected:
+            return []
+        ids = selected[0]
+        for other in selected[1:]:
+            ids = ids & other
+        return sorted(ids)
@@ -0,0 +1,507 @@
+"""Indexes split across several shards.
+
+A :class:`ShardedSimpleNeighbors` object spreads its items over a number of
+:class:`~simpleneighbors.SimpleNeighbors` indexes (shards), each with its own
+backend. The shards are built in parallel, in separate processes, and
+queries are sent to every shard at once (in a pool of threads; the Annoy and
+Numpy-based backends release the GIL while they search) and the results
+merged by distance.
+"""
+
+from collections import namedtuple
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import select_best
+from simpleneighbors.backends.bruteforcepurepython import distance, norm_dist
+from simpleneighbors.backends.vectors import VectorStore
+from simpleneighbors.corpus import PICKLE_PROTOCOL, _key
+
+# the items added to one shard (or, with range routing, to the whole index)
+# before it's built: their vectors are kept in a contiguous float32 buffer,
+# rather than as a tuple of Python floats per item
+_Pending = namedtuple('_Pending', ['items', 'vectors', 'metadata'])
+
+
+def hash_route(item, shards):
+    """Returns the shard an item is assigned to by hashing its pickle.
+
+    :param item: the item
+    :param shards: the number of shards
+    :returns: a shard number
+    """
+    return _key(pickle.dumps(item, protocol=PICKLE_PROTOCOL)) % shards
+
+
+def _build_shard(args):
+    # runs in a worker process: builds one shard and saves it for the parent
+    prefix, dims, metric, backend, (items, matrix, metadata), n, params = args
+    if not items:
+        return None
+    sim = SimpleNeighbors(dims, metric, backend=backend)
+    sim.feed_arrays(items, matrix, metadata)
+    sim.build(n, params)
+    sim.save(prefix)
+    return prefix
+
+
+class ShardedSimpleNeighbors:
+    """A Simple Neighbors index split into shards.
+
+    This class has the same interface as
+    :class:`~simpleneighbors.SimpleNeighbors`, but stores its items in
+    ``shards`` separate indexes. With ``route='hash'`` (the default), each
+    item goes to a shard chosen by a hash of the item, so that items can be
+    looked up in a single shard; with ``route='range'``, the items are split
+    into contiguous blocks, in the order they were added, when the index is
+    built. (Shards that end up without any items aren't built, and are
+    skipped when querying.)
+
+    .. doctest::
+
+        >>> from simpleneighbors.sharded import ShardedSimpleNeighbors
+        >>> sim = ShardedSimpleNeighbors(2, shards=2, metric='euclidean')
+        >>> sim.feed([('a', (4, 5)),
+        ...     ('b', (0, 3)),
+        ...     ('c', (-2, 8)),
+        ...     ('d', (2, -2))])
+        >>> sim.build(processes=1)
+        >>> sim.nearest((1, -1), n=2)
+        ['d', 'b']
+
+    :param dims: the number of dimensions in your data
+    :param shards: the number of shards
+    :param metric: the distance metric to use
+    :param backend: the nearest neighbors backend to use for each shard
+    :param route: how to assign items to shards (``'hash'`` or ``'range'``)
+    """
+
+    def __init__(self, dims, shards=4, metric="angular", backend=None,
+                 route="hash"):
+        if route not in ('hash', 'range'):
+            raise ValueError("route must be 'hash' or 'range'")
+        if backend is None:
+            backend = select_best()
+        self.dims = dims
+        self.metric = metric
+        self.backend_class = backend
+        self.route = route
+        self.pending = [self._pending() for i in range(shards)]
+        self.shards = []
+        self.built = False
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    @property
+    def shard_count(self):
+        return len(self.pending)
+
+    def _pending(self):
+        return _Pending([], VectorStore(self.dims), [])
+
+    def _route(self, item):
+        if self.route == 'hash':
+            return hash_route(item, self.shard_count)
+        # split into blocks later, once the number of items is known
+        return 0
+
+    def add_one(self, item, vector, metadata=None):
+        """Adds an item to the index (see
+        :func:`~simpleneighbors.SimpleNeighbors.add_one`).
+
+        :param item: the item to add
+        :param vector: the vector corresponding to that item
+        :param metadata: dictionary of metadata about the item
+        :returns: None
+        """
+        assert self.built is False, "Index already built; can't add new items."
+        pending = self.pending[self._route(item)]
+        pending.vectors.append(vector)
+        pending.items.append(item)
+        pending.metadata.append(metadata)
+
+    def feed(self, items):
+        """Adds multiple items to the index (see
+        :func:`~simpleneighbors.SimpleNeighbors.feed`).
+
+        :param items: a list of ``(item, vector)`` tuples
+        :returns: None
+        """
+        for row in items:
+            self.add_one(*row)
+
+    def feed_arrays(self, items, matrix, metadata=None):
+        """Adds a block of items to the index, with vectors in a 2D array
+        (see :func:`~simpleneighbors.SimpleNeighbors.feed_arrays`). Each
+        shard's rows are copied into its buffer at once.
+
+        :param items: a sequence of items
+        :param matrix: a 2D array of vectors, one row for each item
+        :param metadata: a sequence of metadata dictionaries (or ``None``),
+            one for each item
+        :returns: None
+        """
+        assert self.built is False, "Index already built; can't add new items."
+        items = list(items)
+        metadata = [None] * len(items) if metadata is None \
+            else list(metadata)
+        try:
+            import numpy as np
+        except ImportError:
+            for row in zip(items, matrix, metadata):
+                self.add_one(*row)
+            return
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[1] != self.dims:
+            raise ValueError("expected an array with shape (n, %d)" %
+                             self.dims)
+        if not len(items) == len(matrix) == len(metadata):
+            raise ValueError("got %d items, %d vectors and %d metadata "
+                             "entries" % (len(items), len(matrix),
+                                          len(metadata)))
+        routes = np.array([self._route(item) for item in items],
+                          dtype=np.intp)
+        for shard, pending in enumerate(self.pending):
+            rows = np.nonzero(routes == shard)[0]
+            if not len(rows):
+                continue
+            pending.vectors.extend(matrix[rows])
+            pending.items.extend(items[row] for row in rows)
+            pending.metadata.extend(metadata[row] for row in rows)
+
+    def _block(self, pending, start, stop):
+        """Returns ``(items, matrix, metadata)`` for rows ``start:stop`` of
+        ``pending``."""
+        if pending.vectors.use_numpy:
+            matrix = pending.vectors.matrix()[start:stop]
+        else:
+            matrix = [pending.vectors.get(idx) for idx in range(start, stop)]
+        return (pending.items[start:stop], matrix,
+                pending.metadata[start:stop])
+
+    def _assignments(self):
+        """Returns the ``(items, matrix, metadata)`` for each shard."""
+        if self.route == 'hash':
+            return [self._block(pending, 0, len(pending.items))
+                    for pending in self.pending]
+        pending = self.pending[0]
+        count = self.shard_count
+        bounds = [len(pending.items) * k // count for k in range(count + 1)]
+        return [self._block(pending, bounds[k], bounds[k + 1])
+                for k in range(count)]
+
+    def build(self, n=10, params=None, processes=None, workdir=None):
+        """Builds every shard.
+
+        Each shard is built in a separate process (with at most
+        ``processes`` processes running at once; by default, one per CPU),
+        saved to a file in ``workdir`` and loaded back into this process. If
+        ``workdir`` isn't given, a temporary directory is used and removed
+        afterwards. With ``processes=1``, the shards are built one after
+        another in this process instead.
+
+        :param n: backend-dependent (see
+            :func:`~simpleneighbors.SimpleNeighbors.build`)
+        :param params: dictionary with extra parameters to pass to backend
+        :param processes: number of processes to build shards in
+        :param workdir: directory for the built shards' files
+        :returns: None
+        """
+        assignments = self._assignments()
+        if processes == 1:
+            self.shards = []
+            for items, matrix, metadata in assignments:
+                sim = self._empty_shard()
+                if items:
+                    sim.feed_arrays(items, matrix, metadata)
+                    sim.build(n, params)
+                self.shards.append(sim)
+        else:
+            tmpdir = None
+            if workdir is None:
+                workdir = tmpdir = tempfile.mkdtemp()
+            jobs = [(os.path.join(workdir, "shard%d" % k), self.dims,
+                     self.metric, self.backend_class, rows, n, params)
+                    for k, rows in enumerate(assignments)]
+            pool = Pool(processes)
+            try:
+                prefixes = pool.map(_build_shard, jobs)
+            finally:
+                pool.close()
+                pool.join()
+            self.shards = [self._empty_shard() if prefix is None
+                           else SimpleNeighbors.load(prefix)
+                           for prefix in prefixes]
+            if tmpdir is not None:
+                # the shards' files are memory-mapped or read into memory at
+                # this point, so they can be unlinked
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        self.pending = [self._pending() for i in range(self.shard_count)]
+        self.built = True
+
+    def _empty_shard(self):
+        return SimpleNeighbors(self.dims, self.metric,
+                               backend=self.backend_class)
+
+    def _map(self, fn):
+        """Calls ``fn`` on every built shard concurrently, returning the
+        results in shard order."""
+        shards = [shard for shard in self.shards if shard.built]
+        if len(shards) < 2:
+            return [fn(shard) for shard in shards]
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(len(self.shards))
+            pool = self.pool
+        return pool.map(fn, shards)
+
+    def close(self):
+        """Shuts down the pool of threads used to query the shards. (A new
+        pool is started if the index is queried again.)"""
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+
+    def _shard_of(self, item):
+        if self.route == 'hash':
+            shard = self.shards[hash_route(item, len(self.shards))]
+            if item in shard.id_map:
+                return shard
+        else:
+            for shard in self.shards:
+                if item in shard.id_map:
+                    return shard
+        raise KeyError(item)
+
+    def nearest_with_distances(self, vec, n=12, search_k=None):
+        """Returns the items nearest to a given vector, with their distances
+        (see :func:`~simpleneighbors.SimpleNeighbors.nearest_with_distances`).
+
+        :param vec: search vector
+        :param n: number of results to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of ``(item, distance)`` tuples sorted in order of
+            proximity
+        """
+        results = []
+        for shard_results in self._map(
+                lambda shard: shard.nearest_with_distances(
+                    vec, n, search_k)):
+            results.extend(shard_results)
+        results.sort(key=itemgetter(1))
+        return results[:n]
+
+    def nearest(self, vec, n=12, search_k=None):
+        """Returns the items nearest to a given vector (see
+        :func:`~simpleneighbors.SimpleNeighbors.nearest`).
+
+        :param vec: search vector
+        :param n: number of results to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of items sorted in order of proximity
+        """
+        return [item for item, dist in self.nearest_with_distances(
+            vec, n, search_k)]
+
+    def neighbors_with_distances(self, item, n=12, search_k=None):
+        """Returns the items nearest to another item, with their distances
+        (see
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors_with_distances`).
+
+        :param item: search item
+        :param n: number of results to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of ``(item, distance)`` tuples sorted in order of
+            proximity
+        """
+        return self.nearest_with_distances(self.vec(item), n, search_k)
+
+    def neighbors(self, item, n=12, search_k=None):
+        """Returns the items nearest to another item (see
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors`).
+
+        :param item: search item
+        :param n: number of results to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list of items sorted in order of proximity
+        """
+        return self.nearest(self.vec(item), n, search_k)
+
+    def nearest_many(self, vecs, n=12, search_k=None):
+        """Returns the items nearest to each of several vectors (see
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_many`).
+
+        :param vecs: a sequence of search vectors
+        :param n: number of results to return for each vector
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list with one list of items for each search vector
+        """
+        vecs = list(vecs)
+        results = [[] for vec in vecs]
+        # one batched search per shard
+        for shard_results in self._map(
+                lambda shard: shard.nearest_many_with_distances(
+                    vecs, n, search_k)):
+            for row, found in zip(results, shard_results):
+                row.extend(found)
+        return [[item for item, dist in sorted(row, key=itemgetter(1))[:n]]
+                for row in results]
+
+    def neighbors_many(self, items, n=12, search_k=None):
+        """Returns the items nearest to each of several items (see
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors_many`).
+
+        :param items: a sequence of search items
+        :param n: number of results to return for each item
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :returns: a list with one list of items for each search item
+        """
+        return self.nearest_many([self.vec(item) for item in items], n,
+                                 search_k)
+
+    def _vec_dist(self, a_vec, b_vec):
+        """Returns the distance between two vectors from different shards,
+        as the shards' backends would compute it."""
+        if self.metric == 'angular':
+            return norm_dist(a_vec, b_vec)
+        if self.metric == 'euclidean':
+            return distance(a_vec, b_vec)
+        if self.metric == 'manhattan':
+            return sum(abs(a - b) for a, b in zip(a_vec, b_vec))
+        raise ValueError("can't compare items in different shards with the "
+                         "%s metric" % self.metric)
+
+    def nearest_matching(self, vec, n=12, check=lambda x: True, where=None,
+                         search_k=None):
+        """Returns the items nearest to a given vector that pass a test (see
+        :func:`~simpleneighbors.SimpleNeighbors.nearest_matching`).
+
+        :param vec: search vector
+        :param n: number of items to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param check: function to call on each item
+        :param where: dictionary of conditions on the items' metadata
+        :returns: a generator yielding up to ``n`` items
+        """
+        if check is None:
+            check = lambda x: True  # noqa: E731
+
+        def search(shard):
+            # (the distances found by each shard's own search)
+            return list(shard.nearest_matching_with_distances(
+                    vec, n, check, where, search_k))
+        results = []
+        for shard_results in self._map(search):
+            results.extend(shard_results)
+        results.sort(key=itemgetter(1))
+        for item, dist in results[:n]:
+            yield item
+
+    def neighbors_matching(self, item, n=12, check=None, where=None,
+                           search_k=None):
+        """Returns the items nearest to another item that pass a test (see
+        :func:`~simpleneighbors.SimpleNeighbors.neighbors_matching`).
+
+        :param item: search item
+        :param n: number of items to return
+        :param search_k: search effort (see
+            :func:`~simpleneighbors.SimpleNeighbors.nearest`)
+        :param check: function to call on each item
+        :param where: dictionary of conditions on the items' metadata
+        :returns: a generator yielding up to ``n`` items
+        """
+        if check is None:
+            return self.nearest_matching(self.vec(item), n, where=where,
+                                         search_k=search_k)
+        return self.nearest_matching(self.vec(item), n, check, where,
+                                     search_k)
+
+    def dist(self, a, b):
+        """Returns the distance between two items (see
+        :func:`~simpleneighbors.SimpleNeighbors.dist`).
+
+        :param a: first item
+        :param b: second item
+        :returns: distance between ``a`` and ``b``
+        """
+        a_shard = self._shard_of(a)
+        b_shard = self._shard_of(b)
+        if a_shard is b_shard:
+            return a_shard.dist(a, b)
+        return self._vec_dist(a_shard.vec(a), b_shard.vec(b))
+
+    def vec(self, item):
+        """Returns the vector for an item (see
+        :func:`~simpleneighbors.SimpleNeighbors.vec`).
+
+        :param item: item to look up
+        :returns: vector for item
+        """
+        return self._shard_of(item).vec(item)
+
+    def __len__(self):
+        """Returns the number of items in the index"""
+        if self.built:
+            return sum(len(shard) for shard in self.shards)
+        return sum(len(pending.items) for pending in self.pending)
+
+    def save(self, prefix, compact=False):
+        """Saves the index to disk.
+
+        Each shard is saved with :func:`~simpleneighbors.SimpleNeighbors.save`
+        using the prefix ``<prefix>-shard<k>``, and the object data for the
+        index as a whole is saved as ``<prefix>-shards.pkl``.
+
+        :param prefix: filename prefix
+        :param compact: save each shard's items in the compact format
+        :returns: None
+        """
+        assert self.built, "Only built indexes can be saved."
+        for k, shard in enumerate(self.shards):
+            if shard.built:
+                shard.save("%s-shard%d" % (prefix, k), compact=compact)
+        data = {
+            'dims': self.dims,
+            'metric': self.metric,
+            'route': self.route,
+            'shards': len(self.shards),
+            'empty': [k for k, shard in enumerate(self.shards)
+                      if not shard.built],
+            '_backend_class': self.backend_class,
+        }
+        with open(prefix + "-shards.pkl", "wb") as fh:
+            pickle.dump(data, fh)
+
+    @classmethod
+    def load(cls, prefix):
+        """Restores a previously-saved sharded index.
+
+        :param prefix: prefix used when saving
+        :returns: ShardedSimpleNeighbors object restored from specified files
+        """
+        with open(prefix + "-shards.pkl", "rb") as fh:
+            data = pickle.load(fh)
+        newobj = cls(dims=data['dims'], shards=data['shards'],
+                     metric=data['metric'], backend=data['_backend_class'],
+                     route=data['route'])
+        newobj.shards = [
+            newobj._empty_shard() if k in data['empty']
+            else SimpleNeighbors.load("%s-shard%d" % (prefix, k))
+            for k in range(data['shards'])]
+        newobj.built = True
+        return newobj
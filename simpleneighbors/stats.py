@@ -0,0 +1,164 @@
+"""Timing and counting the operations performed on an index.
+
+A :class:`~simpleneighbors.SimpleNeighbors` object calls its hooks (added
+with :func:`~simpleneighbors.SimpleNeighbors.add_hook`) after each operation
+with three arguments: the name of the operation (e.g., ``'nearest'``), the
+time it took in seconds, and a dictionary of extra information (e.g., for
+``'nearest_matching'``, the number of expansion rounds and predicate calls).
+Hooks are how you'd export timings to a metrics system::
+
+    def to_statsd(op, seconds, info):
+        statsd.timing('simpleneighbors.' + op, seconds * 1000)
+    sim.add_hook(to_statsd)
+
+A :class:`Stats` object is a hook that keeps counts and latency histograms
+in memory; create an index with ``collect_stats=True`` to have one added
+automatically, and read it with :func:`~simpleneighbors.SimpleNeighbors.stats`.
+
+When an index has no hooks, the only cost of instrumentation is a check of
+the index's ``hooks`` attribute on each call.
+"""
+
+from functools import wraps
+import threading
+import time
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    # python 2
+    timer = time.time
+
+# upper bounds of the latency histogram buckets, in seconds: powers of two
+# from 1 microsecond to about 17 seconds (latencies above the last bound go
+# in a final, unbounded bucket)
+BUCKETS = [2 ** i / 1e6 for i in range(25)]
+
+
+def timed(op):
+    """Decorator for :class:`~simpleneighbors.SimpleNeighbors` methods that
+    reports how long each call takes to the object's hooks.
+
+    :param op: the name of the operation
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if self.hooks is None:
+                return fn(self, *args, **kwargs)
+            start = timer()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self._record(op, timer() - start, {})
+        return wrapper
+    return decorator
+
+
+def counting(fn, counts, name):
+    """Wraps a function so that calls to it are counted and timed in
+    ``counts`` (as ``<name>_calls`` and ``<name>_sec``)."""
+    counts.setdefault(name + '_calls', 0)
+    counts.setdefault(name + '_sec', 0.0)
+
+    def wrapper(*args, **kwargs):
+        start = timer()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            counts[name + '_calls'] += 1
+            counts[name + '_sec'] += timer() - start
+    return wrapper
+
+
+class Histogram:
+    """Counts latencies in exponentially-sized buckets (see
+    :data:`BUCKETS`)."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = 0
+        while bucket < len(BUCKETS) and seconds > BUCKETS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Returns an upper bound on the ``q`` quantile (e.g., 0.99) of the
+        latencies added so far, in seconds."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Stats:
+    """A hook that keeps, for each operation, a count of calls, a latency
+    histogram and the totals of any numbers in the extra information.
+
+        >>> from simpleneighbors.stats import Stats
+        >>> stats = Stats()
+        >>> stats('nearest_matching', 0.003, {'backend_calls': 2})
+        >>> stats('nearest_matching', 0.001, {'backend_calls': 1})
+        >>> summary = stats.summary()['nearest_matching']
+        >>> summary['count'], summary['backend_calls']
+        (2, 3)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.totals = {}
+
+    def __call__(self, op, seconds, info):
+        with self.lock:
+            histogram = self.histograms.get(op)
+            if histogram is None:
+                histogram = self.histograms[op] = Histogram()
+                self.totals[op] = {}
+            histogram.add(seconds)
+            totals = self.totals[op]
+            for key, value in info.items():
+                totals[key] = totals.get(key, 0) + value
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self.lock:
+            self.histograms.clear()
+            self.totals.clear()
+
+    def summary(self):
+        """Returns a dictionary mapping each operation recorded so far to a
+        dictionary with its ``count``, ``total_sec``, ``mean_sec``,
+        ``max_sec``, ``p50_sec``, ``p90_sec`` and ``p99_sec`` (upper bounds
+        from the histogram), ``buckets`` (a list of ``(upper bound, count)``
+        pairs, with ``None`` as the last bound) and the totals of the extra
+        information reported with the operation."""
+        with self.lock:
+            summary = {}
+            for op, histogram in self.histograms.items():
+                entry = dict(self.totals[op])
+                entry.update({
+                    'count': histogram.count,
+                    'total_sec': histogram.total,
+                    'mean_sec': histogram.total / histogram.count,
+                    'max_sec': histogram.max,
+                    'p50_sec': histogram.quantile(0.5),
+                    'p90_sec': histogram.quantile(0.9),
+                    'p99_sec': histogram.quantile(0.99),
+                    'buckets': list(zip(BUCKETS + [None], histogram.counts)),
+                })
+                summary[op] = entry
+            return summary
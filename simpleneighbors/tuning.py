@@ -0,0 +1,215 @@
+"""Choosing build and search parameters for a target recall or latency.
+
+:func:`tune` builds an index with each candidate backend and setting of
+``build()``'s ``n`` (and, for approximate backends like Annoy, each
+candidate search effort, ``search_k``), measures recall@k against an exact
+search and query latency on a sample of queries, and returns the index that
+best meets the target. :func:`tune_search` does the same for just the search
+effort of an index that's already built.
+
+A target is given as ``min_recall`` (e.g., ``0.95`` for recall@k of at least
+95%), ``max_latency_ms`` (a limit on the ``percentile``-th percentile of
+query latency), or both. Among the settings that meet the target, the one
+with the lowest latency is chosen if ``min_recall`` was given, otherwise the
+one with the highest recall. If no settings meet the target, the ones that
+come closest are chosen.
+
+The chosen search effort is stored in the index's ``search_effort``
+attribute, which :func:`~simpleneighbors.SimpleNeighbors.save` saves along
+with the index, so that queries made after loading it use the tuned effort
+too. For backends whose ``search_k`` grows with the number of results (like
+Annoy's number of nodes to inspect), it's stored per result, so a query for
+more results than the tuned ``n`` gets a proportionally larger
+``search_k``.
+"""
+
+from collections import namedtuple
+import time
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import available, BruteForceNumpy
+from simpleneighbors.backends import BruteForcePurePython
+from simpleneighbors.backends.segmented import Segmented
+from simpleneighbors.benchmark import recall
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    # python 2
+    _timer = time.time
+
+Trial = namedtuple('Trial', [
+    'backend', 'build_n', 'search_k', 'recall', 'latency_ms'])
+Trial.__doc__ = """The recall@k and latency measured for one setting."""
+
+TuningResult = namedtuple('TuningResult', [
+    'sim', 'backend', 'build_n', 'search_k', 'recall', 'latency_ms',
+    'met_target', 'trials'])
+TuningResult.__doc__ = """The outcome of tuning: the chosen index and its
+settings and measurements, whether it met the target, and a list of every
+:class:`Trial`."""
+
+
+def exact_neighbors(items, matrix, queries, n=10, metric='angular'):
+    """Returns the true nearest neighbors of each query, found by an exact
+    (brute-force) search.
+
+    :param items: a list of items
+    :param matrix: a 2D array with one vector per item
+    :param queries: a sequence of search vectors
+    :param n: number of neighbors to find for each query
+    :param metric: the distance metric to use
+    :returns: a list with one list of items for each query
+    """
+    exact = SimpleNeighbors(len(matrix[0]), metric, backend=BruteForceNumpy)
+    exact.feed_arrays(items, matrix)
+    exact.build()
+    return exact.nearest_many(queries, n)
+
+
+def measure(sim, queries, expected, n=10, percentile=99):
+    """Measures recall@n and query latency for an index.
+
+    :param sim: a built :class:`~simpleneighbors.SimpleNeighbors` object
+    :param queries: a sequence of search vectors
+    :param expected: the true nearest neighbors of each query
+    :param n: number of results to ask for in each query
+    :param percentile: latency percentile to report
+    :returns: a ``(recall, latency in milliseconds)`` tuple
+    """
+    import numpy as np
+    found = []
+    latencies = []
+    # cached results would make the queries look faster than they are
+    cache, sim.cache = sim.cache, None
+    try:
+        for query in queries:
+            start = _timer()
+            found.append(sim.nearest(query, n))
+            latencies.append(_timer() - start)
+    finally:
+        sim.cache = cache
+    latency = float(np.percentile(latencies, percentile)) * 1000.0
+    return recall(found, expected), latency
+
+
+def _ranking(min_recall, max_latency_ms):
+    """Returns a key function ranking trials (best first) for a target."""
+    def key(trial):
+        shortfall = 0.0
+        if min_recall is not None:
+            shortfall += max(0.0, min_recall - trial.recall)
+        if max_latency_ms is not None:
+            shortfall += max(0.0, trial.latency_ms / max_latency_ms - 1.0)
+        if shortfall > 0:
+            return (1, shortfall, 0.0)
+        if min_recall is not None:
+            return (0, trial.latency_ms, -trial.recall)
+        return (0, -trial.recall, trial.latency_ms)
+    return key
+
+
+def _meets(trial, min_recall, max_latency_ms):
+    return ((min_recall is None or trial.recall >= min_recall) and
+            (max_latency_ms is None or trial.latency_ms <= max_latency_ms))
+
+
+def _result(best, sim, n, trials, min_recall, max_latency_ms):
+    sim.search_k = None
+    sim.search_effort = best.search_k
+    if best.search_k is not None and sim.backend.search_k_per_result:
+        sim.search_effort = float(best.search_k) / n
+    if sim.cache is not None:
+        sim.cache.clear()
+    return TuningResult(sim, best.backend, best.build_n, best.search_k,
+                        best.recall, best.latency_ms,
+                        _meets(best, min_recall, max_latency_ms), trials)
+
+
+def tune(items, matrix, queries, n=10, min_recall=None, max_latency_ms=None,
+         percentile=99, metric='angular', backends=None,
+         build_ns=(10, 25, 50, 100), metadata=None):
+    """Builds indexes with candidate settings and returns the best one.
+
+    Each backend is built with each of ``build_ns`` (backends that ignore
+    ``build()``'s ``n``, like the brute-force backends, are only built once)
+    and queried with each search effort worth trying for that backend.
+
+    :param items: a list of items
+    :param matrix: a 2D array with one vector per item
+    :param queries: a sample of search vectors, representative of the
+        queries the index will be used for
+    :param n: number of results to measure recall for (recall@n)
+    :param min_recall: target recall, between 0 and 1
+    :param max_latency_ms: target query latency, in milliseconds
+    :param percentile: latency percentile the target applies to
+    :param metric: the distance metric to use
+    :param backends: backend classes to try (default: every available
+        backend except ``BruteForcePurePython`` and ``HNSW``, whose build
+        time grows with the square of the number of items)
+    :param build_ns: values of ``build()``'s ``n`` to try
+    :param metadata: list of metadata dictionaries, one per item
+    :returns: a :class:`TuningResult`
+    """
+    if backends is None:
+        backends = [backend for backend in available()
+                    if backend is not BruteForcePurePython]
+    queries = list(queries)
+    expected = exact_neighbors(items, matrix, queries, n, metric)
+    key = _ranking(min_recall, max_latency_ms)
+    trials = []
+    best = best_sim = None
+    for backend in backends:
+        for build_n, search_ks in backend.tuning_grid(n, list(build_ns)):
+            sim = SimpleNeighbors(len(matrix[0]), metric, backend=backend)
+            sim.feed_arrays(items, matrix, metadata)
+            sim.build(build_n)
+            for search_k in search_ks:
+                sim.search_k = search_k
+                trial = Trial(backend, build_n, search_k,
+                              *measure(sim, queries, expected, n,
+                                       percentile))
+                trials.append(trial)
+                if best is None or key(trial) < key(best):
+                    best, best_sim = trial, sim
+    return _result(best, best_sim, n, trials, min_recall, max_latency_ms)
+
+
+def tune_search(sim, queries, n=10, min_recall=None, max_latency_ms=None,
+                percentile=99, search_ks=None, expected=None):
+    """Chooses the search effort for an index that's already built.
+
+    :param sim: a built :class:`~simpleneighbors.SimpleNeighbors` object
+    :param queries: a sample of search vectors
+    :param n: number of results to measure recall for (recall@n)
+    :param min_recall: target recall, between 0 and 1
+    :param max_latency_ms: target query latency, in milliseconds
+    :param percentile: latency percentile the target applies to
+    :param search_ks: values of ``search_k`` to try (default: the values
+        worth trying for the index's backend)
+    :param expected: the true nearest neighbors of each query (by default,
+        found with an exact search over the index's vectors)
+    :returns: a :class:`TuningResult`; the index's ``search_effort`` is
+        set to the chosen value
+    """
+    backend = sim.backend
+    if isinstance(backend, Segmented):
+        backend = backend.main
+    build_n = sim.build_args[0]
+    if search_ks is None:
+        search_ks = backend.tuning_grid(n, [build_n])[0][1]
+    queries = list(queries)
+    if expected is None:
+        items = list(sim.id_map)
+        matrix = [sim.vec(item) for item in items]
+        expected = exact_neighbors(items, matrix, queries, n, sim.metric)
+    key = _ranking(min_recall, max_latency_ms)
+    trials = []
+    # each trial's search_k is used as is
+    sim.search_effort = None
+    for search_k in search_ks:
+        sim.search_k = search_k
+        trials.append(Trial(backend.__class__, build_n, search_k,
+                            *measure(sim, queries, expected, n, percentile)))
+    best = min(trials, key=key)
+    return _result(best, sim, n, trials, min_recall, max_latency_ms)
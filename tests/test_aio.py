@@ -0,0 +1,77 @@
+import sys
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import BruteForceNumpy
+
+from tests.test_simpleneighbors import data
+
+# (this module avoids async syntax itself, so that it can be loaded by
+# older interpreters, which skip its tests)
+if sys.version_info >= (3, 5):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from simpleneighbors.aio import AsyncSimpleNeighbors
+
+
+def run_all(*coros, **kwargs):
+    """Runs coroutines concurrently on a new event loop and returns their
+    results."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.gather(*coros, **kwargs))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "requires Python 3.5 or later")
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = SimpleNeighbors(3, backend=BruteForceNumpy)
+        self.sim.feed(data)
+        self.sim.build()
+
+    def test_coalescing(self):
+        sim = self.sim
+        with ThreadPoolExecutor(2) as executor, \
+                mock.patch.object(sim, 'nearest_many',
+                                  wraps=sim.nearest_many) as nearest_many:
+            asim = AsyncSimpleNeighbors(sim, executor, window=0.01)
+            results = run_all(
+                    *[asim.aneighbors(item, 5) for item, vec in data])
+            self.assertEqual(results,
+                             [sim.neighbors(item, 5) for item, vec in data])
+            self.assertEqual(nearest_many.call_count, 1)
+
+            # batches are split at max_batch, and by n
+            asim.max_batch = 8
+            results = run_all(
+                    *[asim.anearest(vec, 3) for item, vec in data] +
+                    [asim.anearest(data[0][1], 2)])
+            self.assertEqual(results[-1], sim.nearest(data[0][1], 2))
+            self.assertEqual(results[0], sim.nearest(data[0][1], 3))
+            # 20 queries for n=3 in batches of at most 8, one for n=2
+            self.assertEqual(nearest_many.call_count, 1 + 3 + 1)
+
+    def test_errors(self):
+        asim = AsyncSimpleNeighbors(self.sim)
+        good, bad = run_all(asim.anearest(data[0][1], 1),
+                            asim.anearest((1, 2), 1),
+                            return_exceptions=True)
+        self.assertEqual(good, ['mahogany'])
+        self.assertIsInstance(bad, Exception)
+        self.assertRaises(KeyError, run_all, asim.aneighbors('not a color'))
+        self.assertAlmostEqual(
+                run_all(asim.arun(self.sim.dist, 'mint', 'mint'))[0], 0.0,
+                places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import csv
+import json
+import unittest
+import tempfile
+from os.path import join as opj
+from shutil import rmtree
+
+from simpleneighbors import benchmark
+from simpleneighbors.backends import Annoy, BruteForceNumpy
+
+
+class TestBenchmark(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.tmpdir)
+
+    def test_recall(self):
+        self.assertEqual(benchmark.recall([[1, 2], [3, 4]], [[2, 1], [3, 5]]),
+                         0.75)
+
+    def test_benchmark(self):
+        results = benchmark.benchmark(
+            n=200, dims=[4, 8], query_count=10, build_n=5,
+            backends=[Annoy, BruteForceNumpy], isolate=False, k=5,
+            batch_size=4, threads=2)
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertEqual(sorted(result), sorted(benchmark.FIELDS))
+            self.assertTrue(0 <= result['recall'] <= 1)
+            self.assertTrue(result['index_bytes'] > 0)
+            self.assertTrue(result['latency_ms_p50'] <=
+                            result['latency_ms_p99'])
+        self.assertEqual(results[-1]['recall'], 1.0)
+        benchmark.write_json(results, opj(self.tmpdir, 'results.json'))
+        with open(opj(self.tmpdir, 'results.json')) as fh:
+            self.assertEqual(json.load(fh), results)
+        benchmark.write_csv(results, opj(self.tmpdir, 'results.csv'))
+        with open(opj(self.tmpdir, 'results.csv')) as fh:
+            rows = list(csv.DictReader(fh))
+        self.assertEqual([row['backend'] for row in rows],
+                         ['Annoy', 'Annoy', 'BruteForceNumpy',
+                          'BruteForceNumpy'])
+
+
+if __name__ == '__main__':
+    unittest.main()
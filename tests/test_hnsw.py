@@ -0,0 +1,79 @@
+import unittest
+import tempfile
+from os.path import join as opj
+from shutil import rmtree
+
+import numpy as np
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import BruteForceNumpy, HNSW
+from simpleneighbors.benchmark import recall
+from simpleneighbors.tuning import exact_neighbors
+
+
+class TestHNSW(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        cls.matrix = rng.randn(1000, 16).astype(np.float32)
+        cls.items = list(range(1000))
+        cls.queries = rng.randn(20, 16).astype(np.float32)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.tmpdir)
+
+    def test_recall(self):
+        for metric in ('angular', 'euclidean'):
+            expected = exact_neighbors(self.items, self.matrix, self.queries,
+                                       10, metric)
+            sim = SimpleNeighbors(16, metric, backend=HNSW)
+            sim.feed_arrays(self.items, self.matrix)
+            sim.build(8)
+            links = sim.backend.links
+            self.assertEqual(links[0].shape, (1000, 16))
+            self.assertEqual(links[0].dtype, np.int32)
+            self.assertTrue(all(layer.shape[1] == 8 for layer in links[1:]))
+            # every item can be reached from the entry point
+            self.assertEqual(
+                    [found[0] for found in sim.nearest_many(self.matrix, 1)],
+                    self.items)
+            self.assertGreater(
+                    recall(sim.nearest_many(self.queries, 10), expected),
+                    0.9)
+            # a larger ef finds more of the true neighbors
+            self.assertGreaterEqual(
+                    recall(sim.nearest_many(self.queries, 10, search_k=200),
+                           expected), 0.98)
+            exact = SimpleNeighbors(16, metric, backend=BruteForceNumpy)
+            exact.feed_arrays(self.items, self.matrix)
+            exact.build()
+            for (item, dist), (exact_item, exact_dist) in zip(
+                    sim.nearest_with_distances(self.queries[0], 3),
+                    exact.nearest_with_distances(self.queries[0], 3)):
+                self.assertEqual(item, exact_item)
+                self.assertAlmostEqual(dist, exact_dist, places=4)
+
+    def test_save_load(self):
+        sim = SimpleNeighbors(16, 'angular', backend=HNSW)
+        sim.feed_arrays(self.items, self.matrix)
+        sim.build(8, params={'ef': 20})
+        prefix = opj(self.tmpdir, 'hnsw')
+        sim.save(prefix)
+        sim2 = SimpleNeighbors.load(prefix)
+        self.assertEqual(sim2.backend.ef, 20)
+        self.assertEqual(sim2.backend.entry, sim.backend.entry)
+        self.assertEqual(sim2.nearest_many(self.queries, 10),
+                         sim.nearest_many(self.queries, 10))
+        self.assertEqual(sim2.vec(5), sim.vec(5))
+
+    def test_empty(self):
+        sim = SimpleNeighbors(16, 'angular', backend=HNSW)
+        sim.build()
+        self.assertEqual(sim.nearest(self.queries[0], 10), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import tempfile
+from os.path import exists, join as opj
+from shutil import rmtree
+
+import numpy as np
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import IVF
+from simpleneighbors.benchmark import recall
+from simpleneighbors.tuning import exact_neighbors
+
+
+class TestIVF(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        # clustered data, as real embeddings tend to be
+        centers = rng.randn(20, 16) * 4
+        cls.matrix = (centers[rng.randint(20, size=2000)] +
+                      rng.randn(2000, 16)).astype(np.float32)
+        cls.items = list(range(2000))
+        cls.queries = (centers[rng.randint(20, size=20)] +
+                       rng.randn(20, 16)).astype(np.float32)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.tmpdir)
+
+    def make_sim(self, metric, **kwargs):
+        sim = SimpleNeighbors(16, metric, backend=IVF, **kwargs)
+        sim.feed_arrays(self.items, self.matrix)
+        sim.build(40, params={'nprobe': 4})
+        return sim
+
+    def test_recall(self):
+        for metric in ('angular', 'euclidean'):
+            expected = exact_neighbors(self.items, self.matrix, self.queries,
+                                       10, metric)
+            sim = self.make_sim(metric)
+            backend = sim.backend
+            self.assertEqual(len(backend.centroids), 40)
+            self.assertEqual(backend.offsets[-1], 2000)
+            self.assertEqual(sorted(backend.ids.tolist()), self.items)
+            # each cell's vectors are stored together
+            for cell in (0, 39):
+                start, stop = backend.offsets[cell], backend.offsets[cell + 1]
+                np.testing.assert_array_equal(
+                        backend.vectors[start:stop],
+                        self.matrix[backend.ids[start:stop]])
+            self.assertGreater(
+                    recall(sim.nearest_many(self.queries, 10), expected),
+                    0.8)
+            # probing every cell is an exact search
+            self.assertEqual(sim.nearest_many(self.queries, 10, search_k=40),
+                             expected)
+            # never fewer results than asked for
+            self.assertEqual(len(sim.nearest(self.queries[0], 500,
+                                             search_k=1)), 500)
+
+    def test_n_jobs(self):
+        sim = self.make_sim('angular', n_jobs=1)
+        sim2 = self.make_sim('angular', n_jobs=4)
+        np.testing.assert_array_equal(sim.backend.ids, sim2.backend.ids)
+
+    def test_save_load(self):
+        sim = self.make_sim('euclidean')
+        prefix = opj(self.tmpdir, 'ivf')
+        sim.save(prefix)
+        sim2 = SimpleNeighbors.load(prefix)
+        self.assertEqual(sim2.backend.nprobe, 4)
+        self.assertIsInstance(sim2.backend.vectors, np.memmap)
+        self.assertEqual(sim2.nearest_many(self.queries, 10),
+                         sim.nearest_many(self.queries, 10))
+        self.assertEqual(sim2.vec(5), sim.vec(5))
+        self.assertEqual(sim2.vec(5), self.matrix[5].tolist())
+
+    def test_on_disk_build(self):
+        prefix = opj(self.tmpdir, 'ivf-ondisk')
+        sim = SimpleNeighbors(16, 'angular', backend=IVF, on_disk=prefix)
+        sim.feed_arrays(self.items, self.matrix)
+        sim.build(40)
+        self.assertIsInstance(sim.backend.vectors, np.memmap)
+        self.assertFalse(exists(prefix + '.idx-vectors.npy'))
+        expected = sim.nearest_many(self.queries, 10)
+        sim.save(prefix)
+        self.assertEqual(SimpleNeighbors.load(prefix).nearest_many(
+            self.queries, 10), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
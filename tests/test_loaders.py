@@ -0,0 +1,80 @@
+import unittest
+import tempfile
+from os.path import join as opj
+from shutil import rmtree
+
+import numpy as np
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import BruteForceNumpy
+
+from tests.test_simpleneighbors import data
+
+
+class TestLoaders(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.labels = [item for item, vec in data]
+        cls.matrix = np.array([vec for item, vec in data], dtype=np.float32)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.tmpdir)
+
+    def check(self, sim, labels=None):
+        if labels is None:
+            labels = self.labels
+        self.assertEqual(list(sim.corpus), labels)
+        for label, vec in zip(labels, self.matrix):
+            self.assertEqual(sim.vec(label), vec.tolist())
+        sim.build()
+        self.assertEqual(sim.neighbors(labels[0], 1), [labels[0]])
+
+    def test_glove_text(self):
+        fname = opj(self.tmpdir, 'vectors.txt')
+        with open(fname, 'w') as fh:
+            fh.write("%d 3\n" % len(data))
+            for item, vec in data:
+                fh.write("%s %s\n" % (item, " ".join(str(d) for d in vec)))
+        counts = []
+        sim = SimpleNeighbors.from_glove_text(
+                fname, backend=BruteForceNumpy, chunk_size=7,
+                progress=counts.append)
+        self.assertEqual(counts, [7, 14, 20])
+        self.check(sim)
+        sim = SimpleNeighbors.from_glove_text(
+                fname, backend=BruteForceNumpy, chunk_size=3, limit=5)
+        self.assertEqual(len(sim), 5)
+
+    def test_word2vec_binary(self):
+        # labels in this format can't contain spaces
+        labels = [label.replace(' ', '_') for label in self.labels]
+        fname = opj(self.tmpdir, 'vectors.bin')
+        with open(fname, 'wb') as fh:
+            fh.write(("%d 3\n" % len(data)).encode('utf8'))
+            for item, vec in zip(labels, self.matrix):
+                fh.write(item.encode('utf8') + b' ')
+                fh.write(vec.astype('<f4').tobytes() + b'\n')
+        sim = SimpleNeighbors.from_word2vec_binary(
+                fname, backend=BruteForceNumpy, chunk_size=6)
+        self.check(sim, labels)
+        sim = SimpleNeighbors.from_word2vec_binary(
+                fname, backend=BruteForceNumpy, limit=4)
+        self.assertEqual(list(sim.corpus), labels[:4])
+
+    def test_npy(self):
+        fname = opj(self.tmpdir, 'vectors.npy')
+        np.save(fname, self.matrix)
+        sim = SimpleNeighbors.from_npy(
+                fname, self.labels, backend=BruteForceNumpy, chunk_size=8)
+        self.check(sim)
+        sim = SimpleNeighbors.from_npy(fname, backend=BruteForceNumpy)
+        self.check(sim, list(range(len(data))))
+        self.assertRaises(ValueError, SimpleNeighbors.from_npy, fname,
+                          self.labels[:3], backend=BruteForceNumpy)
+
+
+if __name__ == '__main__':
+    unittest.main()
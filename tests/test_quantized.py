@@ -0,0 +1,93 @@
+import unittest
+import tempfile
+from os.path import join as opj
+from shutil import rmtree
+
+import numpy as np
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import BruteForceNumpy, Quantized, select_best
+from simpleneighbors.benchmark import recall
+from simpleneighbors.tuning import exact_neighbors
+
+
+class TestQuantized(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        cls.matrix = rng.randn(2000, 32).astype(np.float32)
+        cls.items = list(range(2000))
+        cls.queries = rng.randn(20, 32).astype(np.float32)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.tmpdir)
+
+    def make_sim(self, metric, params=None):
+        sim = SimpleNeighbors(32, metric, backend=Quantized)
+        sim.feed_arrays(self.items, self.matrix)
+        sim.build(params=params)
+        return sim
+
+    def test_select_best(self):
+        self.assertEqual(select_best(compressed=True), Quantized)
+
+    def test_recall(self):
+        for metric in ('angular', 'euclidean'):
+            expected = exact_neighbors(self.items, self.matrix, self.queries,
+                                       10, metric)
+            sim = self.make_sim(metric)
+            self.assertEqual(sim.backend.codes.dtype, np.int8)
+            self.assertEqual(sim.backend.codes.shape, (2000, 32))
+            # without re-ranking, the order is only approximate
+            approx = sim.nearest_many(self.queries, 10, search_k=0)
+            self.assertGreater(recall(approx, expected), 0.8)
+            # re-ranking enough candidates finds the exact results
+            found = sim.nearest_many(self.queries, 10, search_k=200)
+            self.assertEqual(found, expected)
+            with_dists = sim.nearest_with_distances(self.queries[0], 3,
+                                                    search_k=200)
+            exact = SimpleNeighbors(32, metric, backend=BruteForceNumpy)
+            exact.feed_arrays(self.items, self.matrix)
+            exact.build()
+            for (item, dist), (exact_item, exact_dist) in zip(
+                    with_dists,
+                    exact.nearest_with_distances(self.queries[0], 3)):
+                self.assertEqual(item, exact_item)
+                self.assertAlmostEqual(dist, exact_dist, places=4)
+
+    def test_save_load(self):
+        sim = self.make_sim('angular', {'rerank': 8})
+        prefix = opj(self.tmpdir, 'quantized')
+        sim.save(prefix)
+        sim2 = SimpleNeighbors.load(prefix)
+        self.assertEqual(sim2.backend.rerank, 8)
+        self.assertIsInstance(sim2.backend.items.matrix(), np.memmap)
+        self.assertEqual(sim2.nearest_many(self.queries, 10),
+                         sim.nearest_many(self.queries, 10))
+        self.assertEqual(sim2.vec(5), sim.vec(5))
+        # saving a loaded index to the same prefix keeps its vectors
+        sim2.save(prefix)
+        self.assertEqual(SimpleNeighbors.load(prefix).vec(5), sim.vec(5))
+
+    def test_without_vectors(self):
+        sim = self.make_sim('euclidean', {'keep_vectors': False})
+        self.assertIsNone(sim.backend.items)
+        expected = exact_neighbors(self.items, self.matrix, self.queries,
+                                   10, 'euclidean')
+        self.assertGreater(
+                recall(sim.nearest_many(self.queries, 10), expected), 0.8)
+        # vectors are approximated from the quantized ones
+        np.testing.assert_allclose(sim.vec(5), self.matrix[5], atol=0.05)
+        prefix = opj(self.tmpdir, 'quantized-small')
+        sim.save(prefix)
+        sim2 = SimpleNeighbors.load(prefix)
+        self.assertIsNone(sim2.backend.items)
+        self.assertEqual(sim2.nearest_many(self.queries, 10),
+                         sim.nearest_many(self.queries, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,18 +4,29 @@ try:
 except ImportError:
     import mock
 import warnings
-from simpleneighbors.backends import select_best
-from simpleneighbors.backends import Annoy, Sklearn, BruteForcePurePython
+from simpleneighbors.backends import select_best, available
+from simpleneighbors.backends import (
+    Annoy, Sklearn, BruteForceNumpy, BruteForcePurePython)
 
 
 class TestSelectBest(unittest.TestCase):
 
+    def setUp(self):
+        # import each backend's dependencies up front, so that patching
+        # sys.modules below doesn't unload (and later reload) them
+        for backend in available():
+            backend.available()
+
     def test_select_best(self):
         self.assertEqual(select_best(), Annoy)
         with mock.patch.dict('sys.modules', {'annoy': None}):
             self.assertEqual(select_best(), Sklearn)
         with mock.patch.dict('sys.modules',
                              {'annoy': None, 'sklearn.neighbors': None}):
+            self.assertEqual(select_best(), BruteForceNumpy)
+        with mock.patch.dict('sys.modules',
+                             {'annoy': None, 'sklearn.neighbors': None,
+                              'numpy': None}):
             with warnings.catch_warnings(record=True) as w:
                 self.assertEqual(select_best(), BruteForcePurePython)
                 self.assertIn("very slow", str(w[-1].message))
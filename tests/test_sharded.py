@@ -0,0 +1,158 @@
+import unittest
+import tempfile
+import threading
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from os.path import join as opj
+from shutil import rmtree
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.sharded import ShardedSimpleNeighbors
+from simpleneighbors.backends import Annoy, BruteForceNumpy
+
+from tests.test_simpleneighbors import data, one_more
+
+
+class TestSharded(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.exact = SimpleNeighbors(3, backend=BruteForceNumpy)
+        cls.exact.feed(data)
+        cls.exact.add_one(*one_more)
+        cls.exact.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.tmpdir)
+
+    def check(self, sim):
+        exact = self.exact
+        self.assertEqual(len(sim), len(data) + 1)
+        self.assertEqual(sim.nearest(one_more[1], 8),
+                         exact.nearest(one_more[1], 8))
+        self.assertEqual(sim.neighbors('mint', 5), exact.neighbors('mint', 5))
+        for (item, dist), (e_item, e_dist) in zip(
+                sim.neighbors_with_distances('dusk', 5),
+                exact.neighbors_with_distances('dusk', 5)):
+            self.assertEqual(item, e_item)
+            self.assertAlmostEqual(dist, e_dist, places=3)
+        self.assertAlmostEqual(sim.dist('mint', 'dusk'),
+                               exact.dist('mint', 'dusk'), places=4)
+        self.assertEqual(
+            list(sim.neighbors_matching('mint', 3, lambda x: 'green' in x)),
+            list(exact.neighbors_matching('mint', 3,
+                                          lambda x: 'green' in x)))
+        self.assertRaises(KeyError, sim.vec, 'not a color')
+
+    def test_sharded(self):
+        for backend in (Annoy, BruteForceNumpy):
+            for route in ('hash', 'range'):
+                sim = ShardedSimpleNeighbors(3, shards=3, backend=backend,
+                                             route=route)
+                sim.feed(data)
+                sim.add_one(*one_more)
+                sim.build(20)
+                self.assertEqual(len(sim.shards), 3)
+                self.assertTrue(all(len(shard) for shard in sim.shards))
+                self.check(sim)
+                self.assertRaises(AssertionError, sim.add_one, *one_more)
+                prefix = opj(self.tmpdir, 'sharded-' + route)
+                sim.save(prefix)
+                sim.close()
+                sim2 = ShardedSimpleNeighbors.load(prefix)
+                self.check(sim2)
+                sim2.close()
+
+    def test_concurrent_first_queries(self):
+        from simpleneighbors import sharded
+        sim = ShardedSimpleNeighbors(3, shards=3, backend=BruteForceNumpy)
+        sim.feed(data)
+        sim.build(processes=1)
+        start = threading.Event()
+
+        def query():
+            start.wait()
+            sim.nearest(one_more[1], 3)
+        with mock.patch.object(sharded, 'ThreadPool',
+                               wraps=sharded.ThreadPool) as pool_class:
+            threads = [threading.Thread(target=query) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        # one pool is started and shared by all of the queries
+        self.assertEqual(pool_class.call_count, 1)
+        sim.close()
+
+    def test_feed_arrays(self):
+        import numpy as np
+        items = [item for item, vec in data] + [one_more[0]]
+        matrix = np.array([vec for item, vec in data] + [one_more[1]])
+        for route in ('hash', 'range'):
+            sim = ShardedSimpleNeighbors(3, shards=3,
+                                         backend=BruteForceNumpy,
+                                         route=route)
+            sim.feed_arrays(items, matrix)
+            self.assertEqual(len(sim), len(items))
+            # rows are kept as float32 vectors until the shards are built
+            self.assertTrue(all(
+                str(pending.vectors.matrix().dtype) == 'float32'
+                for pending in sim.pending))
+            self.assertRaises(ValueError, sim.feed_arrays, ['x'],
+                              [[1, 2]])
+            sim.build(processes=1)
+            self.check(sim)
+            queries = [vec for item, vec in data[:10]]
+            self.assertEqual(sim.nearest_many(queries, 5),
+                             [sim.nearest(vec, 5) for vec in queries])
+            self.assertEqual(sim.neighbors_many(['mint', 'dusk'], 5),
+                             [self.exact.neighbors('mint', 5),
+                              self.exact.neighbors('dusk', 5)])
+
+    def test_other_metrics(self):
+        sim = ShardedSimpleNeighbors(3, shards=3, metric='manhattan',
+                                     backend=Annoy)
+        sim.feed(data)
+        sim.build(20, processes=1)
+        exact = SimpleNeighbors(3, metric='manhattan', backend=Annoy)
+        exact.feed(data)
+        exact.build(20)
+        for a, b in (('mint', 'dusk'), ('mint', 'mahogany')):
+            self.assertAlmostEqual(sim.dist(a, b), exact.dist(a, b),
+                                   places=4)
+        # results from different shards are merged by the shards' own
+        # distances
+        self.assertEqual(
+            list(sim.neighbors_matching('mint', 4, lambda x: 'e' in x)),
+            list(exact.neighbors_matching('mint', 4, lambda x: 'e' in x)))
+        # distances between items in different shards can't be computed
+        # for metrics the sharded index doesn't know
+        sim = ShardedSimpleNeighbors(3, shards=3, metric='dot',
+                                     backend=Annoy)
+        sim.feed(data)
+        sim.build(20, processes=1)
+        a = data[0][0]
+        b = [item for item, vec in data
+             if sim._shard_of(item) is not sim._shard_of(a)][0]
+        self.assertRaises(ValueError, sim.dist, a, b)
+
+    def test_in_process_build(self):
+        sim = ShardedSimpleNeighbors(3, shards=4, backend=BruteForceNumpy)
+        sim.feed(data[:3])
+        sim.build(processes=1)
+        self.assertEqual(len(sim), 3)
+        self.assertEqual(sim.nearest(data[0][1], 3),
+                         ['mahogany', 'avocado green', 'violet'])
+        # with four shards and three items, at least one shard is empty
+        prefix = opj(self.tmpdir, 'sharded-small')
+        sim.save(prefix)
+        self.assertEqual(len(ShardedSimpleNeighbors.load(prefix)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
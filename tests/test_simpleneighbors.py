@@ -4,7 +4,10 @@ from os.path import join as opj
 from shutil import rmtree
 
 from simpleneighbors import SimpleNeighbors
-from simpleneighbors.backends import BruteForcePurePython, Annoy, Sklearn
+from simpleneighbors.corpus import MappedCorpus
+from simpleneighbors.backends import (
+    BruteForcePurePython, BruteForceNumpy, Annoy, Sklearn, Quantized, HNSW,
+    IVF)
 
 data = [
     ('mahogany', (74, 1, 0)),
@@ -68,6 +71,23 @@ class TestSimpleNeighbors(unittest.TestCase):
             sim.nearest([100, 100, 200], 3),
             ['dusk', 'purpley', 'french blue'])
 
+        self.assertEqual(
+            sim.nearest_many([[100, 100, 200], [159, 254, 176]], 3),
+            [['dusk', 'purpley', 'french blue'],
+             ['mint', 'battleship grey', 'bluegrey']])
+
+        self.assertEqual(
+            sim.neighbors_many(['mint'], 3),
+            [['mint', 'battleship grey', 'bluegrey']])
+
+        with_dists = sim.neighbors_with_distances('topaz', 3)
+        self.assertEqual([item for item, dist in with_dists],
+                         sim.neighbors('topaz', 3))
+        self.assertEqual("%0.5f" % with_dists[0][1], "0.00000")
+        for item, dist in with_dists:
+            self.assertEqual("%0.4f" % dist,
+                             "%0.4f" % sim.dist('topaz', item))
+
         nm = list(sim.neighbors_matching('mint', 1, lambda x: 'a' in x))
         self.assertEqual(nm[0], 'battleship grey')
 
@@ -80,13 +100,631 @@ class TestSimpleNeighbors(unittest.TestCase):
                 "0.45335")
 
     def test_workflow(self):
-        for backend in Annoy, BruteForcePurePython, Sklearn:
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn, Quantized, HNSW, IVF):
             sim = self.make_sim(backend)
             self.workflow(sim)
             sim.save(opj(self.tmpdir, 'neighbortest'))
             sim2 = SimpleNeighbors.load(opj(self.tmpdir, 'neighbortest'))
             self.workflow(sim2)
 
+    def test_feed_arrays(self):
+        import numpy as np
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn):
+            sim = SimpleNeighbors(3, metric='angular', backend=backend)
+            sim.feed_arrays([item for item, vec in data],
+                            np.array([vec for item, vec in data]))
+            sim.feed_arrays([one_more[0]], memoryview(
+                np.array([one_more[1]], dtype=np.float32)))
+            self.assertRaises(ValueError, sim.feed_arrays, ['x', 'y'],
+                              np.zeros((1, 3)))
+            self.assertRaises(ValueError, sim.feed_arrays, ['x'],
+                              np.zeros((1, 2)))
+            sim.build(20)
+            self.workflow(sim)
+
+    def test_annoy_batches(self):
+        import numpy as np
+        rng = np.random.RandomState(0)
+        sim = SimpleNeighbors(10, backend=Annoy, n_jobs=4)
+        sim.feed_arrays(list(range(500)), rng.randn(500, 10))
+        sim.build(5)
+        queries = rng.randn(200, 10)
+        expected = [sim.nearest(query, 5) for query in queries]
+        self.assertEqual(sim.nearest_many(queries, 5), expected)
+        pool = sim.backend.pool
+        self.assertIsNotNone(pool)
+        self.assertEqual(sim.nearest_many(queries, 5), expected)
+        # the pool is kept between batches
+        self.assertIs(sim.backend.pool, pool)
+        # small batches don't use it
+        sim.backend.close()
+        self.assertEqual(sim.nearest_many(queries[:3], 5), expected[:3])
+        self.assertIsNone(sim.backend.pool)
+
+    def test_build_n_jobs(self):
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn):
+            sim = SimpleNeighbors(3, metric='angular', backend=backend)
+            sim.feed(data + [one_more])
+            sim.build(20, n_jobs=2)
+            self.workflow(sim)
+
+    def test_concurrent_queries(self):
+        from multiprocessing.pool import ThreadPool
+        items = [item for item, vec in data]
+        pool = ThreadPool(8)
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn):
+            sim = SimpleNeighbors(3, metric='angular', backend=backend,
+                                  n_jobs=1)
+            sim.feed(data)
+            sim.build(20)
+            self.assertEqual(sim.backend.n_jobs, 1)
+            expected = [sim.neighbors(item, 5) for item in items]
+            self.assertEqual(
+                pool.map(lambda item: sim.neighbors(item, 5), items * 10),
+                expected * 10)
+            self.assertEqual(sim.nearest_many([vec for item, vec in data]),
+                             [sim.nearest(vec) for item, vec in data])
+            prefix = opj(self.tmpdir, 'neighbortest-threads')
+            sim.save(prefix)
+            sim2 = SimpleNeighbors.load(prefix, n_jobs=2)
+            self.assertEqual(sim2.backend.n_jobs, 2)
+            if backend is Sklearn:
+                self.assertEqual(sim.backend.nn.n_jobs, 1)
+                self.assertEqual(sim2.backend.nn.n_jobs, 2)
+
+            # adding to a mutable index while other threads query it
+            sim = SimpleNeighbors(3, metric='angular', backend=backend,
+                                  mutable=True)
+            sim.feed(data)
+            sim.build(20)
+
+            def add(i):
+                sim.add_one('extra%d' % i, one_more[1])
+                return sim.nearest(one_more[1], 3)
+            results = pool.map(add, range(50))
+            self.assertTrue(all(len(found) == 3 for found in results))
+            self.assertEqual(len(sim), len(data) + 50)
+        pool.close()
+
+    def test_concurrent_compact(self):
+        import threading
+        import numpy as np
+        rng = np.random.RandomState(0)
+        matrix = rng.randn(2000, 8).astype(np.float32)
+        items = ['item%d' % i for i in range(2000)]
+        for backend in (Annoy, BruteForceNumpy):
+            sim = SimpleNeighbors(8, metric='euclidean', backend=backend,
+                                  mutable=True)
+            sim.feed_arrays(items, matrix)
+            sim.build(10)
+            stop = threading.Event()
+            errors = []
+
+            def query(offset):
+                i = offset
+                try:
+                    while not stop.is_set():
+                        item = items[i % 1000 + 1000]
+                        found = sim.neighbors(item, 5)
+                        # (with ids from one state and items from another,
+                        # the item itself wouldn't be found)
+                        if found[0] != item:
+                            errors.append((item, found))
+                        i += 7
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=query, args=(i,))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            try:
+                # each compaction after deletions changes most items' ids
+                for start in range(0, 1000, 200):
+                    for item in items[start:start + 200]:
+                        sim.delete(item)
+                    sim.compact()
+            finally:
+                stop.set()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(len(sim), 1000)
+
+    def test_overlapping_compact(self):
+        import threading
+        import numpy as np
+        rng = np.random.RandomState(0)
+        matrix = rng.randn(5000, 8).astype(np.float32)
+        items = ['item%d' % i for i in range(5000)]
+        sim = SimpleNeighbors(8, metric='euclidean', backend=Annoy,
+                              mutable=True)
+        sim.feed_arrays(items, matrix)
+        sim.build(10)
+        errors = []
+
+        def compact():
+            try:
+                sim.compact()
+            except Exception as e:
+                errors.append(e)
+        for item in items[:2000]:
+            sim.delete(item)
+        threads = [threading.Thread(target=compact)]
+        threads[0].start()
+        for item in items[2000:3000]:
+            sim.delete(item)
+        # later compactions start from the result of the first
+        threads.append(threading.Thread(target=compact))
+        threads[1].start()
+        sim.build(10)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(sim), 2000)
+        self.assertEqual(sim.backend.deleted, set())
+        self.assertEqual(sim.backend.main_count, 2000)
+        self.assertEqual(list(sim.corpus), items[3000:])
+        for item in items[3000::100]:
+            self.assertEqual(sim.neighbors(item, 1), [item])
+
+    def test_sklearn_save(self):
+        import os
+        import numpy as np
+        rng = np.random.RandomState(0)
+        matrix = rng.randn(500, 64).astype(np.float32)
+        sim = SimpleNeighbors(64, 'euclidean', backend=Sklearn)
+        sim.feed_arrays(list(range(500)), matrix)
+        sim.build(20, params={'algorithm': 'brute'})
+        prefix = opj(self.tmpdir, 'neighbortest-sklearn')
+        sim.save(prefix)
+        # the vectors are saved once, in the .npy file
+        self.assertLess(os.path.getsize(prefix + '.idx'), 4096)
+        sim2 = SimpleNeighbors.load(prefix)
+        self.assertTrue(np.shares_memory(sim2.backend.nn._fit_X,
+                                         sim2.backend.items.matrix()))
+        self.assertEqual(sim2.nearest_many(matrix[:10], 5),
+                         sim.nearest_many(matrix[:10], 5))
+
+    def test_with_distances(self):
+        sim = self.make_sim(BruteForceNumpy)
+        vecs = [vec for item, vec in data[:5]]
+        self.assertEqual(sim.nearest_many_with_distances(vecs, 4),
+                         [sim.nearest_with_distances(vec, 4) for vec in vecs])
+        self.assertEqual(
+            sim.nearest_many_with_distances(vecs, 4, oversample=2),
+            [sim.nearest_with_distances(vec, 4, oversample=2)
+             for vec in vecs])
+        found = list(sim.nearest_matching_with_distances(
+            data[0][1], 3, check=lambda item: 'green' in item))
+        self.assertEqual(
+            found, [(item, dist) for item, dist in
+                    sim.nearest_with_distances(data[0][1], 21)
+                    if 'green' in item][:3])
+        sim = SimpleNeighbors(3, backend=BruteForceNumpy, collect_stats=True)
+        sim.feed(data)
+        sim.build()
+        list(sim.nearest_matching_with_distances(data[0][1], 3))
+        self.assertEqual(
+            sim.stats()['nearest_matching_with_distances']['count'], 1)
+
+    def test_empty_batch(self):
+        for backend in (BruteForcePurePython, BruteForceNumpy, Annoy,
+                        Sklearn, Quantized, HNSW, IVF):
+            sim = self.make_sim(backend)
+            self.assertEqual(sim.backend.get_nns_by_vectors([], 5), [])
+            self.assertEqual(sim.nearest_many([], 5), [])
+            self.assertEqual(sim.neighbors_many([], 5), [])
+        sim = SimpleNeighbors(3, metric='angular', mutable=True)
+        sim.feed(data)
+        sim.build(20)
+        sim.add_one(*one_more)
+        self.assertEqual(sim.nearest_many([], 5), [])
+
+    def test_pure_python_old_format(self):
+        import pickle
+        from simpleneighbors.backends.bruteforcepurepython import norm_dist
+        sim = self.make_sim(BruteForcePurePython)
+        prefix = opj(self.tmpdir, 'neighbortest-oldformat')
+        sim.save(prefix)
+        # indexes saved by 0.1.0 pickled the vectors as a list of tuples
+        old = BruteForcePurePython.__new__(BruteForcePurePython)
+        old.items = [tuple(float(x) for x in vec)
+                     for item, vec in data + [one_more]]
+        old.dist_fn = norm_dist
+        with open(prefix + '.idx', 'wb') as fh:
+            pickle.dump(old, fh)
+        sim2 = SimpleNeighbors.load(prefix)
+        self.assertEqual(sim2.vec('violet'), list(data[1][1]))
+        self.assertEqual(sim2.neighbors('violet', 5),
+                         sim.neighbors('violet', 5))
+
+    def test_on_disk_build(self):
+        for backend in (Annoy, BruteForceNumpy, Quantized, HNSW, IVF):
+            prefix = opj(self.tmpdir, 'neighbortest-ondisk')
+            sim = SimpleNeighbors(3, metric='angular', backend=backend,
+                                  on_disk=prefix)
+            sim.feed(data)
+            sim.add_one(*one_more)
+            sim.build(20)
+            self.assertIsInstance(sim.corpus, MappedCorpus)
+            self.workflow(sim)
+            sim.save(prefix)
+            self.workflow(SimpleNeighbors.load(prefix))
+            other = opj(self.tmpdir, 'neighbortest-ondisk-copy')
+            sim.save(other)
+            self.workflow(SimpleNeighbors.load(other))
+
+    def test_far_from_origin(self):
+        import numpy as np
+        rng = np.random.RandomState(0)
+        base = np.array([500.0, 300.0, 800.0])
+        matrix = base + rng.normal(0, 0.05, size=(200, 3))
+        items = list(range(200))
+        exact = SimpleNeighbors(3, 'euclidean', backend=BruteForcePurePython)
+        exact.feed_arrays(items, matrix)
+        exact.build()
+        expected = exact.nearest_with_distances(base, 8)
+        for backend in (BruteForceNumpy, Quantized, HNSW, IVF):
+            sim = SimpleNeighbors(3, 'euclidean', backend=backend)
+            sim.feed_arrays(items, matrix)
+            sim.build(4)
+            found = sim.nearest_with_distances(base, 8)
+            self.assertEqual([item for item, dist in found],
+                             [item for item, dist in expected])
+            for (item, dist), (exact_item, exact_dist) in zip(found,
+                                                              expected):
+                self.assertAlmostEqual(dist, exact_dist, places=4)
+            # a point 0.01 away is reported as 0.01 away
+            sim = SimpleNeighbors(3, 'euclidean', backend=backend)
+            sim.feed_arrays(['a', 'b'], [base, base + [0.01, 0, 0]])
+            sim.build(1)
+            self.assertAlmostEqual(
+                sim.nearest_with_distances(base, 2)[1][1], 0.01, places=4)
+
+    def test_query_cache(self):
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn):
+            sim = SimpleNeighbors(3, metric='angular', backend=backend,
+                                  cache_size=2)
+            sim.feed(data + [one_more])
+            sim.build(20)
+            self.workflow(sim)
+            self.workflow(sim)
+            info = sim.cache_info()
+            self.assertEqual(info['size'], 2)
+            self.assertGreater(info['hits'], 0)
+            # results are the same whether or not they come from the cache
+            first = sim.nearest([100, 100, 200], 3)
+            self.assertEqual(sim.nearest([100, 100, 200], 3), first)
+            self.assertEqual(
+                sim.nearest_with_distances([100, 100, 200], 3)[0][0],
+                first[0])
+        self.assertIsNone(self.make_sim(BruteForceNumpy).cache_info())
+
+    def test_nearest_matching_rounds(self):
+        sim = self.make_sim(BruteForceNumpy)
+        calls = []
+        get_nns_by_vector = sim.backend.get_nns_by_vector
+
+        def counting(vec, n, include_distances=False, search_k=None):
+            calls.append(n)
+            return get_nns_by_vector(vec, n, include_distances, search_k)
+        sim.backend.get_nns_by_vector = counting
+
+        checked = []
+
+        def check(item):
+            checked.append(item)
+            return item.endswith('green')
+        found = list(sim.neighbors_matching('mint', 5, check))
+        self.assertEqual(len(found), 5)
+        self.assertTrue(all(item.endswith('green') for item in found))
+        # each candidate is only checked once, however many rounds it takes
+        self.assertEqual(len(checked), len(set(checked)))
+        self.assertGreater(len(calls), 1)
+        self.assertTrue(all(n <= len(sim) for n in calls))
+
+        # asking for more items than pass the check exhausts the index
+        found = list(sim.neighbors_matching('mint', 50, check))
+        self.assertEqual(len(found), 6)
+        self.assertEqual(len(list(sim.neighbors_matching('mint', 50))),
+                         len(sim))
+
+    def test_metadata_filters(self):
+        from simpleneighbors.metadata import Range
+
+        def meta(item):
+            return {'green': item.endswith('green'), 'length': len(item)}
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn):
+            sim = SimpleNeighbors(3, metric='angular', backend=backend)
+            sim.feed([(item, vec, meta(item)) for item, vec in data])
+            sim.add_one(one_more[0], one_more[1], meta(one_more[0]))
+            sim.build(20)
+            self.workflow(sim)
+            greens = list(sim.neighbors_matching(
+                'mint', 10, where={'green': True}))
+            self.assertEqual(
+                greens,
+                list(sim.neighbors_matching(
+                    'mint', 10, lambda x: x.endswith('green'))))
+            self.assertEqual(len(greens), 6)
+            short = list(sim.nearest_matching(
+                [100, 100, 200], 3,
+                where={'green': False, 'length': Range(hi=6)}))
+            self.assertEqual(short, ['dusk', 'violet', 'mint'])
+            self.assertEqual(
+                list(sim.nearest_matching(
+                    [100, 100, 200], 3,
+                    check=lambda x: x != 'dusk',
+                    where={'length': [4, 5]})),
+                ['mint', 'topaz'])
+            self.assertEqual(list(sim.nearest_matching(
+                [100, 100, 200], 3, where={'color': 'red'})), [])
+            prefix = opj(self.tmpdir, 'neighbortest-metadata')
+            sim.save(prefix)
+            sim2 = SimpleNeighbors.load(prefix)
+            self.assertEqual(list(sim2.neighbors_matching(
+                'mint', 10, where={'green': True})), greens)
+
+    def test_mutable(self):
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn, Quantized, HNSW, IVF):
+            full = self.make_sim(backend)
+            sim = SimpleNeighbors(3, metric='angular', backend=backend,
+                                  mutable=True)
+            sim.feed(data)
+            sim.build(20)
+            sim.add_one(*one_more)
+            self.assertEqual(len(sim), len(data) + 1)
+            self.assertEqual(sim.neighbors('purpley', 5),
+                             full.neighbors('purpley', 5))
+            self.assertEqual(sim.nearest(one_more[1], 5),
+                             full.nearest(one_more[1], 5))
+            self.assertAlmostEqual(sim.dist('purpley', 'mint'),
+                                   full.dist('purpley', 'mint'), places=5)
+            sim.delete('violet')
+            self.assertEqual(len(sim), len(data))
+            self.assertNotIn('violet', sim.nearest(one_more[1], 21))
+            self.assertEqual(len(sim.nearest(one_more[1], 21)), len(data))
+            # re-adding an item replaces it
+            sim.add_one('mint', data[0][1])
+            self.assertEqual(len(sim), len(data))
+            # (the two are the same distance away; which comes first depends
+            # on the rounding errors of each segment's backend)
+            self.assertEqual(set(sim.nearest(data[0][1], 2)),
+                             set(['mahogany', 'mint']))
+            expected = sim.nearest(one_more[1], 10)
+            sim.compact()
+            self.assertEqual(len(sim.corpus), len(data))
+            self.assertEqual(sim.backend.deleted, set())
+            self.assertEqual(sim.nearest(one_more[1], 10), expected)
+            sim.add_one('violet', data[1][1])
+            sim.compact(background=True).join()
+            self.assertEqual(sim.neighbors('purpley', 5),
+                             full.neighbors('purpley', 5))
+            prefix = opj(self.tmpdir, 'neighbortest-mutable')
+            sim.delete('dusk')
+            sim.save(prefix)
+            sim2 = SimpleNeighbors.load(prefix)
+            self.assertEqual(len(sim2), len(sim))
+            self.assertEqual(sim2.nearest(one_more[1], 10),
+                             sim.nearest(one_more[1], 10))
+            sim2.add_one('dusk', data[6][1])
+            self.assertIn('dusk', sim2.neighbors('ugly blue', 3))
+
+    def test_stats(self):
+        calls = []
+        sim = SimpleNeighbors(3, metric='angular', backend=BruteForceNumpy,
+                              collect_stats=True)
+        self.assertEqual(sim.stats(), {})
+        sim.add_hook(lambda op, seconds, info: calls.append(op))
+        sim.feed(data)
+        sim.build()
+        sim.nearest(one_more[1], 3)
+        sim.neighbors('mint', 3)
+        found = list(sim.nearest_matching(one_more[1], 2,
+                                          lambda x: x.endswith('green')))
+        self.assertEqual(len(found), 2)
+        sim.dist('mint', 'dusk')
+        prefix = opj(self.tmpdir, 'neighbortest-stats')
+        sim.save(prefix)
+        self.assertEqual(calls, ['add_one'] * len(data) + [
+            'feed', 'build', 'nearest', 'vec', 'nearest', 'neighbors',
+            'nearest_matching', 'dist', 'save'])
+        stats = sim.stats(reset=True)
+        self.assertEqual(stats['nearest']['count'], 2)
+        self.assertEqual(stats['feed']['count'], 1)
+        matching = stats['nearest_matching']
+        self.assertEqual(matching['results'], 2)
+        self.assertTrue(matching['backend_calls'] >= 1)
+        self.assertTrue(matching['check_calls'] >= 2)
+        self.assertTrue(matching['total_sec'] >= matching['check_sec'])
+        self.assertEqual(sum(count for bound, count in matching['buckets']),
+                         1)
+        self.assertEqual(sim.stats(), {})
+
+        loaded = []
+        sim2 = SimpleNeighbors.load(prefix, collect_stats=True,
+                                    hooks=[lambda *args: loaded.append(args)])
+        self.assertEqual(sim2.stats()['load']['count'], 1)
+        self.assertEqual(loaded[0][0], 'load')
+        sim2.remove_hook(sim2.stats_hook)
+        sim2.nearest(one_more[1])
+        self.assertEqual(list(sim2.stats()), ['load'])
+        self.assertEqual(len(loaded), 2)
+        self.assertIsNone(SimpleNeighbors(3).stats())
+
+    def test_search_k(self):
+        import numpy as np
+        rng = np.random.RandomState(0)
+        matrix = rng.randn(1000, 20)
+        queries = rng.randn(20, 20)
+        items = list(range(1000))
+        exact = SimpleNeighbors(20, backend=BruteForceNumpy)
+        exact.feed_arrays(items, matrix)
+        exact.build()
+        sim = SimpleNeighbors(20, backend=Annoy, cache_size=100)
+        sim.feed_arrays(items, matrix)
+        sim.build(2)
+
+        def overlap(search_k):
+            return sum(
+                len(set(sim.nearest(query, 10, search_k=search_k)) &
+                    set(exact.nearest(query, 10)))
+                for query in queries)
+        # inspecting every node gives exact results
+        self.assertEqual(overlap(1000000), 200)
+        self.assertLess(overlap(10), 200)
+        # search_k is part of the cache key
+        self.assertEqual(overlap(1000000), 200)
+        sim.search_k = 1000000
+        self.assertEqual(overlap(None), 200)
+        self.assertEqual(
+            sim.nearest_many(queries, 10, search_k=1000000),
+            exact.nearest_many(queries, 10))
+        self.assertEqual(
+            list(sim.neighbors_matching(0, 5, lambda x: x % 2,
+                                        search_k=1000000)),
+            list(exact.neighbors_matching(0, 5, lambda x: x % 2)))
+        # exact backends ignore it
+        self.assertEqual(exact.nearest(queries[0], 10, search_k=1),
+                         exact.nearest(queries[0], 10))
+
+    def test_oversample(self):
+        import numpy as np
+        rng = np.random.RandomState(0)
+        matrix = rng.randn(1000, 20)
+        queries = rng.randn(20, 20)
+        items = list(range(1000))
+        for metric in ('angular', 'euclidean', 'manhattan'):
+            sim = SimpleNeighbors(20, metric, backend=Annoy, cache_size=100)
+            sim.feed_arrays(items, matrix)
+            sim.build(2)
+            # annoy's exact results, for comparison
+            expected = sim.nearest_many(queries, 10, search_k=1000000)
+
+            def overlap(oversample):
+                return sum(
+                    len(set(sim.nearest(query, 10, oversample=oversample)) &
+                        set(exact))
+                    for query, exact in zip(queries, expected))
+            self.assertGreater(overlap(10), overlap(None))
+            # oversample is part of the cache key
+            self.assertGreater(overlap(10), overlap(None))
+            self.assertEqual(
+                sim.nearest_many(queries, 10, search_k=1000000, oversample=1),
+                expected)
+            self.assertEqual(
+                sim.nearest_many(queries, 10, oversample=10),
+                [sim.nearest(query, 10, oversample=10) for query in queries])
+            for item, dist in sim.neighbors_with_distances(0, 5,
+                                                           oversample=4):
+                self.assertAlmostEqual(dist, sim.dist(0, item), places=4)
+            self.assertEqual(sim.neighbors(0, 5, oversample=4),
+                             sim.neighbors_many([0], 5, oversample=4)[0])
+
+        sim = SimpleNeighbors(3, metric='dot', backend=Annoy)
+        sim.feed(data)
+        sim.build(2)
+        self.assertRaises(ValueError, sim.nearest, [1, 2, 3], 3,
+                          oversample=2)
+
+    def test_all_neighbors(self):
+        import numpy as np
+        for backend in (Annoy, BruteForceNumpy):
+            sim = self.make_sim(backend)
+            items = list(sim.corpus)
+            expected = [sim.neighbors(item, 5) for item in items]
+            ids, dists = sim.all_neighbors(5)
+            self.assertEqual(ids.dtype, np.int32)
+            self.assertEqual(dists.dtype, np.float32)
+            self.assertEqual(
+                [[sim.corpus[idx] for idx in row] for row in ids.tolist()],
+                expected)
+            self.assertAlmostEqual(float(dists[0, 1]),
+                                   sim.dist(items[0], expected[0][1]),
+                                   places=4)
+            path = opj(self.tmpdir, 'neighbortest-knn')
+            ids, dists = sim.all_neighbors(5, path, workers=2, block_size=4)
+            self.assertEqual(ids.tolist(), sim.all_neighbors(5)[0].tolist())
+            self.assertRaises(ValueError, sim.all_neighbors, 3, path,
+                              resume=True, block_size=4)
+
+        # resuming only searches for the blocks that weren't finished
+        done = np.load(path + '-done.npy', mmap_mode='r+')
+        done[1] = 0
+        done.flush()
+        stale = np.load(path + '-ids.npy', mmap_mode='r+')
+        stale[:8] = 0
+        stale.flush()
+        del done, stale
+        ids, dists = sim.all_neighbors(5, path, block_size=4, resume=True)
+        self.assertEqual(ids[:4].tolist(), [[0] * 5] * 4)
+        self.assertEqual(ids[4:].tolist(),
+                         sim.all_neighbors(5)[0][4:].tolist())
+
+        sim = SimpleNeighbors(3, metric='angular', mutable=True)
+        sim.feed(data)
+        sim.build(20)
+        sim.delete('violet')
+        ids, dists = sim.all_neighbors(3)
+        self.assertEqual(ids[1].tolist(), [-1, -1, -1])
+        self.assertNotIn(1, ids)
+
+        # blocks of vectors are read the same way from every backend
+        # (including the delta of a mutable index)
+        sim.add_one(*one_more)
+        ids = [0, 20, 2]
+        self.assertEqual(
+            [[float(x) for x in vec]
+             for vec in sim.backend.get_item_vectors(ids)],
+            [sim.backend.get_item_vector(idx) for idx in ids])
+        for backend in (BruteForcePurePython, Sklearn, Quantized, HNSW, IVF):
+            sim = self.make_sim(backend)
+            ids, dists = sim.all_neighbors(5, block_size=8)
+            self.assertEqual(
+                [[sim.corpus[idx] for idx in row] for row in ids.tolist()],
+                [sim.neighbors(item, 5) for item in sim.corpus])
+
+    def test_query_cache_eviction(self):
+        from simpleneighbors.cache import QueryCache
+        cache = QueryCache(maxsize=2, ttl=None)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), (True, 1))
+        cache.put('c', 3)
+        # 'b' was the least recently used
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('c'), (True, 3))
+        self.assertEqual(cache.info()['hits'], 3)
+        self.assertEqual(cache.info()['misses'], 1)
+        cache = QueryCache(maxsize=2, ttl=-1)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), (False, None))
+
+    def test_compact_workflow(self):
+        for backend in (Annoy, BruteForcePurePython, BruteForceNumpy,
+                        Sklearn, Quantized, HNSW, IVF):
+            sim = self.make_sim(backend)
+            prefix = opj(self.tmpdir, 'neighbortest-compact')
+            sim.save(prefix, compact=True)
+            sim2 = SimpleNeighbors.load(prefix)
+            self.assertIsInstance(sim2.corpus, MappedCorpus)
+            self.assertEqual(list(sim2.corpus), list(sim.corpus))
+            self.assertEqual(sim2.id_map['mint'], sim.id_map['mint'])
+            self.assertRaises(KeyError, sim2.vec, 'not a color')
+            self.workflow(sim2)
+            # a loaded compact index can be resaved in the pickle format
+            sim2.save(opj(self.tmpdir, 'neighbortest-resaved'))
+            self.workflow(SimpleNeighbors.load(
+                opj(self.tmpdir, 'neighbortest-resaved')))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import tempfile
+from os.path import join as opj
+from shutil import rmtree
+
+import numpy as np
+
+from simpleneighbors import SimpleNeighbors
+from simpleneighbors.backends import Annoy, BruteForceNumpy
+from simpleneighbors.tuning import tune, tune_search
+
+
+class TestTuning(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        cls.matrix = rng.randn(500, 16).astype(np.float32)
+        cls.items = ['item%d' % i for i in range(500)]
+        cls.queries = rng.randn(30, 16).astype(np.float32)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.tmpdir)
+
+    def test_tune(self):
+        result = tune(self.items, self.matrix, self.queries, n=10,
+                      min_recall=0.99, backends=[Annoy, BruteForceNumpy],
+                      build_ns=(2, 10))
+        # five search efforts for each number of trees, and one exact search
+        self.assertEqual(len(result.trials), 2 * 5 + 1)
+        self.assertTrue(result.met_target)
+        self.assertGreaterEqual(result.recall, 0.99)
+        self.assertIsInstance(result.sim.backend, result.backend)
+        self.assertEqual(result.sim.search_k, None)
+        if result.search_k is not None:
+            # Annoy's effort is stored per result
+            self.assertEqual(result.sim.search_effort * 10, result.search_k)
+        fastest = min(trial.latency_ms for trial in result.trials
+                      if trial.recall >= 0.99)
+        self.assertEqual(result.latency_ms, fastest)
+
+        # an impossible target gets the closest settings
+        result = tune(self.items, self.matrix, self.queries, n=10,
+                      max_latency_ms=1e-9, backends=[Annoy],
+                      build_ns=(2,))
+        self.assertFalse(result.met_target)
+        self.assertEqual(result.latency_ms,
+                         min(trial.latency_ms for trial in result.trials))
+
+    def test_tune_search(self):
+        sim = SimpleNeighbors(16, backend=Annoy)
+        sim.feed_arrays(self.items, self.matrix)
+        sim.build(2)
+        result = tune_search(sim, self.queries, n=10, min_recall=0.9)
+        self.assertEqual(len(result.trials), 5)
+        self.assertTrue(result.met_target)
+        self.assertGreaterEqual(result.recall, 0.9)
+        self.assertEqual(sim.search_k, None)
+        self.assertEqual(sim.search_effort * 10, result.search_k)
+        prefix = opj(self.tmpdir, 'tuned')
+        sim.save(prefix)
+        sim2 = SimpleNeighbors.load(prefix)
+        self.assertEqual(sim2.search_effort, sim.search_effort)
+        self.assertEqual(sim2.nearest(self.queries[0], 10),
+                         sim.nearest(self.queries[0], 10))
+
+    def test_search_effort(self):
+        sim = SimpleNeighbors(16, backend=Annoy)
+        sim.feed_arrays(self.items, self.matrix)
+        sim.build(2)
+        # two nodes per result (tuned for 10 results, search_k=20) would
+        # find fewer than 100 results if the effort didn't grow with n
+        sim.search_effort = 2.0
+        self.assertEqual(len(sim.nearest(self.queries[0], 100)), 100)
+        self.assertEqual(len(sim.nearest_many(self.queries[:2], 100)[1]),
+                         100)
+        # a filtered search keeps expanding when a round comes up short
+        # because of a small effort, rather than taking it as the end of
+        # the index
+        sim.search_effort = 0.5
+        odd = set(self.items[1::2])
+        self.assertEqual(len(list(sim.nearest_matching(
+            self.queries[0], 50, check=lambda item: item in odd))), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
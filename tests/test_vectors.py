@@ -0,0 +1,39 @@
+import unittest
+
+from simpleneighbors.backends.vectors import VectorStore
+
+
+class TestVectorStore(unittest.TestCase):
+
+    def check_store(self, store):
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.matrix().shape, (0, 3))
+        for i in range(100):
+            store.append((i, i + 0.5, -i))
+        self.assertEqual(len(store), 100)
+        self.assertEqual(store.get(42), [42.0, 42.5, -42.0])
+        self.assertEqual(list(store.row(99)), [99.0, 99.5, -99.0])
+        matrix = store.matrix()
+        self.assertEqual(matrix.shape, (100, 3))
+        self.assertEqual(str(matrix.dtype), 'float32')
+        self.assertEqual(matrix[7].tolist(), [7.0, 7.5, -7.0])
+        self.assertRaises(IndexError, store.get, 100)
+        self.assertRaises(ValueError, store.append, (1, 2))
+        # a single value isn't broadcast to every dimension
+        self.assertRaises(ValueError, store.append, [5])
+        self.assertRaises(ValueError, store.append, (1, 2, 3, 4))
+        self.assertEqual(len(store), 100)
+
+    def test_numpy_store(self):
+        store = VectorStore(3, use_numpy=True)
+        self.check_store(store)
+        # the matrix is a view on the store's buffer, not a copy
+        store.matrix()[0, 0] = 1000.0
+        self.assertEqual(store.get(0)[0], 1000.0)
+
+    def test_array_store(self):
+        self.check_store(VectorStore(3, use_numpy=False))
+
+
+if __name__ == '__main__':
+    unittest.main()